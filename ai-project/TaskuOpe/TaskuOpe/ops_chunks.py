@@ -7,53 +7,501 @@ toimintoja OPS-chunkien hakuun ja suodatukseen.
 Lukee JSONin: TaskuOpe/ops_data/opetussuunnitelma_1-6_API_data.json
 """
 
+import hashlib
 import json
+import math
 import os
 import re
+import threading
 import time
+from array import array
 from collections import Counter
-from typing import Dict, List, Optional, Tuple
+from functools import lru_cache
+from itertools import islice
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Sequence, Tuple
 
 from django.conf import settings
 
+from . import ops_index
+from .ops_normalize import analyze_token, stem
+
+# Vektoroitu pisteytys (numpy tulee scikit-learnin mukana)
+try:
+    import numpy as np
+    _HAS_SPARSE = True
+except ImportError:
+    _HAS_SPARSE = False
+
+# Tarkka token-laskenta promptin kokoamiseen (valinnainen)
+try:
+    import tiktoken
+    _HAS_TIKTOKEN = True
+except ImportError:
+    _HAS_TIKTOKEN = False
+
 JSON_FILENAME = "opetussuunnitelma_1-6_API_data.json"
+# Keräimen (ops_data/collect_ops_data_API_toimiva.py) tuottama rivimuotoinen data; ensisijainen
+JSONL_FILENAME = "opetussuunnitelma_1-6_API_data.jsonl"
+INDEX_FILENAME = "opetussuunnitelma_1-6_API_data.idx"
 
-_DATA: List[Dict] = []
-_FACETS: Dict[str, List[str]] = {}
-_LOADED_PATH = ""
-_LOADED_MTIME = 0.0
+# Ladattu data (_OpsState). Uusi data ladataan aina uuteen olioon, joka vaihdetaan
+# tähän yhdellä sijoituksella: haku näkee joko vanhan tai uuden indeksin, ei sekoitusta.
+_STATE: Optional["_OpsState"] = None
+_STATE_LOCK = threading.Lock()      # sarjallistaa vain lataukset, ei hakuja
+# Taustalla tuoreutta tarkkaileva säie (käynnistetään prosessikohtaisesti)
+_WATCHER: Optional[threading.Thread] = None
+_WATCHER_PID = 0
 
 WORD_RE = re.compile(r"\w+", re.UNICODE)
 
+# Pisteytystavat: "tf" = alkuperäinen kevyt TF-heuristiikka, "bm25" = Okapi BM25
+SCORERS = ("tf", "bm25")
+# Analysaattorit: "plain" = \w+ ja pienet kirjaimet, "finnish" = lisäksi kevyt
+# suomen vartalointi ja yhdyssanojen pilkonta (ks. ops_normalize)
+ANALYZERS = ("plain", "finnish")
+# Indeksin taulukoiden etuliite analysaattoreittain
+_SECTION_PREFIX = {"plain": "", "finnish": "fi_"}
+FI_MEMO_SIZE = 16384
+# Hakumoottorit: "python" = posting-listojen läpikäynti, "sparse" = numpy-summaus,
+# "auto" = sparse, kun kyselytermien posting-listoja on yhteensä vähintään
+# SPARSE_MIN_POSTINGS (harvinaisilla termeillä listojen läpikäynti on nopeampi)
+ENGINES = ("auto", "python", "sparse")
+SPARSE_MIN_POSTINGS = 256
+# Facetin nimi get_facets-vastauksessa -> rivin kenttä
+FACET_FIELDS = (
+    ("subjects", "subject"),
+    ("grades", "grade_context"),
+    ("content_types", "content_type"),
+)
+# Rivin kentät, jotka tallennetaan indeksiin arvotaulukkona + tunnisteina
+ROW_FIELDS = ("subject", "grade_context", "content_type", "source")
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Hakutulosten LRU-välimuistin koko (prosessikohtainen, tyhjenee datan latautuessa)
+QUERY_CACHE_SIZE = 1024
+# Kuinka usein (s) taustasäie tarkistaa JSONin ja indeksin muutokset;
+# settings.OPS_RELOAD_INTERVAL ohittaa, 0 poistaa tarkistukset käytöstä
+RELOAD_INTERVAL = 5.0
+# gpt-4o-mallien tokenisaattori; ilman tiktokenia käytetään arviota
+TOKEN_ENCODING = "o200k_base"
+# Arvio ilman tiktokenia: suomenkielisessä tekstissä noin 3 merkkiä / token
+CHARS_PER_TOKEN = 3.0
+TOKEN_CACHE_SIZE = 8192
+
 def _json_path() -> str:
-    """Palauttaa JSON-tiedoston koko polun."""
-    import os
-    from django.conf import settings
+    """Palauttaa datatiedoston koko polun.
+
+    settings.OPS_DATA_PATH ohittaa; muuten käytetään keräimen JSONL-tiedostoa,
+    jos se on olemassa, ja muuten vanhaa JSON-tiedostoa.
+    """
+    override = getattr(settings, "OPS_DATA_PATH", None)
+    if override:
+        return override
     # BASE_DIR osoittaa yleensä .../TaskuOpe
+    jsonl = os.path.join(settings.BASE_DIR, "ops_data", JSONL_FILENAME)
+    if os.path.exists(jsonl):
+        return jsonl
     return os.path.join(settings.BASE_DIR, "ops_data", JSON_FILENAME)
 
-def _build_facets(rows: List[Dict]) -> Dict[str, List[str]]:
-    """Rakentaa facetit (aiheet, luokka-asteet, sisältötyypit) datasta.
+def _load_raw(payload: bytes, path: str) -> List[Dict]:
+    """Jäsentää datatiedoston sisällön: JSONL rivi kerrallaan, muuten yksi JSON-lista."""
+    if path.endswith(".jsonl"):
+        return [json.loads(line) for line in payload.splitlines() if line.strip()]
+    return json.loads(payload)
+
+def _index_path() -> str:
+    """Palauttaa binääri-indeksin polun (settings.OPS_INDEX_PATH tai ops_data/*.idx)."""
+    return getattr(settings, "OPS_INDEX_PATH", None) or os.path.join(
+        settings.BASE_DIR, "ops_data", INDEX_FILENAME
+    )
+
+class _PostingIndex:
+    """Yhden analysaattorin termi-järjestetyt posting-listat litteinä taulukkoina.
+
+    Termin t posting-lista on kohdat ptr[i]:ptr[i + 1] taulukoissa doc
+    (rivin indeksi), tf (termifrekvenssi) ja bm25 (valmiiksi laskettu
+    tf * (k1 + 1) / (tf + norm)), missä i = vocab[t]. idf on termeittäin ja
+    doc_len riveittäin. Sama rakenne toimii sekä tavallisilla
+    array-taulukoilla että mmapin memoryview-näkymillä.
+    """
+
+    def __init__(self, sections: Dict[str, Sequence], prefix: str, n_docs: int):
+        vocab_off = sections[f"{prefix}vocab_off"]
+        if isinstance(vocab_off, memoryview):
+            self.vocab = ops_index.MappedVocab(sections[f"{prefix}vocab_blob"], vocab_off)
+            self._terms = None
+        else:
+            blob = bytes(sections[f"{prefix}vocab_blob"])
+            self._terms = [
+                blob[vocab_off[i]:vocab_off[i + 1]].decode("utf-8") for i in range(len(vocab_off) - 1)
+            ]
+            self.vocab = {term: i for i, term in enumerate(self._terms)}
+        self.ptr = sections[f"{prefix}post_ptr"]
+        self.doc = sections[f"{prefix}post_doc"]
+        self.tf = sections[f"{prefix}post_tf"]
+        self.bm25 = sections[f"{prefix}post_bm25"]
+        self.idf = sections[f"{prefix}idf"]
+        self.doc_len = sections[f"{prefix}doc_len"]
+        self.sparse = _build_sparse(self, n_docs)
+
+    def term_id(self, term: str) -> Optional[int]:
+        return self.vocab.get(term)
+
+    def term(self, i: int) -> str:
+        """Palauttaa termin indeksillä i."""
+        return self._terms[i] if self._terms is not None else self.vocab.term(i)
+
+    def count(self, term: str) -> int:
+        """Palauttaa termin posting-listan pituuden (0 tuntemattomalle)."""
+        i = self.vocab.get(term)
+        return 0 if i is None else self.ptr[i + 1] - self.ptr[i]
+
+    def get(self, term: str, default=()):
+        """Palauttaa termin posting-listan (rivin indeksi, tf) -pareina."""
+        i = self.vocab.get(term)
+        if i is None:
+            return default
+        a, b = self.ptr[i], self.ptr[i + 1]
+        return list(zip(self.doc[a:b], self.tf[a:b]))
+
+    def __contains__(self, term: str) -> bool:
+        return self.vocab.get(term) is not None
+
+    def __len__(self) -> int:
+        return len(self.vocab)
+
+def _parse_row(i: int, r: Dict) -> Optional[Dict]:
+    """Esikäsittelee yhden rivin hakua varten; tyhjä sisältö -> None."""
+    txt = (r.get("content") or "").strip()
+    if not txt:
+        return None
+    subj = (r.get("subject") or "").strip()
+    grade = (r.get("grade_context") or "").strip()
+    ctype = (r.get("content_type") or "").strip()
+    src = (r.get("source") or "POPS_2014").strip()
+    tokens = _tokenize(txt)
+    tf = Counter(tokens)
+    return {
+        "id": f"ops-{i}",
+        "text": txt,
+        "subject": subj,
+        "grade_context": grade,
+        "content_type": ctype,
+        "source": src,
+        "_tokens": tokens,
+        "_tf": tf,                  # term frequencies
+        "_len": max(len(tokens), 1) # pituus normaaliin
+    }
+
+def _parse_rows(raw: List[Dict]) -> List[Dict]:
+    """Esikäsittelee JSONin rivit hakua varten (tokenit, _tf, _len).
+
+    Args:
+        raw: JSON-tiedoston rivit.
+
+    Returns:
+        Lista sanakirjoja; tyhjät rivit ohitetaan, id viittaa JSONin riviin.
+    """
+    return _parse_subjects(raw)[0]
+
+def _parse_subjects(
+    raw: List[Dict], previous: Optional[Dict[str, Tuple[str, List[Optional[Dict]]]]] = None,
+) -> Tuple[List[Dict], Dict[str, Tuple[str, List[Optional[Dict]]]], List[str]]:
+    """Esikäsittelee rivit oppiaineittain ja käyttää muuttumattomat uudelleen.
+
+    Oppiaineen rivien tiiviste verrataan edelliseen lataukseen; jos se on
+    sama, aiemmin tokenisoidut rivit käytetään sellaisinaan (vain id
+    päivitetään rivin uuteen paikkaan). Posting-listat rakennetaan silti
+    kokonaan, mutta tokenisointi tehdään vain muuttuneille oppiaineille.
+
+    Args:
+        raw: Datatiedoston rivit.
+        previous: Edellisen latauksen oppiaineet (_OpsState.subjects).
+
+    Returns:
+        Tuple (rivit, oppiaine -> (tiiviste, rivit), uudelleen käsitellyt oppiaineet).
+    """
+    groups: Dict[str, List[int]] = {}
+    for i, r in enumerate(raw):
+        groups.setdefault((r.get("subject") or "").strip(), []).append(i)
+
+    parsed: List[Optional[Dict]] = [None] * len(raw)
+    subjects: Dict[str, Tuple[str, List[Optional[Dict]]]] = {}
+    reparsed: List[str] = []
+    for subject, positions in groups.items():
+        h = hashlib.sha1()
+        for i in positions:
+            h.update(json.dumps(raw[i], sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        digest = h.hexdigest()
+        old = (previous or {}).get(subject)
+        if old is not None and old[0] == digest:
+            rows = [None if row is None else dict(row, id=f"ops-{i}") for i, row in zip(positions, old[1])]
+        else:
+            rows = [_parse_row(i, raw[i]) for i in positions]
+            reparsed.append(subject)
+        subjects[subject] = (digest, rows)
+        for i, row in zip(positions, rows):
+            parsed[i] = row
+    return [row for row in parsed if row is not None], subjects, reparsed
+
+def _read_rows() -> List[Dict]:
+    """Lukee ja esikäsittelee datatiedoston rivit (sisältävät _tf-laskurit _score-funktiolle)."""
+    path = _json_path()
+    with open(path, "rb") as f:
+        return _parse_rows(_load_raw(f.read(), path))
+
+def _postings_sections(doc_tfs: List[Counter], prefix: str) -> Dict[str, array]:
+    """Rakentaa yhden analysaattorin posting-taulukot rivien termilaskureista.
+
+    IDF ja BM25-painot lasketaan tässä kerran, joten kyselyn aikana jää
+    vain summaus.
+
+    Args:
+        doc_tfs: Termifrekvenssit riveittäin.
+        prefix: Taulukoiden nimien etuliite (ks. _SECTION_PREFIX).
+
+    Returns:
+        Osion nimi -> array-taulukko.
+    """
+    terms = sorted({t for tf in doc_tfs for t in tf})
+    vocab = {term: i for i, term in enumerate(terms)}
+    per_term: List[List[Tuple[int, int]]] = [[] for _ in terms]
+    for doc_id, doc_tf in enumerate(doc_tfs):
+        for term, tf in doc_tf.items():
+            per_term[vocab[term]].append((doc_id, tf))
+
+    n_docs = len(doc_tfs)
+    lengths = [max(sum(tf.values()), 1) for tf in doc_tfs]
+    avgdl = (sum(lengths) / n_docs) if n_docs else 1.0
+    norms = [BM25_K1 * (1.0 - BM25_B + BM25_B * n / avgdl) for n in lengths]
+    ptr, doc, tfs, bm25, idf = array("i", [0]), array("i"), array("d"), array("d"), array("d")
+    for plist in per_term:
+        idf.append(math.log(1.0 + (n_docs - len(plist) + 0.5) / (len(plist) + 0.5)))
+        for doc_id, tf in plist:
+            doc.append(doc_id)
+            tfs.append(tf)
+            bm25.append(tf * (BM25_K1 + 1.0) / (tf + norms[doc_id]))
+        ptr.append(len(doc))
+
+    sections: Dict[str, array] = {}
+    sections[f"{prefix}vocab_blob"], sections[f"{prefix}vocab_off"] = ops_index.pack_strings(terms)
+    sections[f"{prefix}post_ptr"] = ptr
+    sections[f"{prefix}post_doc"] = doc
+    sections[f"{prefix}post_tf"] = tfs
+    sections[f"{prefix}post_bm25"] = bm25
+    sections[f"{prefix}idf"] = idf
+    sections[f"{prefix}doc_len"] = array("d", lengths)
+    return sections
+
+def _build_sections(rows: List[Dict]) -> Tuple[Dict[str, Any], Dict[str, array]]:
+    """Rakentaa indeksin litteät taulukot esikäsitellyistä riveistä.
+
+    Samat taulukot tallennetaan indeksitiedostoon (build_index_file) tai
+    otetaan suoraan käyttöön, jos tiedostoa ei ole. Jokaiselle
+    analysaattorille rakennetaan omat posting-taulukot; "finnish"-termit
+    lasketaan kerran koko sanastolle ja tallennetaan vartalointitauluksi
+    (fi_map_*), jota kyselyt käyttävät suoraan.
+
+    Args:
+        rows: Esikäsitellyt OPS-rivit (_parse_rows).
+
+    Returns:
+        Tuple (header, sections): header sisältää kenttien arvotaulukot
+        ja koot, sections osion nimi -> array-taulukko.
+    """
+    n_docs = len(rows)
+    sections = _postings_sections([r["_tf"] for r in rows], _SECTION_PREFIX["plain"])
+
+    terms = sorted({t for r in rows for t in r["_tf"]})
+    known = {stem(t) for t in terms}
+    analysis = {t: analyze_token(t, known.__contains__) for t in terms}
+    fi_tfs = [
+        Counter(term for tok in r["_tokens"] for term in analysis[tok]) for r in rows
+    ]
+    fi_prefix = _SECTION_PREFIX["finnish"]
+    sections.update(_postings_sections(fi_tfs, fi_prefix))
+    fi_vocab = {term: i for i, term in enumerate(sorted({t for tf in fi_tfs for t in tf}))}
+    map_ptr, map_terms = array("I", [0]), array("I")
+    for t in terms:
+        map_terms.extend(fi_vocab[term] for term in analysis[t])
+        map_ptr.append(len(map_terms))
+    sections["fi_map_ptr"], sections["fi_map_terms"] = map_ptr, map_terms
+
+    field_values = {field: sorted({r[field] for r in rows}) for field in ROW_FIELDS}
+    sections["doc_orig"] = array("I", (int(r["id"][4:]) for r in rows))
+    sections["by_length"] = array("I", sorted(range(n_docs), key=lambda i: len(rows[i]["text"])))
+    sections["text_blob"], sections["text_off"] = ops_index.pack_strings([r["text"] for r in rows])
+    for field, values in field_values.items():
+        ids = {v: i for i, v in enumerate(values)}
+        sections[f"field_{field}"] = array("H", (ids[r[field]] for r in rows))
+    header = {
+        "n_docs": n_docs, "n_terms": len(terms), "analyzers": list(ANALYZERS),
+        "field_values": field_values,
+    }
+    return header, sections
+
+def _build_facets(field_values: Dict[str, List[str]]) -> Dict[str, List[str]]:
+    """Rakentaa facetit (aiheet, luokka-asteet, sisältötyypit) kenttien arvoista.
 
     Args:
-        rows: Lista sanakirjoja, jotka edustavat OPS-chunkkeja.
+        field_values: Rivin kenttä -> lajiteltu lista sen uniikeista arvoista.
 
     Returns:
         Sanakirja, jossa avaimina ovat facet-tyypit ja arvoina
         listat uniikeista facet-arvoista.
     """
-    subs, grades, ctypes = set(), set(), set()
-    for r in rows:
-        subs.add((r.get("subject") or "").strip())
-        grades.add((r.get("grade_context") or "").strip())
-        ctypes.add((r.get("content_type") or "").strip())
-    clean = lambda s: sorted([x for x in s if x])
+    return {name: [v for v in field_values[field] if v] for name, field in FACET_FIELDS}
+
+def _build_facet_bits(
+    field_values: Dict[str, List[str]], sections: Dict[str, Sequence[int]]
+) -> Dict[str, Dict[str, int]]:
+    """Rakentaa yhden bittikartan jokaiselle facet-arvolle.
+
+    Bitti i on päällä, jos rivi i kuuluu arvoon. Suodinyhdistelmät
+    lasketaan bittioperaatioilla (OR facetin sisällä, AND facettien välillä).
+
+    Args:
+        field_values: Rivin kenttä -> arvotaulukko.
+        sections: Indeksin taulukot (field_<kenttä> = arvon indeksi riveittäin).
+
+    Returns:
+        Sanakirja facet -> {pienaakkosin kirjoitettu arvo: bittimaski}.
+    """
+    bits: Dict[str, Dict[str, int]] = {}
+    for name, field in FACET_FIELDS:
+        values = field_values[field]
+        per_value = [0] * len(values)
+        for doc_id, value_id in enumerate(sections[f"field_{field}"]):
+            per_value[value_id] |= 1 << doc_id
+        bits[name] = {}
+        for value, mask in zip(values, per_value):
+            key = value.lower()
+            bits[name][key] = bits[name].get(key, 0) | mask
+    return bits
+
+def _build_sparse(postings: _PostingIndex, n_docs: int) -> Optional[Dict[str, Any]]:
+    """Kääri posting-taulukot numpy-näkymiksi vektoroitua pisteytystä varten.
+
+    Posting-listat ovat termi x dokumentti -matriisi CSC-muodossa, joten
+    kyselyn sarakkeet saadaan suoraan viipaleina eikä mitään kopioida;
+    mmap-indeksillä näkymät osoittavat jaettuihin muistisivuihin.
+
+    Args:
+        postings: Posting-listat (_PostingIndex).
+        n_docs: Rivien määrä.
+
+    Returns:
+        Sanakirja numpy-taulukoista ja sanastosta tai None, jos numpy puuttuu.
+    """
+    if not _HAS_SPARSE:
+        return None
     return {
-        "subjects": clean(subs),
-        "grades": clean(grades),
-        "content_types": clean(ctypes),
+        "vocab": postings.vocab,
+        "n_docs": n_docs,
+        "ptr": np.frombuffer(postings.ptr, dtype=np.int32),
+        "doc": np.frombuffer(postings.doc, dtype=np.int32),
+        "tf": np.frombuffer(postings.tf, dtype=np.float64),
+        "bm25": np.frombuffer(postings.bm25, dtype=np.float64),
+        "idf": np.frombuffer(postings.idf, dtype=np.float64),
+        "len": np.frombuffer(postings.doc_len, dtype=np.float64),
+        "all_bits": (1 << n_docs) - 1,
     }
 
+class _OpsState:
+    """Yksi ladattu OPS-indeksi: rivit, facetit ja posting-listat.
+
+    Olio ei muutu latauksen jälkeen (vain finnish-termien muisti täyttyy),
+    joten pyyntö voi käyttää samaa oliota alusta loppuun lukitsematta.
+
+    Attributes:
+        rows: Rivit (_parse_rows-lista tai ops_index.MappedRows).
+        facets: Facet-arvot (get_facets).
+        facet_bits: Facet -> pienaakkosin kirjoitettu arvo -> bittimaski riveistä.
+        all_bits: Kaikkien rivien bittimaski.
+        by_length: Rivien indeksit tekstin pituuden mukaan (tyhjän kyselyn vastaukset).
+        indexes: Analysaattori -> _PostingIndex.
+        postings: "plain"-indeksi.
+        source: "json" tai muistikartoitetun indeksitiedoston polku.
+        signature: Tiedostojen tila lataushetkellä (ks. _signature).
+        subjects: Oppiaine -> (tiiviste, esikäsitellyt rivit); tyhjä mmap-latauksessa.
+        reparsed: Tässä latauksessa tokenisoidut oppiaineet.
+    """
+
+    def __init__(
+        self, header: Dict[str, Any], sections: Dict[str, Sequence], rows: Sequence[Dict],
+        source: str, signature: Tuple,
+        subjects: Optional[Dict[str, Tuple[str, List[Optional[Dict]]]]] = None,
+        reparsed: Optional[List[str]] = None,
+    ):
+        n_docs = header["n_docs"]
+        self.rows = rows
+        self.facets = _build_facets(header["field_values"])
+        self.facet_bits = _build_facet_bits(header["field_values"], sections)
+        self.all_bits = (1 << n_docs) - 1
+        self.by_length = sections["by_length"]
+        self.indexes = {
+            analyzer: _PostingIndex(sections, prefix, n_docs)
+            for analyzer, prefix in _SECTION_PREFIX.items()
+        }
+        self.postings = self.indexes["plain"]
+        # Vartalointitaulu: plain-termin indeksi -> "finnish"-termien indeksit (ptr, termit)
+        self.fi_map = (sections["fi_map_ptr"], sections["fi_map_terms"])
+        self.fi_memo: Dict[str, Tuple[str, ...]] = {}
+        self.source = source
+        self.signature = signature
+        self.subjects = subjects or {}
+        self.reparsed = reparsed or []
+
+    def finnish_terms(self, token: str) -> Tuple[str, ...]:
+        """Palauttaa tokenin "finnish"-termit.
+
+        Sanaston tokenit luetaan indeksin vartalointitaulusta; muut
+        (vain kyselyissä esiintyvät) analysoidaan. Tulos muistetaan
+        (enintään FI_MEMO_SIZE tokenia).
+        """
+        terms = self.fi_memo.get(token)
+        if terms is None:
+            fi = self.indexes["finnish"]
+            i = self.postings.term_id(token)
+            if i is not None:
+                ptr, ids = self.fi_map
+                terms = tuple(fi.term(j) for j in ids[ptr[i]:ptr[i + 1]])
+            else:
+                terms = analyze_token(token, fi.__contains__)
+            if len(self.fi_memo) >= FI_MEMO_SIZE:
+                self.fi_memo.clear()
+            self.fi_memo[token] = terms
+        return terms
+
+def _analyze(text: str, analyzer: str, st: Optional[_OpsState] = None) -> List[str]:
+    """Tokenisoi tekstin valitulla analysaattorilla (ks. ANALYZERS)."""
+    tokens = _tokenize(text)
+    if analyzer == "plain":
+        return tokens
+    st = st or _state()
+    return [term for tok in tokens for term in st.finnish_terms(tok)]
+
+def build_index_file(path: Optional[str] = None) -> Tuple[str, int]:
+    """Rakentaa OPS-datasta binääri-indeksin, jonka workerit voivat muistikartoittaa.
+
+    Tiedosto sidotaan JSONin SHA-1-tiivisteeseen; jos JSON muuttuu,
+    vanhaa indeksiä ei käytetä vaan data ladataan JSONista.
+
+    Args:
+        path: Kohdepolku; oletuksena _index_path().
+
+    Returns:
+        Tuple (polku, tiedoston koko tavuina).
+    """
+    path = path or _index_path()
+    data_path = _json_path()
+    with open(data_path, "rb") as f:
+        payload = f.read()
+    rows = _parse_rows(_load_raw(payload, data_path))
+    header, sections = _build_sections(rows)
+    header["source_sha1"] = hashlib.sha1(payload).hexdigest()
+    return path, ops_index.write_index(path, header, sections)
+
 def _tokenize(text: str) -> List[str]:
     """Tokenisoi tekstin ja muuttaa tokenit pieniksi kirjaimiksi.
 
@@ -66,60 +514,207 @@ def _tokenize(text: str) -> List[str]:
 
     return [t.lower() for t in WORD_RE.findall(text)]
 
-def _load_data(force: bool = False) -> None:
-    """Lataa ja esikäsittelee OPS-datan JSON-tiedostosta.
+def _signature() -> Tuple:
+    """Palauttaa JSONin ja indeksitiedoston tilan (muutoksen tunnistamiseen)."""
+    path = _json_path()
+    st = os.stat(path)
+    try:
+        idx_mtime = os.stat(_index_path()).st_mtime_ns
+    except OSError:
+        idx_mtime = None
+    return (path, st.st_mtime_ns, st.st_size, _index_path(), idx_mtime)
+
+def _load_state(signature: Tuple, previous: Optional[_OpsState] = None) -> _OpsState:
+    """Lataa OPS-datan uuteen _OpsState-olioon.
 
-    Data ladataan vain kerran tai jos tiedostoa on muokattu tai force=True.
+    Jos binääri-indeksi (build_index_file) on olemassa ja vastaa JSONin
+    sisältöä, se muistikartoitetaan: kaikki gunicorn-workerit jakavat samat
+    muistisivut eikä JSONia tarvitse jäsentää. Muuten indeksi rakennetaan
+    JSONista tämän prosessin muistiin; edellisen latauksen muuttumattomien
+    oppiaineiden rivit käytetään uudelleen (ks. _parse_subjects).
 
     Args:
-        force: Pakottaa datan uudelleenlatauksen, vaikka sitä ei olisi muokattu.
+        signature: _signature()-arvo, joka tallennetaan olioon.
+        previous: Edellinen tila, jonka rivejä voi käyttää uudelleen.
+
+    Returns:
+        Uusi _OpsState.
     """
-        
-    global _DATA, _FACETS, _LOADED_PATH, _LOADED_MTIME
-    path = _json_path()
-    st = os.stat(path)
-    if (not force) and _LOADED_PATH == path and _LOADED_MTIME == st.st_mtime and _DATA:
+    data_path = _json_path()
+    with open(data_path, "rb") as f:
+        payload = f.read()
+    index_path = _index_path()
+    idx = ops_index.open_index(index_path)
+    if (
+        idx is not None
+        and idx.header.get("source_sha1") == hashlib.sha1(payload).hexdigest()
+        and idx.header.get("analyzers") == list(ANALYZERS)
+    ):
+        sec = idx.sections
+        fields = {
+            field: (idx.header["field_values"][field], sec[f"field_{field}"]) for field in ROW_FIELDS
+        }
+        rows = ops_index.MappedRows(
+            sec["text_blob"], sec["text_off"], sec["doc_orig"], sec["doc_len"], fields
+        )
+        return _OpsState(idx.header, sec, rows, index_path, signature)
+    rows, subjects, reparsed = _parse_subjects(
+        _load_raw(payload, data_path), previous.subjects if previous is not None else None
+    )
+    header, sections = _build_sections(rows)
+    return _OpsState(header, sections, rows, "json", signature, subjects, reparsed)
+
+def _refresh(force: bool = False) -> bool:
+    """Lataa datan uudelleen, jos tiedostot ovat muuttuneet (tai force=True).
+
+    Uusi indeksi rakennetaan kokonaan ennen kuin se vaihdetaan käyttöön,
+    joten käynnissä olevat haut jatkavat vanhalla oliolla.
+
+    Returns:
+        True, jos data vaihdettiin.
+    """
+    global _STATE
+    with _STATE_LOCK:
+        signature = _signature()
+        if not force and _STATE is not None and _STATE.signature == signature:
+            return False
+        _STATE = _load_state(signature, _STATE)
+        _cached_retrieve.cache_clear()
+        return True
+
+def _reload_interval() -> float:
+    return float(getattr(settings, "OPS_RELOAD_INTERVAL", RELOAD_INTERVAL) or 0)
+
+def _watch(interval: float) -> None:
+    """Taustasäikeen silmukka: tarkistaa tiedostot interval sekunnin välein."""
+    while True:
+        time.sleep(interval)
+        try:
+            _refresh()
+        except Exception as e:
+            print(f"OPS-datan uudelleenlataus epäonnistui: {e}")
+
+def _ensure_watcher() -> None:
+    """Käynnistää tarkkailusäikeen tässä prosessissa (myös forkatuissa workereissa)."""
+    global _WATCHER, _WATCHER_PID
+    if _WATCHER_PID == os.getpid():
         return
+    interval = _reload_interval()
+    with _STATE_LOCK:
+        if _WATCHER_PID == os.getpid():
+            return
+        _WATCHER_PID = os.getpid()
+        if interval > 0:
+            _WATCHER = threading.Thread(
+                target=_watch, args=(interval,), name="ops-reload", daemon=True
+            )
+            _WATCHER.start()
 
-    with open(path, "r", encoding="utf-8") as f:
-        raw = json.load(f)
+def _state() -> _OpsState:
+    """Palauttaa ladatun OPS-datan; lataa sen ensimmäisellä kutsulla.
 
-    norm: List[Dict] = []
-    for i, r in enumerate(raw):
-        txt = (r.get("content") or "").strip()
-        if not txt:
-            continue
-        subj = (r.get("subject") or "").strip()
-        grade = (r.get("grade_context") or "").strip()
-        ctype = (r.get("content_type") or "").strip()
-        src = (r.get("source") or "POPS_2014").strip()
-        tokens = _tokenize(txt)
-        tf = Counter(tokens)
-        norm.append({
-            "id": f"ops-{i}",
-            "text": txt,
-            "subject": subj,
-            "grade_context": grade,
-            "content_type": ctype,
-            "source": src,
-            "_tokens": tokens,
-            "_tf": tf,                  # term frequencies
-            "_len": max(len(tokens), 1) # pituus normaaliin
-        })
-
-    _DATA = norm
-    _FACETS = _build_facets(norm)
-    _LOADED_PATH = path
-    _LOADED_MTIME = st.st_mtime
-
-def get_facets() -> Dict[str, List[str]]:
+    Tuoreuden tarkistus (os.stat) ja uudelleenlataus tapahtuvat
+    taustasäikeessä, eivät pyynnön aikana.
+    """
+    st = _STATE
+    if st is None:
+        _refresh()
+        st = _STATE
+    _ensure_watcher()
+    return st
+
+def _load_data(force: bool = False) -> None:
+    """Lataa OPS-datan, jos sitä ei ole vielä ladattu.
+
+    Args:
+        force: Lataa datan heti uudelleen (esim. indeksin rakentamisen jälkeen)
+            odottamatta taustasäikeen tarkistusta.
+    """
+    if force:
+        _refresh(force=True)
+    else:
+        _state()
+
+def get_facets(
+    query: str = "",
+    subjects: Optional[List[str]] = None,
+    grades: Optional[List[str]] = None,
+    ctypes: Optional[List[str]] = None,
+    analyzer: str = "plain",
+) -> Dict[str, Any]:
     """Palauttaa saatavilla olevat facet-arvot (aiheet, luokka-asteet, sisältötyypit).
 
+    Avaimen "counts" alla on osumamäärä jokaiselle facet-arvolle. Jos kysely
+    tai suodattimia annetaan, määrät lasketaan niiden mukaan: kunkin facetin
+    määriin sovelletaan muiden facettien suodattimia (ei facetin omaa), jotta
+    käyttöliittymä voi näyttää vaihtoehtojen määrät valinnan aikana.
+
+    Args:
+        query: Valinnainen hakukysely, jonka osumat lasketaan.
+        subjects: Valitut aiheet.
+        grades: Valitut luokka-asteet.
+        ctypes: Valitut sisältötyypit.
+        analyzer: Kyselyn analysaattori, "plain" (oletus) tai "finnish".
+
     Returns:
-        Sanakirja, jossa avaimina facet-tyypit ja arvoina listat uniikeista arvoista.
+        Sanakirja, jossa avaimina facet-tyypit ja arvoina listat uniikeista arvoista
+        sekä "counts": facet -> {arvo: osumien määrä}.
+
+    Raises:
+        ValueError: Jos analysaattoria ei tunnisteta.
     """
-    _load_data()
-    return _FACETS
+    if analyzer not in ANALYZERS:
+        raise ValueError(f"Tuntematon analysaattori: {analyzer}")
+    st = _state()
+    selected = {"subjects": subjects, "grades": grades, "content_types": ctypes}
+    masks = {name: _facet_mask(st, name, selected[name]) for name, _ in FACET_FIELDS}
+    if query.strip():
+        base = _query_mask(_analyze(query, analyzer, st), st.indexes[analyzer])
+    else:
+        base = st.all_bits
+
+    counts: Dict[str, Dict[str, int]] = {}
+    for name, _ in FACET_FIELDS:
+        others = base
+        for other, _ in FACET_FIELDS:
+            if other != name:
+                others &= masks[other]
+        counts[name] = {
+            value: (st.facet_bits[name].get(value.lower(), 0) & others).bit_count()
+            for value in st.facets[name]
+        }
+    return {**st.facets, "counts": counts}
+
+def _facet_mask(st: _OpsState, name: str, values: Optional[Iterable[str]]) -> int:
+    """Palauttaa facetin valintojen bittimaskin (valintojen unioni).
+
+    Args:
+        st: Ladattu data.
+        name: Facetin nimi (esim. "subjects").
+        values: Valitut arvot; tyhjä tai None tarkoittaa "kaikki".
+
+    Returns:
+        Bittimaski riveistä, jotka kuuluvat johonkin valituista arvoista.
+    """
+    keys = {v.strip().lower() for v in (values or []) if v}
+    if not keys:
+        return st.all_bits
+    mask = 0
+    for key in keys:
+        mask |= st.facet_bits[name].get(key, 0)
+    return mask
+
+def _query_mask(query_tokens: List[str], postings: Optional[_PostingIndex] = None) -> int:
+    """Palauttaa bittimaskin riveistä, joissa on ainakin yksi kyselytermi."""
+    postings = postings or _state().postings
+    mask = 0
+    ptr, docs = postings.ptr, postings.doc
+    for term in set(query_tokens):
+        i = postings.term_id(term)
+        if i is not None:
+            for doc_id in docs[ptr[i]:ptr[i + 1]]:
+                mask |= 1 << doc_id
+    return mask
 
 def _score(query_tokens: List[str], row: Dict) -> float:
     """Yksinkertainen avainsanapisteytys OPS-chunkille.
@@ -141,9 +736,152 @@ def _score(query_tokens: List[str], row: Dict) -> float:
     hits = sum(tf.get(t, 0) for t in query_tokens)
     if hits == 0:
         return 0.0
-    coverage = len({t for t in query_tokens if tf.get(t, 0) > 0}) / len(set(query_tokens))
-    base = hits / (0.5 + 0.5 * row["_len"])  # kevyt pituuspenalti
-    return base * (1.0 + coverage)           # palkitse kattavuudesta (1–2x)
+    matched = len({t for t in query_tokens if tf.get(t, 0) > 0})
+    return _tf_score(hits, matched, len(set(query_tokens)), row["_len"])
+
+def _tf_score(hits: int, matched: int, n_terms: int, length: int) -> float:
+    """Laskee _score-pisteen valmiiksi kerätyistä osumista.
+
+    Args:
+        hits: Kyselytermien esiintymien summa chunkissa (TF).
+        matched: Kuinka moni uniikki kyselytermi löytyi chunkista.
+        n_terms: Uniikkien kyselytermien määrä.
+        length: Chunkin pituus tokeneina.
+
+    Returns:
+        Chunkin pistemäärä.
+    """
+    coverage = matched / n_terms
+    base = hits / (0.5 + 0.5 * length)  # kevyt pituuspenalti
+    return base * (1.0 + coverage)      # palkitse kattavuudesta (1–2x)
+
+def _accumulate_postings(
+    query_tokens: List[str], postings: Optional[_PostingIndex] = None
+) -> Dict[int, Tuple[int, int]]:
+    """Kerää kyselyn osumat käänteisestä indeksistä.
+
+    Käy läpi vain kyselytermien posting-listat, joten rivejä, joissa
+    ei ole yhtään kyselytermiä, ei kosketa lainkaan.
+
+    Args:
+        query_tokens: Lista tokeneita hakukyselystä (toistot sallittu).
+        postings: Analysaattorin indeksi (oletus: "plain").
+
+    Returns:
+        Sanakirja rivin indeksi -> (hits, matched), jossa hits on
+        kyselytermien esiintymien summa ja matched löytyneiden uniikkien
+        termien määrä.
+    """
+    acc: Dict[int, Tuple[int, int]] = {}
+    postings = postings or _state().postings
+    ptr, docs, tfs = postings.ptr, postings.doc, postings.tf
+    for term, q_count in Counter(query_tokens).items():
+        i = postings.term_id(term)
+        if i is None:
+            continue
+        a, b = ptr[i], ptr[i + 1]
+        for doc_id, tf in zip(docs[a:b], tfs[a:b]):
+            hits, matched = acc.get(doc_id, (0, 0))
+            acc[doc_id] = (hits + q_count * tf, matched + 1)
+    return acc
+
+def _bm25_scores(
+    query_tokens: List[str], postings: Optional[_PostingIndex] = None
+) -> Dict[int, float]:
+    """Laskee BM25-pisteet kyselyn posting-listojen riveille.
+
+    Args:
+        query_tokens: Lista tokeneita hakukyselystä (toistot painottavat termiä).
+        postings: Analysaattorin indeksi (oletus: "plain").
+
+    Returns:
+        Sanakirja rivin indeksi -> BM25-pistemäärä.
+    """
+    acc: Dict[int, float] = {}
+    postings = postings or _state().postings
+    ptr, docs, weights = postings.ptr, postings.doc, postings.bm25
+    for term, q_count in Counter(query_tokens).items():
+        i = postings.term_id(term)
+        if i is None:
+            continue
+        a, b = ptr[i], ptr[i + 1]
+        q_weight = q_count * postings.idf[i]
+        for doc_id, w in zip(docs[a:b], weights[a:b]):
+            acc[doc_id] = acc.get(doc_id, 0.0) + q_weight * w
+    return acc
+
+def _sparse_top_k(
+    query_tokens: List[str], scorer: str, allowed: int, k: int, min_score: float,
+    postings: Optional[_PostingIndex] = None,
+) -> List[Tuple[float, int]]:
+    """Pisteyttää kyselyn numpyllä ja valitsee top-k:n.
+
+    Kyselytermien posting-viipaleet yhdistetään ja summataan riveittäin
+    np.bincountilla (sarakejärjestyksessä, kuten harvan matriisin tulo),
+    joten työ riippuu vain kyselyn posting-listojen pituudesta. Tuottaa
+    samat pisteet kuin _accumulate_postings/_bm25_scores, mutta
+    ilman Python-silmukoita rivien yli. Top-k valitaan argpartitionilla koko
+    lajittelun sijaan; tasapisteissä pienempi rivin indeksi voittaa.
+
+    Args:
+        query_tokens: Lista tokeneita hakukyselystä.
+        scorer: "tf" tai "bm25".
+        allowed: Facet-suodattimien bittimaski.
+        k: Palautettavien rivien maksimimäärä.
+        min_score: Pisteiden on oltava tätä suurempia.
+        postings: Analysaattorin indeksi (oletus: "plain").
+
+    Returns:
+        Lista (pistemäärä, rivin indeksi) laskevassa järjestyksessä.
+    """
+    sp = (postings or _state().postings).sparse
+    q_counts = Counter(query_tokens)
+    vocab = sp["vocab"]
+    known = [(col, c) for col, c in ((vocab.get(t), c) for t, c in q_counts.items()) if col is not None]
+    if not known or k <= 0:
+        return []
+    known.sort()
+    n, ptr = sp["n_docs"], sp["ptr"]
+    spans = [(ptr[col], ptr[col + 1]) for col, _ in known]
+    docs = np.concatenate([sp["doc"][a:b] for a, b in spans])
+
+    if scorer == "bm25":
+        weights = np.concatenate([
+            sp["bm25"][a:b] * (c * sp["idf"][col]) for (a, b), (col, c) in zip(spans, known)
+        ])
+        scores = np.bincount(docs, weights=weights, minlength=n)
+        hit = scores > 0.0
+    else:
+        weights = np.concatenate([sp["tf"][a:b] * float(c) for (a, b), (_, c) in zip(spans, known)])
+        hits = np.bincount(docs, weights=weights, minlength=n)
+        matched = np.bincount(docs, minlength=n)
+        scores = hits / (0.5 + 0.5 * sp["len"]) * (1.0 + matched / len(q_counts))
+        hit = hits > 0.0
+
+    return _sparse_select(scores, hit, _allowed_vector(sp, allowed), k, min_score)
+
+def _allowed_vector(sp: Dict[str, Any], allowed: int) -> Optional["np.ndarray"]:
+    """Muuntaa facet-bittimaskin bool-vektoriksi (None, jos kaikki rivit sallittu)."""
+    if allowed == sp["all_bits"]:
+        return None
+    n = sp["n_docs"]
+    mask_bytes = np.frombuffer(allowed.to_bytes((n + 7) // 8, "little"), dtype=np.uint8)
+    return np.unpackbits(mask_bytes, bitorder="little")[:n].astype(bool)
+
+def _sparse_select(
+    scores: "np.ndarray", hit: "np.ndarray", allowed: Optional["np.ndarray"], k: int, min_score: float,
+) -> List[Tuple[float, int]]:
+    """Valitsee pistevektorista top-k:n (argpartition + tasapisteissä pienempi indeksi)."""
+    valid = hit & (scores > min_score)
+    if allowed is not None:
+        valid &= allowed
+    cand = np.flatnonzero(valid)
+    if cand.size > k:
+        part = np.argpartition(-scores[cand], k - 1)[:k]
+        kth = scores[cand[part]].min()
+        cand = cand[scores[cand] >= kth]  # mukaan myös rajalla olevat tasapisteet
+    order = np.lexsort((cand, -scores[cand]))[:k]
+    return [(float(scores[d]), int(d)) for d in cand[order]]
 
 def retrieve_chunks(
     query: str = "",
@@ -151,52 +889,291 @@ def retrieve_chunks(
     subjects: Optional[List[str]] = None,
     grades: Optional[List[str]] = None,
     ctypes: Optional[List[str]] = None,
-    min_score: float = 0.0
+    min_score: float = 0.0,
+    scorer: str = "tf",
+    engine: str = "auto",
+    cache: bool = True,
+    analyzer: str = "plain",
 ) -> List[Dict]:
     """Palauttaa top-k chunkit ilman RapidFuzzia.
 
     Jos query on tyhjä, palauttaa k lyhyintä riviä valituilla suodattimilla.
+    Tulokset muistetaan LRU-välimuistissa (QUERY_CACHE_SIZE), jonka avaimena
+    on normalisoitu kysely (analysaattorin termit), suodatinjoukot, k,
+    min_score, pisteytys, moottori ja analysaattori. Välimuisti tyhjenee,
+    kun data ladataan uudelleen.
 
     Args:
         query: Hakutermi.
-        k: Palautettavien chunkien maksimimäärä.
+        k: Palautettavien chunkien maksimimäärä (negatiivinen = 0).
         subjects: Lista aiheista, joilla suodattaa.
         grades: Lista luokka-asteista, joilla suodattaa.
         ctypes: Lista sisältötyypeistä, joilla suodattaa.
         min_score: Minimipistemäärä, jolla chunk palautetaan.
+        scorer: Pisteytystapa, "tf" (oletus) tai "bm25".
+        engine: Hakumoottori, "auto" (oletus), "python" tai "sparse".
+        cache: False ohittaa välimuistin (esim. mittauksissa).
+        analyzer: "plain" (oletus) tai "finnish", joka yhdistää taivutusmuodot
+            ja yhdyssanojen osat (luvut / lukujen / murtoluvut).
 
     Returns:
         Lista sanakirjoja, jotka edustavat löydettyjä OPS-chunkkeja
         pisteytyksen tai pituuden mukaan järjestettynä.
+
+    Raises:
+        ValueError: Jos pisteytystapaa, hakumoottoria tai analysaattoria ei
+            tunnisteta, tai "sparse" pyydetään ilman numpya.
     """
-    _load_data()
-    subj_set = {s.strip().lower() for s in (subjects or []) if s}
-    grade_set = {g.strip().lower() for g in (grades or []) if g}
-    type_set = {t.strip().lower() for t in (ctypes or []) if t}
+    _check_options(scorer, engine, analyzer)
+    st = _state()
+    key = (
+        tuple(_analyze(query, analyzer, st)) if query.strip() else None,
+        _facet_key(subjects), _facet_key(grades), _facet_key(ctypes),
+        max(0, int(k)), float(min_score), scorer, engine, analyzer,
+    )
+    if not cache:
+        return _retrieve(st, *key)
+    # Kopiot, jotta kutsujan muutokset eivät päädy välimuistiin
+    return [dict(c) for c in _cached_retrieve(st, *key)]
 
-    rows: List[Dict] = []
-    for r in _DATA:
-        if subj_set and r["subject"].lower() not in subj_set:
-            continue
-        if grade_set and r["grade_context"].lower() not in grade_set:
-            continue
-        if type_set and r["content_type"].lower() not in type_set:
-            continue
-        rows.append(r)
-
-    if not query.strip():
-        rows.sort(key=lambda x: len(x["text"]))
-        rows = rows[:k]
-        return [_public_fields(x, score=None) for x in rows]
-
-    q_tokens = _tokenize(query)
-    scored = []
-    for r in rows:
-        s = _score(q_tokens, r)
-        if s > min_score:
-            scored.append((s, r))
-    scored.sort(key=lambda x: x[0], reverse=True)
-    return [_public_fields(r, score=float(s)) for s, r in scored[:k]]
+def retrieve_chunks_many(
+    queries: Sequence[str],
+    k: int = 8,
+    subjects: Optional[List[str]] = None,
+    grades: Optional[List[str]] = None,
+    ctypes: Optional[List[str]] = None,
+    min_score: float = 0.0,
+    scorer: str = "tf",
+    engine: str = "auto",
+    analyzer: str = "plain",
+) -> List[List[Dict]]:
+    """Hakee monta kyselyä kerralla samoilla suodattimilla.
+
+    Kyselyt analysoidaan ensin, identtiset yhdistetään ja jokaisen
+    kyselytermin posting-lista käydään läpi vain kerran kaikille kyselyille
+    yhteisesti (ks. _batch_top_k). Tulokset ovat samat kuin
+    retrieve_chunks-kutsuilla yksi kerrallaan, mutta välimuistia ei käytetä.
+
+    Args:
+        queries: Hakukyselyt; tyhjä kysely palauttaa lyhyimmät rivit.
+        k: Palautettavien chunkien maksimimäärä kyselyä kohden (negatiivinen = 0).
+        subjects: Lista aiheista, joilla suodattaa.
+        grades: Lista luokka-asteista, joilla suodattaa.
+        ctypes: Lista sisältötyypeistä, joilla suodattaa.
+        min_score: Minimipistemäärä, jolla chunk palautetaan.
+        scorer: Pisteytystapa, "tf" (oletus) tai "bm25".
+        engine: Hakumoottori, "auto" (oletus), "python" tai "sparse".
+        analyzer: "plain" (oletus) tai "finnish".
+
+    Returns:
+        Lista tuloslistoja samassa järjestyksessä kuin queries.
+
+    Raises:
+        ValueError: Kuten retrieve_chunks.
+    """
+    _check_options(scorer, engine, analyzer)
+    st = _state()
+    k = max(0, int(k))
+    facets = (_facet_key(subjects), _facet_key(grades), _facet_key(ctypes))
+    keys = [tuple(_analyze(q, analyzer, st)) if q.strip() else None for q in queries]
+    unique = list(dict.fromkeys(key for key in keys if key is not None))
+    tops = _batch_top_k(
+        st.indexes[analyzer], unique, scorer, engine, _allowed(st, *facets), k, float(min_score)
+    )
+    by_key = dict(zip(unique, tops))
+    rows = st.rows
+    results = []
+    for key in keys:
+        if key is None:
+            results.append(_retrieve(st, None, *facets, k, float(min_score), scorer, engine, analyzer))
+        else:
+            results.append([_public_fields(rows[d], score=s) for s, d in by_key[key]])
+    return results
+
+def _check_options(scorer: str, engine: str, analyzer: str) -> None:
+    """Tarkistaa hakufunktioiden valinnat (ks. retrieve_chunks, Raises)."""
+    if scorer not in SCORERS:
+        raise ValueError(f"Tuntematon pisteytystapa: {scorer}")
+    if engine not in ENGINES:
+        raise ValueError(f"Tuntematon hakumoottori: {engine}")
+    if engine == "sparse" and not _HAS_SPARSE:
+        raise ValueError("Sparse-haku vaatii numpy-kirjaston")
+    if analyzer not in ANALYZERS:
+        raise ValueError(f"Tuntematon analysaattori: {analyzer}")
+
+def _batch_top_k(
+    postings: _PostingIndex, queries: List[Tuple[str, ...]], scorer: str, engine: str,
+    allowed: int, k: int, min_score: float,
+) -> List[List[Tuple[float, int]]]:
+    """Pisteyttää monta kyselyä yhdellä posting-listojen läpikäynnillä.
+
+    Termit kerätään kaikista kyselyistä (termi -> [(kysely, toistot)]) ja
+    käydään läpi termin indeksin mukaisessa järjestyksessä, joten jokainen
+    posting-viipale luetaan kerran. Sparse-moottorilla kaikkien kyselyjen
+    pisteet summataan yhdellä np.bincountilla (rivi kysely * n_docs + rivi).
+
+    Args:
+        postings: Analysaattorin indeksi.
+        queries: Analysoidut kyselyt (ei tyhjiä).
+        scorer: "tf" tai "bm25".
+        engine: Hakumoottori ("auto", "python" tai "sparse").
+        allowed: Facet-suodattimien bittimaski.
+        k: Palautettavien rivien maksimimäärä kyselyä kohden.
+        min_score: Pisteiden on oltava tätä suurempia.
+
+    Returns:
+        Jokaiselle kyselylle lista (pistemäärä, rivin indeksi) laskevassa järjestyksessä.
+    """
+    counts = [Counter(q) for q in queries]
+    by_term: Dict[int, List[Tuple[int, int]]] = {}
+    for qi, q_counts in enumerate(counts):
+        for term, c in q_counts.items():
+            i = postings.term_id(term)
+            if i is not None:
+                by_term.setdefault(i, []).append((qi, c))
+    if not by_term or k <= 0:
+        return [[] for _ in queries]
+    ptr = postings.ptr
+    if engine == "auto" and postings.sparse is not None:
+        n_postings = sum(ptr[i + 1] - ptr[i] for i in by_term)
+        engine = "sparse" if n_postings >= SPARSE_MIN_POSTINGS else "python"
+
+    if engine == "sparse" and postings.sparse is not None:
+        sp = postings.sparse
+        n, n_q = sp["n_docs"], len(queries)
+        doc_parts, weight_parts = [], []
+        for col in sorted(by_term):
+            a, b = ptr[col], ptr[col + 1]
+            docs = sp["doc"][a:b]
+            for qi, c in by_term[col]:
+                doc_parts.append(docs + qi * n)
+                if scorer == "bm25":
+                    weight_parts.append(sp["bm25"][a:b] * (c * sp["idf"][col]))
+                else:
+                    weight_parts.append(sp["tf"][a:b] * float(c))
+        docs = np.concatenate(doc_parts)
+        sums = np.bincount(docs, weights=np.concatenate(weight_parts), minlength=n * n_q).reshape(n_q, n)
+        if scorer == "bm25":
+            scores, hit = sums, sums > 0.0
+        else:
+            matched = np.bincount(docs, minlength=n * n_q).reshape(n_q, n)
+            n_terms = np.array([len(c) for c in counts], dtype=np.float64)[:, None]
+            scores = sums / (0.5 + 0.5 * sp["len"]) * (1.0 + matched / n_terms)
+            hit = sums > 0.0
+        mask = _allowed_vector(sp, allowed)
+        return [_sparse_select(scores[qi], hit[qi], mask, k, min_score) for qi in range(n_q)]
+
+    docs, doc_len = postings.doc, postings.doc_len
+    values = postings.bm25 if scorer == "bm25" else postings.tf
+    accs: List[Dict[int, Any]] = [{} for _ in queries]
+    for col in sorted(by_term):
+        a, b = ptr[col], ptr[col + 1]
+        posting = list(zip(docs[a:b], values[a:b]))
+        for qi, c in by_term[col]:
+            acc = accs[qi]
+            if scorer == "bm25":
+                q_weight = c * postings.idf[col]
+                for doc_id, w in posting:
+                    acc[doc_id] = acc.get(doc_id, 0.0) + q_weight * w
+            else:
+                for doc_id, tf in posting:
+                    hits, matched = acc.get(doc_id, (0, 0))
+                    acc[doc_id] = (hits + c * tf, matched + 1)
+    if scorer == "bm25":
+        return [_top_k(acc.items(), allowed, k, min_score) for acc in accs]
+    return [
+        _top_k(
+            ((doc_id, _tf_score(hits, matched, len(q_counts), doc_len[doc_id]))
+             for doc_id, (hits, matched) in acc.items()),
+            allowed, k, min_score,
+        )
+        for acc, q_counts in zip(accs, counts)
+    ]
+
+def _top_k(candidates: Iterable[Tuple[int, float]], allowed: int, k: int, min_score: float) -> List[Tuple[float, int]]:
+    """Suodattaa (rivi, pisteet) -parit ja palauttaa top-k:n; tasapisteissä rivijärjestys."""
+    scored = [(s, doc_id) for doc_id, s in candidates if (allowed >> doc_id) & 1 and s > min_score]
+    scored.sort(key=lambda x: (-x[0], x[1]))
+    return scored[:k]
+
+def _allowed(st: _OpsState, subjects: FrozenSet[str], grades: FrozenSet[str], ctypes: FrozenSet[str]) -> int:
+    """Yhdistää facet-valintojen bittimaskit."""
+    return (
+        _facet_mask(st, "subjects", subjects)
+        & _facet_mask(st, "grades", grades)
+        & _facet_mask(st, "content_types", ctypes)
+    )
+
+def retrieve_cache_info() -> Dict[str, int]:
+    """Palauttaa hakutulosten välimuistin osumat, ohitukset ja koon."""
+    info = _cached_retrieve.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize, "maxsize": info.maxsize}
+
+def clear_retrieve_cache() -> None:
+    """Tyhjentää hakutulosten välimuistin."""
+    _cached_retrieve.cache_clear()
+
+def _facet_key(values: Optional[Iterable[str]]) -> FrozenSet[str]:
+    """Normalisoi facet-valinnat välimuistin avaimeksi (kuten _facet_mask)."""
+    return frozenset(v.strip().lower() for v in (values or []) if v)
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _cached_retrieve(
+    st: _OpsState, q_tokens: Optional[Tuple[str, ...]],
+    subjects: FrozenSet[str], grades: FrozenSet[str], ctypes: FrozenSet[str],
+    k: int, min_score: float, scorer: str, engine: str, analyzer: str,
+) -> Tuple[Dict, ...]:
+    """_retrieve välimuistilla; data-olio on avaimessa, jotta vanha data ei palaudu."""
+    return tuple(_retrieve(st, q_tokens, subjects, grades, ctypes, k, min_score, scorer, engine, analyzer))
+
+def _retrieve(
+    st: _OpsState, q_tokens: Optional[Tuple[str, ...]],
+    subjects: FrozenSet[str], grades: FrozenSet[str], ctypes: FrozenSet[str],
+    k: int, min_score: float, scorer: str, engine: str, analyzer: str,
+) -> List[Dict]:
+    """Suorittaa haun normalisoiduilla argumenteilla (ks. retrieve_chunks).
+
+    Args:
+        st: Ladattu data (sama olio koko haun ajan).
+        q_tokens: Kyselyn analysoidut termit tai None tyhjälle kyselylle.
+        subjects: Valitut aiheet (pienaakkosin).
+        grades: Valitut luokka-asteet (pienaakkosin).
+        ctypes: Valitut sisältötyypit (pienaakkosin).
+        k: Palautettavien chunkien maksimimäärä.
+        min_score: Minimipistemäärä.
+        scorer: Pisteytystapa.
+        engine: Hakumoottori.
+        analyzer: Analysaattori, jonka indeksistä haetaan.
+
+    Returns:
+        Lista julkisia chunk-sanakirjoja.
+    """
+    allowed = _allowed(st, subjects, grades, ctypes)
+
+    rows = st.rows
+    if q_tokens is None:
+        hits = islice((rows[i] for i in st.by_length if (allowed >> i) & 1), k)
+        return [_public_fields(x, score=None) for x in hits]
+
+    q_tokens = list(q_tokens)
+    postings = st.indexes[analyzer]
+    if engine == "auto" and postings.sparse is not None:
+        n_postings = sum(postings.count(t) for t in set(q_tokens))
+        engine = "sparse" if n_postings >= SPARSE_MIN_POSTINGS else "python"
+    if engine == "sparse" and postings.sparse is not None:
+        top = _sparse_top_k(q_tokens, scorer, allowed, k, min_score, postings)
+        return [_public_fields(rows[d], score=s) for s, d in top]
+
+    if scorer == "bm25":
+        candidates = _bm25_scores(q_tokens, postings).items()
+    else:
+        n_terms = len(set(q_tokens))
+        doc_len = postings.doc_len
+        candidates = (
+            (doc_id, _tf_score(hits, matched, n_terms, doc_len[doc_id]))
+            for doc_id, (hits, matched) in _accumulate_postings(q_tokens, postings).items()
+        )
+    return [_public_fields(rows[d], score=float(s)) for s, d in _top_k(candidates, allowed, k, min_score)]
 
 def _public_fields(row: Dict, score: Optional[float]) -> Dict:
     """Muokkaa OPS-chunkin sanakirjan julkisesti näkyvään muotoon.
@@ -223,9 +1200,76 @@ def _public_fields(row: Dict, score: Optional[float]) -> Dict:
         out["score"] = round(score, 6)
     return out
 
-def format_for_llm(chunks: List[Dict]) -> str:
-    lines = []
-    for i, c in enumerate(chunks, 1):
-        meta = f"{c['subject']} | {c['grade_context']} | {c['content_type']}"
-        lines.append(f"[{i}] ({meta})\n{c['text']}")
-    return "\n\n".join(lines)
+@lru_cache(maxsize=1)
+def _encoding():
+    """Lataa tiktoken-enkoodauksen kerran; None, jos se ei ole saatavilla."""
+    if not _HAS_TIKTOKEN:
+        return None
+    try:
+        return tiktoken.get_encoding(TOKEN_ENCODING)
+    except Exception as e:
+        print(f"tiktoken-enkoodausta {TOKEN_ENCODING} ei voitu ladata, käytetään arviota: {e}")
+        return None
+
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def count_tokens(text: str) -> int:
+    """Laskee tekstin tokenit (tiktoken tai merkkimääräarvio).
+
+    Tulokset muistetaan, koska samat OPS-chunkit päätyvät promptteihin
+    yhä uudelleen.
+
+    Args:
+        text: Laskettava teksti.
+
+    Returns:
+        Tokenien määrä.
+    """
+    enc = _encoding()
+    if enc is not None:
+        return len(enc.encode(text, disallowed_special=()))
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def _chunk_block(i: int, c: Dict) -> str:
+    meta = f"{c['subject']} | {c['grade_context']} | {c['content_type']}"
+    return f"[{i}] ({meta})\n{c['text']}"
+
+def pack_chunks(chunks: List[Dict], max_tokens: Optional[int] = None) -> List[Dict]:
+    """Valitsee chunkit, jotka mahtuvat token-budjettiin kokonaisina.
+
+    Chunkit käydään läpi pistemäärän mukaan (suurin ensin; ilman pisteitä
+    annetussa järjestyksessä). Chunkkia ei koskaan katkaista: jos se ei
+    mahdu, se ohitetaan ja seuraavia (lyhyempiä) kokeillaan.
+
+    Args:
+        chunks: OPS-chunkit (retrieve_chunks tai käyttöliittymän valinta).
+        max_tokens: Kontekstin token-budjetti; None = ei rajaa.
+
+    Returns:
+        Valitut chunkit siinä järjestyksessä, jossa format_for_llm ne numeroi.
+    """
+    ordered = sorted(chunks, key=lambda c: -(c.get("score") or 0.0))
+    if max_tokens is None:
+        return ordered
+    picked: List[Dict] = []
+    used = 0
+    for c in ordered:
+        # Erotin ("\n\n") lasketaan yhdeksi tokeniksi
+        cost = count_tokens(_chunk_block(len(picked) + 1, c)) + (1 if picked else 0)
+        if used + cost <= max_tokens:
+            picked.append(c)
+            used += cost
+    return picked
+
+def format_for_llm(chunks: List[Dict], max_tokens: Optional[int] = None) -> str:
+    """Muotoilee chunkit numeroiduksi kontekstilohkoksi LLM-promptiin.
+
+    Args:
+        chunks: OPS-chunkit.
+        max_tokens: Valinnainen token-budjetti (ks. pack_chunks).
+
+    Returns:
+        Kontekstiteksti; tyhjä, jos yksikään chunk ei mahdu.
+    """
+    if max_tokens is not None:
+        chunks = pack_chunks(chunks, max_tokens)
+    return "\n\n".join(_chunk_block(i, c) for i, c in enumerate(chunks, 1))
@@ -0,0 +1,209 @@
+# TaskuOpe/ops_index.py
+"""OPS-hakuindeksin binääritiedosto: kirjoitus ja muistikartoitettu luku.
+
+Tiedoston rakenne (tavut natiivissa järjestyksessä, tallennetaan otsakkeeseen):
+
+    MAGIC (8 t) | otsakkeen pituus (uint32) | otsake (UTF-8 JSON) | osiot
+
+Jokainen osio on yksi litteä `array`-taulukko (esim. posting-listat,
+normit, facet-tunnisteet), joka alkaa 8 tavun rajalta. Otsake kertoo
+osioiden sijainnin, tyyppikoodin ja pituuden. Lukija kartoittaa tiedoston
+`mmap`illa vain luku -tilassa ja antaa osiot `memoryview`-näkyminä, joten
+gunicorn-workerit jakavat samat muistisivut eikä mitään tarvitse jäsentää.
+"""
+
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections.abc import Sequence
+from typing import Any, Dict, List, Optional, Tuple
+
+MAGIC = b"OPSIDX01"
+VERSION = 1
+_ALIGN = 8
+
+
+def _padding(pos: int) -> int:
+    """Palauttaa täytetavujen määrän seuraavaan _ALIGN-rajaan."""
+    return (-pos) % _ALIGN
+
+
+def write_index(path: str, header: Dict[str, Any], sections: Dict[str, array]) -> int:
+    """Kirjoittaa indeksitiedoston atomisesti.
+
+    Tiedosto kirjoitetaan ensin väliaikaiseen tiedostoon ja vaihdetaan
+    paikalleen `os.replace`lla, joten käynnissä olevien workerien
+    muistikartoitukset (vanha inode) pysyvät ehjinä.
+
+    Args:
+        path: Kohdetiedoston polku.
+        header: Vapaamuotoiset metatiedot (JSON-serialisoituvat).
+        sections: Osion nimi -> litteä array-taulukko.
+
+    Returns:
+        Kirjoitetun tiedoston koko tavuina.
+    """
+    layout: Dict[str, List[Any]] = {}
+    offset = 0
+    for name, arr in sections.items():
+        offset += _padding(offset)
+        layout[name] = [offset, arr.typecode, len(arr)]
+        offset += len(arr) * arr.itemsize
+
+    meta = dict(header, version=VERSION, byteorder=sys.byteorder, sections=layout)
+    head = json.dumps(meta, ensure_ascii=False).encode("utf-8")
+
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(head)))
+        f.write(head)
+        f.write(b"\0" * _padding(f.tell()))
+        data_start = f.tell()
+        for name, arr in sections.items():
+            f.write(b"\0" * _padding(f.tell() - data_start))
+            f.write(arr.tobytes())
+        size = f.tell()
+    os.replace(tmp, path)
+    return size
+
+
+class MappedIndex:
+    """Muistikartoitettu indeksitiedosto.
+
+    Attributes:
+        header: Tiedoston otsake (write_index-funktion header + osiotiedot).
+        sections: Osion nimi -> memoryview (tyyppikoodin mukaan castattu).
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self._mm)
+        if bytes(buf[:8]) != MAGIC:
+            raise ValueError("Tiedosto ei ole OPS-indeksi")
+        (head_len,) = struct.unpack("<I", buf[8:12])
+        self.header = json.loads(bytes(buf[12:12 + head_len]).decode("utf-8"))
+        if self.header.get("version") != VERSION or self.header.get("byteorder") != sys.byteorder:
+            raise ValueError("Indeksin versio tai tavujärjestys ei täsmää")
+        data_start = 12 + head_len
+        data_start += _padding(data_start)
+        self.sections: Dict[str, memoryview] = {}
+        for name, (offset, typecode, count) in self.header["sections"].items():
+            start = data_start + offset
+            nbytes = count * array(typecode).itemsize
+            self.sections[name] = buf[start:start + nbytes].cast(typecode)
+
+
+def open_index(path: str) -> Optional[MappedIndex]:
+    """Avaa indeksitiedoston tai palauttaa None, jos sitä ei ole tai se on viallinen."""
+    try:
+        return MappedIndex(path)
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def pack_strings(values: List[str]) -> Tuple[array, array]:
+    """Pakkaa merkkijonot yhdeksi UTF-8-blobiksi ja offset-taulukoksi.
+
+    Merkkijono i on blob[offsets[i]:offsets[i + 1]].
+    """
+    blob = bytearray()
+    offsets = array("I", [0])
+    for v in values:
+        blob += v.encode("utf-8")
+        offsets.append(len(blob))
+    return array("B", bytes(blob)), offsets
+
+
+class MappedVocab:
+    """Sanasto (termi -> termin indeksi) suoraan muistikartoitetusta blobista.
+
+    Termit on tallennettu järjestyksessä, joten haku on binäärihaku
+    UTF-8-tavuilla (tavujärjestys vastaa merkkijonojen järjestystä).
+    Haetut termit muistetaan prosessikohtaisesti (enintään MEMO_SIZE).
+    """
+
+    MEMO_SIZE = 16384
+
+    def __init__(self, blob: memoryview, offsets: memoryview):
+        self._blob = blob
+        self._off = offsets
+        self._n = len(offsets) - 1
+        self._memo: Dict[str, Optional[int]] = {}
+
+    def _term(self, i: int) -> bytes:
+        return self._blob[self._off[i]:self._off[i + 1]].tobytes()
+
+    def get(self, term: str, default: Optional[int] = None) -> Optional[int]:
+        try:
+            found = self._memo[term]
+        except KeyError:
+            found = self._lookup(term)
+            if len(self._memo) >= self.MEMO_SIZE:
+                self._memo.clear()
+            self._memo[term] = found
+        return default if found is None else found
+
+    def _lookup(self, term: str) -> Optional[int]:
+        key = term.encode("utf-8")
+        lo, hi = 0, self._n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._n and self._term(lo) == key:
+            return lo
+        return None
+
+    def term(self, i: int) -> str:
+        """Palauttaa indeksin i termin."""
+        return self._term(i).decode("utf-8")
+
+    def __contains__(self, term: str) -> bool:
+        return self.get(term) is not None
+
+    def __len__(self) -> int:
+        return self._n
+
+
+class MappedRows(Sequence):
+    """OPS-rivit muistikartoitetusta indeksistä.
+
+    Rivin sanakirja muodostetaan vasta kun riviä pyydetään, joten
+    tekstiä puretaan vain palautettaville chunkeille.
+    """
+
+    def __init__(
+        self, text_blob: memoryview, text_offsets: memoryview, doc_orig: memoryview,
+        doc_len: memoryview, fields: Dict[str, Tuple[List[str], memoryview]],
+    ):
+        self._blob = text_blob
+        self._off = text_offsets
+        self._orig = doc_orig
+        self._len = doc_len
+        self._fields = fields
+
+    def __len__(self) -> int:
+        return len(self._orig)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        row = {
+            "id": f"ops-{self._orig[i]}",
+            "text": self._blob[self._off[i]:self._off[i + 1]].tobytes().decode("utf-8"),
+        }
+        for field, (values, ids) in self._fields.items():
+            row[field] = values[ids[i]]
+        row["_len"] = int(self._len[i])
+        return row
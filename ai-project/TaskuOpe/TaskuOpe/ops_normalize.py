@@ -0,0 +1,119 @@
+# TaskuOpe/ops_normalize.py
+"""Kevyt suomen kielen normalisointi OPS-hakua varten.
+
+Ei täysi morfologinen analyysi, vaan nopea heuristiikka, joka yhdistää
+yleisimmät taivutusmuodot samaan hakutermiin:
+
+- liitepartikkelit ja omistusliitteet pois (-kin, -han, -nsa, ...)
+- sijapäätteet ja monikon tunnukset pois (-ssa, -lla, -jen, -iden, -t, ...)
+- vartalon loppuvokaalit pois ja astevaihtelu yhtenäistetään
+  (luku / luvut / lukujen -> "luk", tavoite / tavoitteet -> "tavoit")
+- yhdyssanat pilkotaan tunnetun sanaston avulla
+  (yhteistyötaitoja -> "yhteistyötait", "yhteist", "tait")
+
+Samaa funktiota käytetään sekä dokumenteille (indeksin rakennusvaiheessa)
+että kyselyille, joten molemmat päätyvät samaan sanastoon.
+"""
+
+from functools import lru_cache
+from typing import Callable, Tuple
+
+# Järjestys: pidemmät ensin, jotta esim. "-ssa" ei jää "-a":ksi
+_CLITICS = ("kaan", "kään", "kin", "han", "hän", "pa", "pä", "ko", "kö")
+_POSSESSIVES = ("nsa", "nsä", "mme", "nne", "ni", "si")
+_CASES = (
+    "iden", "itten", "ihin", "seen", "siin",
+    "ssa", "ssä", "sta", "stä", "lla", "llä", "lta", "ltä", "lle", "ksi", "tta", "ttä",
+    "jen", "ien", "den", "ten", "hin",
+    "na", "nä", "ta", "tä", "ja", "jä",
+    "n", "t", "a", "ä",
+)
+_VOWELS = set("aeiouyäö")
+# Astevaihtelu ja kaksoiskonsonantit vartalon lopussa -> yksi muoto
+_GRADATION = (
+    ("kk", "k"), ("pp", "p"), ("tt", "t"), ("ll", "l"), ("nn", "n"), ("rr", "r"),
+    ("mm", "m"), ("lt", "l"), ("nt", "n"), ("rt", "r"), ("mp", "m"), ("nk", "n"),
+    ("ng", "n"), ("d", "t"), ("v", "k"),
+)
+MIN_STEM = 3
+# Yhdyssanan osien vähimmäispituus (alkuperäisinä merkkeinä ja loppuosan vartalona)
+MIN_PART = 4
+
+
+def _strip_suffix(word: str, suffixes: Tuple[str, ...]) -> str:
+    for suf in suffixes:
+        if word.endswith(suf) and len(word) - len(suf) >= MIN_STEM:
+            return word[: -len(suf)]
+    return word
+
+
+@lru_cache(maxsize=65536)
+def stem(token: str) -> str:
+    """Palauttaa tokenin kevyesti normalisoidun vartalon.
+
+    Args:
+        token: Pieniksi kirjaimiksi muutettu sana.
+
+    Returns:
+        Vartalo; lyhyet sanat ja numerot palautetaan sellaisenaan.
+    """
+    if len(token) <= MIN_STEM or not token.isalpha():
+        return token
+    word = _strip_suffix(token, _CLITICS)
+    word = _strip_suffix(word, _POSSESSIVES)
+    word = _strip_suffix(word, _CASES)
+    # -as/-es/-us-sanat (oppilas, vastaus) ja niiden -kse/-ksi-vartalot
+    if word.endswith("ks") and len(word) - 2 >= MIN_STEM:
+        word = word[:-2]
+    elif word.endswith("s") and len(word) > 5 and word[-2] in _VOWELS:
+        word = word[:-1]
+    # Monikon i/j ja vartalon loppuvokaalit
+    while len(word) > MIN_STEM and (word[-1] in _VOWELS or word[-1] == "j"):
+        word = word[:-1]
+    for src, dst in _GRADATION:
+        if word.endswith(src) and len(word) - len(src) + len(dst) >= MIN_STEM:
+            word = word[: -len(src)] + dst
+            break
+    return word
+
+
+def split_compound(token: str, known: Callable[[str], bool]) -> Tuple[str, ...]:
+    """Pilkkoo yhdyssanan tunnetun sanaston avulla.
+
+    Etsii ensimmäisen (pisimmän loppuosan) jakokohdan, jossa molempien
+    osien vartalot esiintyvät sanastossa itsenäisinä sanoina. Loppuosan
+    vartalon on oltava vähintään MIN_PART merkkiä, jotta lyhyet
+    sattumaosumat ("-att", "-sek") eivät pilko sanoja.
+
+    Args:
+        token: Pieniksi kirjaimiksi muutettu sana.
+        known: Palauttaa True, jos vartalo esiintyy sanastossa itsenäisenä sanana.
+
+    Returns:
+        Tuple (alkuosan vartalo, loppuosan vartalo) tai tyhjä tuple.
+    """
+    if len(token) < 2 * MIN_PART or not token.isalpha():
+        return ()
+    for i in range(MIN_PART, len(token) - MIN_PART + 1):
+        tail = stem(token[i:])
+        if len(tail) < MIN_PART or not known(tail):
+            continue
+        head = stem(token[:i])
+        if len(head) >= MIN_STEM and known(head):
+            return head, tail
+    return ()
+
+
+def analyze_token(token: str, known: Callable[[str], bool]) -> Tuple[str, ...]:
+    """Palauttaa tokenin hakutermit: vartalo ja yhdyssanan osien vartalot.
+
+    Args:
+        token: Pieniksi kirjaimiksi muutettu sana.
+        known: Ks. split_compound.
+
+    Returns:
+        Tuple hakutermejä (vähintään yksi).
+    """
+    whole = stem(token)
+    parts = tuple(p for p in split_compound(token, known) if p != whole)
+    return (whole,) + parts
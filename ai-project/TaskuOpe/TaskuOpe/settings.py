@@ -82,6 +82,8 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'TaskuOpe.wsgi.application'
+# Tuotannossa ajetaan ASGI-tilassa (ks. README: "Running under ASGI")
+ASGI_APPLICATION = 'TaskuOpe.asgi.application'
 
 
 # settings.py
@@ -92,6 +94,14 @@ DATABASES = {
     'default': env.db('DATABASE_URL', default=f'sqlite:///{BASE_DIR / "db.sqlite3"}')
 }
 
+# Djangon cache on kaikkien workerien yhteinen: LLM-välimuistin lukot (single-flight)
+# ja OpenAI-nopeusrajoittimen kiintiöt toimivat vain jaetussa cachessa.
+# Oletuksena tietokantataulu (python manage.py createcachetable); Redis esim.
+# CACHE_URL=rediscache://host:6379/1
+CACHES = {
+    'default': env.cache('CACHE_URL', default='dbcache://django_cache'),
+}
+
 # Lisää SSL-vaatimus VAIN, jos käytössä on PostgreSQL (eli DATABASE_URL löytyi)
 if DATABASES['default']['ENGINE'] == 'django.db.backends.postgresql':
     DATABASES['default']['OPTIONS'] = {'sslmode': 'require'}
@@ -128,6 +138,75 @@ AUTH_USER_MODEL = 'users.CustomUser'
 LOGIN_URL = "kirjaudu"
 LOGIN_REDIRECT_URL = "dashboard" 
 LOGOUT_REDIRECT_URL = "kirjaudu"
+
+
+# OpenAI-asiakas (materials/openai_client.py): aikakatkaisut (s) operaatioittain,
+# uudelleenyritykset 429/5xx-vastauksille ja jaetun yhteyspoolin koko
+OPENAI_TIMEOUTS = {
+    "chat": env.float('OPENAI_CHAT_TIMEOUT', default=60.0),
+    "image": env.float('OPENAI_IMAGE_TIMEOUT', default=120.0),
+    "speech": env.float('OPENAI_SPEECH_TIMEOUT', default=60.0),
+}
+OPENAI_MAX_RETRIES = env.int('OPENAI_MAX_RETRIES', default=3)
+OPENAI_BACKOFF_BASE = env.float('OPENAI_BACKOFF_BASE', default=0.5)
+OPENAI_BACKOFF_MAX = env.float('OPENAI_BACKOFF_MAX', default=20.0)
+OPENAI_POOL_SIZE = env.int('OPENAI_POOL_SIZE', default=20)
+# Async-näkymien (ASGI) yhteyspooli: yksi worker palvelee satoja samanaikaisia pyyntöjä
+OPENAI_ASYNC_POOL_SIZE = env.int('OPENAI_ASYNC_POOL_SIZE', default=100)
+
+# Pelin generoinnin aikaraja (s); sisältö ja metadata generoidaan rinnakkain
+GAME_GENERATION_DEADLINE = env.float('GAME_GENERATION_DEADLINE', default=90.0)
+
+# Tekoälytöiden jono (materials/jobs.py, python manage.py ai_worker)
+AI_JOBS = {
+    "VISIBILITY_TIMEOUT": env.int('AI_JOBS_VISIBILITY_TIMEOUT', default=300),  # lukon kesto (s)
+    "MAX_ATTEMPTS": env.int('AI_JOBS_MAX_ATTEMPTS', default=3),
+    "RETRY_BASE": 10.0,  # uusintayrityksen perusviive (s), kaksinkertaistuu
+    "RETRY_MAX": 600.0,
+    "BATCH_WORKERS": env.int('AI_JOBS_BATCH_WORKERS', default=4),  # koko luokan arvioinnin rinnakkaiset LLM-kutsut
+    "BATCH_MAX_WAIT": env.float('AI_JOBS_BATCH_MAX_WAIT', default=120.0),  # nopeusrajoittimen odotus taustatyössä (s)
+}
+
+# Alkuperäisyystarkistuksen paikallinen esiarvio (materials/plagiarism_prefilter.py):
+# LLM-arvio pyydetään vain, jos jokin tunnusluku ylittää kynnyksensä (0..1)
+PLAGIARISM = {
+    "ESCALATE_SIMILARITY": env.float('PLAGIARISM_ESCALATE_SIMILARITY', default=0.5),  # verrokin samankaltaisuus
+    "ESCALATE_WINNOWING": env.float('PLAGIARISM_ESCALATE_WINNOWING', default=0.3),  # yhteiset sormenjäljet
+    "ESCALATE_STYLE": env.float('PLAGIARISM_ESCALATE_STYLE', default=0.6),  # tyylipoikkeama aiemmista
+}
+
+# LLM-vastausten välimuisti (materials/llm_cache.py): "django", "sqlite" tai "none"
+LLM_CACHE = {
+    "BACKEND": env('LLM_CACHE_BACKEND', default="django"),
+    "ALIAS": "default",
+    "PATH": os.path.join(BASE_DIR, 'llm_cache.sqlite3'),
+    "TTL": env.int('LLM_CACHE_TTL', default=7 * 24 * 3600),
+    "MAX_ENTRIES": env.int('LLM_CACHE_MAX_ENTRIES', default=5000),
+    "LOCK_TIMEOUT": env.int('LLM_CACHE_LOCK_TIMEOUT', default=120),
+}
+
+# OpenAI-kutsujen nopeusrajoitin (materials/rate_limit.py). Tila on Djangon
+# cachessa (CACHES, jaettu kaikkien workerien kesken), joten kiintiö on yhteinen.
+RATE_LIMITS = {
+    "ENABLED": env.bool('RATE_LIMITS_ENABLED', default=True),
+    "ALIAS": "default",
+    "MAX_WAIT": env.float('RATE_LIMIT_MAX_WAIT', default=20.0),  # jonotus ennen 429-vastausta (s)
+    "COMPLETION_TOKENS": 800,  # vastauksen token-arvio TPM-kiintiöön
+    "MODELS": {
+        "gpt-4o": {
+            "RPM": env.int('RATE_LIMIT_CHAT_RPM', default=500),
+            "TPM": env.int('RATE_LIMIT_CHAT_TPM', default=30000),
+            "CONCURRENCY": 20,
+        },
+        "dall-e-3": {"RPM": env.int('RATE_LIMIT_IMAGE_RPM', default=5), "CONCURRENCY": 3},
+        "tts-1": {"RPM": env.int('RATE_LIMIT_TTS_RPM', default=50), "CONCURRENCY": 10},
+    },
+    # Käyttäjäkohtainen kiintiö kaikille malleille yhteensä
+    "USER": {
+        "RPM": env.int('RATE_LIMIT_USER_RPM', default=30),
+        "TPM": env.int('RATE_LIMIT_USER_TPM', default=60000),
+    },
+}
 MEDIA_ROOT = BASE_DIR / 'media'
 MEDIA_URL = '/media/'
 
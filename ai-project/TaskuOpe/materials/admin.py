@@ -3,6 +3,7 @@ from django.contrib import admin
 
 from .models import (
     AIGrade,
+    AIJob,
     Assignment,
     Material,
     MaterialRevision,
@@ -51,7 +52,7 @@ class PlagiarismReportAdmin(admin.ModelAdmin):
     Mahdollistaa hakuja submission id:n, opiskelijan käyttäjänimen
     ja lähteen id:n/käyttäjänimen perusteella.
     """
-    list_display = ("submission", "suspected_source", "score", "created_at")
+    list_display = ("submission", "suspected_source", "score", "method", "created_at")
     search_fields = (
         "submission__id",
         "submission__student__username",
@@ -107,4 +108,16 @@ class AIGradeAdmin(admin.ModelAdmin):
         "rubric__title",
         "submission__student__username",
     )
-    list_filter = ("teacher_confirmed", "model_name", "created_at")
\ No newline at end of file
+    list_filter = ("teacher_confirmed", "model_name", "created_at")
+
+
+@admin.register(AIJob)
+class AIJobAdmin(admin.ModelAdmin):
+    """
+    Määrittää AIJob-mallin (tekoälytyöjono) hallintanäkymän.
+    Näyttää töiden tilan, yritykset ja viimeisimmän virheen.
+    """
+    list_display = ("kind", "status", "submission", "material", "progress", "total", "attempts", "available_at", "locked_by", "created_at")
+    list_filter = ("kind", "status")
+    search_fields = ("idempotency_key", "submission__id", "requested_by__username")
+    readonly_fields = ("created_at", "finished_at")
@@ -1,12 +1,14 @@
 # ai_rubric.py
 
+import hashlib
 import json
 import re
-from typing import Any, Dict, List
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
 from django.utils import timezone
 
-from .ai_service import ask_llm
+from . import openai_client
+from .ai_service import CHAT_MODEL, ask_llm_many, ask_llm_or_raise
 from .models import AIGrade, Material, Rubric, RubricCriterion, Submission
 from TaskuOpe.ops_chunks import format_for_llm, retrieve_chunks
 
@@ -49,11 +51,41 @@ def _ensure_default_rubric(material: Material) -> Rubric:
         )
     return rubric
 
+def _ops_context(material: Material) -> str:
+    """
+    Hakee materiaalin aiheeseen liittyvät OPS-tavoitteet promptin kontekstiksi.
+
+    Args:
+        material (Material): Tehtävään liittyvä materiaali.
+
+    Returns:
+        str: Muotoiltu OPS-konteksti tai tyhjä merkkijono, jos sitä ei löydy.
+    """
+    try:
+        subject, grade_level = material.subject, material.grade_level
+        if subject and grade_level:
+            ops_chunks = retrieve_chunks(
+                query=material.title, subjects=[subject], grades=[grade_level], k=3,
+                scorer="bm25", analyzer="finnish",
+            )
+            if ops_chunks:
+                formatted_ops = format_for_llm(ops_chunks)
+                return f"""
+OPETUSSUUNNITELMAN RELEVANTIT TAVOITTEET/SISÄLLÖT TÄLLE TEHTÄVÄLLE:
+\"\"\"
+{formatted_ops}
+\"\"\"
+"""
+    except Exception as e:
+        print(f"DEBUG (ai_rubric): Could not retrieve OPS chunks: {e}")
+    return ""
+
 # ======================================================================
 # === LOPULLINEN, TARKENNETTU VERSIO PROMPTISTA ===
 # ======================================================================
 def _build_prompt(
-    material: Material, submission: Submission, criteria: List[RubricCriterion]
+    material: Material, submission: Submission, criteria: List[RubricCriterion],
+    ops_context: Optional[str] = None,
 ) -> str:
     """
     Rakentaa tekoälylle tarkoitetun promptin, joka ohjeistaa sitä arvioimaan
@@ -66,29 +98,15 @@ def _build_prompt(
         material (Material): Tehtävään liittyvä materiaali.
         submission (Submission): Oppilaan vastaus.
         criteria (List[RubricCriterion]): Lista rubriikin kriteereistä.
+        ops_context (Optional[str]): Valmiiksi haettu OPS-konteksti
+            (ks. _ops_context); None = haetaan nyt.
 
     Returns:
         str: Valmis prompt-teksti tekoälylle.
     """
     material_excerpt = (material.content or "").strip()[:2000] + "…"
     student_answer = (submission.response or "").strip()
-    ops_context_str = ""
-
-    try:
-        subject, grade_level = material.subject, material.grade_level
-        if subject and grade_level:
-            ops_chunks = retrieve_chunks(query=material.title, subjects=[subject], grades=[grade_level], k=3)
-            if ops_chunks:
-                formatted_ops = format_for_llm(ops_chunks)
-                ops_context_str = f"""
-OPETUSSUUNNITELMAN RELEVANTIT TAVOITTEET/SISÄLLÖT TÄLLE TEHTÄVÄLLE:
-\"\"\"
-{formatted_ops}
-\"\"\"
-"""
-    except Exception as e:
-        print(f"DEBUG (ai_rubric): Could not retrieve OPS chunks: {e}")
-        pass
+    ops_context_str = _ops_context(material) if ops_context is None else ops_context
 
     criterialines = [f'- "{c.name}" (max {c.max_points} p): {c.guidance or ""}'.strip() for c in criteria]
 
@@ -154,27 +172,115 @@ def _extract_json_block(text: str) -> Dict[str, Any]:
             return {}
 
 
-def create_or_update_ai_grade(submission: Submission) -> AIGrade:
+def create_or_update_ai_grade(submission: Submission, *, force: bool = False) -> AIGrade:
     """
     Luo tai päivittää tekoälyn antaman arvosanan (AIGrade) annetulle vastaukselle (Submission).
     Funktio:
     1. Varmistaa, että submissionin materiaalille on olemassa oletusrubriikki.
-    2. Rakentaa promptin tekoälylle rubriikin ja submissionin perusteella.
-    3. Kutsuu tekoälypalvelua (`ask_llm`) ja poimii vastauksesta JSON-muotoisen arvioinnin.
-    4. Käsittelee tekoälyn antamat kriteerikohtaiset pisteet ja palautteen.
-    5. Tallentaa tai päivittää AIGrade-objektin tietokantaan.
+    2. Palauttaa tallennetun arvion sellaisenaan, jos sen sisältötiiviste
+       (vastaus, kriteerit, malli; ks. grading_hash) on ennallaan.
+    3. Rakentaa promptin tekoälylle rubriikin ja submissionin perusteella.
+    4. Kutsuu tekoälypalvelua (`ask_llm_or_raise`) ja poimii vastauksesta JSON-muotoisen arvioinnin.
+    5. Käsittelee tekoälyn antamat kriteerikohtaiset pisteet ja palautteen.
+    6. Tallentaa tai päivittää AIGrade-objektin tietokantaan. Sisältötiiviste
+       tallennetaan vain mallin oikealle, parsittavalle vastaukselle; demo-
+       tai parsimaton vastaus jää muistamatta ja arvioidaan uudelleen.
 
     Args:
         submission (Submission): Oppilaan vastaus, joka arvioidaan.
+        force (bool): Arvioi uudelleen, vaikka arvio olisi ajan tasalla.
 
     Returns:
         AIGrade: Luotu tai päivitetty tekoälyarvosana.
-    """    
+
+    Raises:
+        openai.OpenAIError: Jos LLM-kutsu epäonnistuu (arviota ei tallenneta;
+            työjono yrittää uudelleen).
+        RateLimited: Jos kiintiötä ei saada aikarajassa.
+    """
     material = submission.assignment.material
     rubric = _ensure_default_rubric(material)
     criteria = list(rubric.criteria.order_by("order", "id"))
+    key = grading_hash(submission, rubric, criteria)
+    if not force:
+        ag = AIGrade.objects.filter(submission=submission, content_hash=key).first()
+        if ag is not None:
+            print(f"DEBUG (ai_rubric): Arvio on ajan tasalla, LLM-kutsu ohitetaan ({submission.pk})")
+            return ag
+
     prompt = _build_prompt(material, submission, criteria)
-    llm_text = ask_llm(prompt, user_id=getattr(submission.assignment.assigned_by, "id", 0))
+    llm_text = ask_llm_or_raise(prompt, user_id=getattr(submission.assignment.assigned_by, "id", 0))
+    # Ilman API-avainta vastaus on demoteksti: sitä ei muisteta ajan tasalla olevana
+    return _save_ai_grade(submission, rubric, criteria, llm_text, key if openai_client.api_key() else "")
+
+
+def grading_hash(submission: Submission, rubric: Rubric, criteria: List[RubricCriterion]) -> str:
+    """
+    Laskee arvion sisältötiivisteen: vastaus, kriteeristö (kriteerien nimet,
+    maksimipisteet, ohjeet ja järjestys) ja malli. Jos mikään näistä muuttuu,
+    tallennettu arvio on vanhentunut.
+
+    Args:
+        submission (Submission): Arvioitava palautus.
+        rubric (Rubric): Käytettävä rubriikki.
+        criteria (List[RubricCriterion]): Rubriikin kriteerit.
+
+    Returns:
+        str: SHA-256-tiiviste heksamuodossa.
+    """
+    key = {
+        "response": submission.response or "",
+        "rubric": str(rubric.pk),
+        "criteria": [[c.name, c.max_points, c.guidance, c.order] for c in criteria],
+        "model": CHAT_MODEL,
+    }
+    return hashlib.sha256(json.dumps(key, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def ai_grade_is_current(submission: Submission) -> bool:
+    """
+    Kertoo, vastaako tallennettu AI-arvio palautuksen nykyistä vastausta ja kriteeristöä.
+
+    Args:
+        submission (Submission): Palautus.
+
+    Returns:
+        bool: True, jos arviota ei tarvitse tehdä uudelleen.
+    """
+    ag = AIGrade.objects.filter(submission=submission).exclude(content_hash="").first()
+    rubric = submission.assignment.material.rubrics.first()
+    if ag is None or rubric is None:
+        return False
+    return ag.content_hash == grading_hash(submission, rubric, list(rubric.criteria.order_by("order", "id")))
+
+
+def _save_ai_grade(
+    submission: Submission, rubric: Rubric, criteria: List[RubricCriterion], llm_text: str, content_hash: str = "",
+) -> AIGrade:
+    """
+    Poimii LLM-vastauksesta kriteerikohtaiset pisteet ja tallentaa AIGrade-rivin.
+    Tiiviste jätetään tyhjäksi, jos vastauksesta ei saatu yhtään kriteeriä.
+    """
+    total, details, parsed = _grade_details(rubric, criteria, llm_text)
+    ag, _created = AIGrade.objects.get_or_create(submission=submission)
+    ag.rubric = rubric
+    ag.model_name = CHAT_MODEL
+    ag.total_points = total
+    ag.details = details
+    ag.teacher_confirmed = False
+    ag.content_hash = content_hash if parsed else ""
+    ag.save()
+    return ag
+
+
+def _grade_details(
+    rubric: Rubric, criteria: List[RubricCriterion], llm_text: str,
+) -> Tuple[float, Dict[str, Any], bool]:
+    """
+    Palauttaa (yhteispisteet, details, parsittu) LLM-vastauksesta AIGrade-riviä
+    varten. parsittu on False, jos vastauksesta ei saatu yhtään kriteeriä
+    (kaikki kriteerit 0 pistettä).
+    """
     data = _extract_json_block(llm_text)
     criteria_out = []
     total = 0.0
@@ -195,16 +301,141 @@ def create_or_update_ai_grade(submission: Submission) -> AIGrade:
                 criteria_out.append({"name": matched.name, "points": points, "max": max_p, "feedback": str(item.get("feedback", "")).strip()})
             except Exception:
                 continue
-    if not criteria_out:
+    parsed = bool(criteria_out)
+    if not parsed:
         for c in criteria:
             max_total += int(c.max_points)
             criteria_out.append({"name": c.name, "points": 0, "max": int(c.max_points), "feedback": ""})
     general_feedback = str(data.get("general_feedback", "")).strip() if isinstance(data, dict) else ""
     details = {"criteria": criteria_out, "general_feedback": general_feedback, "rubric_title": rubric.title, "generated_at": timezone.now().isoformat()}
-    ag, _created = AIGrade.objects.get_or_create(submission=submission)
-    ag.rubric = rubric
-    ag.total_points = float(round(total, 2))
-    ag.details = details
-    ag.teacher_confirmed = False
-    ag.save()
-    return ag
\ No newline at end of file
+    return float(round(total, 2)), details, parsed
+
+
+# ---------- Koko luokan arviointi ----------
+
+# Kuinka monta valmista arviota kirjoitetaan kerralla (bulk_create)
+BATCH_WRITE_SIZE = 20
+
+
+class BatchGradingIncomplete(RuntimeError):
+    """Osa koko luokan arvioinnin LLM-kutsuista epäonnistui (ks. grade_submissions_batch)."""
+
+    def __init__(self, saved: int, failed: int):
+        super().__init__(f"{failed} palautuksen arviointi epäonnistui ({saved} tallennettu); yritetään uudelleen.")
+        self.saved = saved
+        self.failed = failed
+
+
+def ungraded_submissions(material: Material):
+    """
+    Palauttaa materiaalin palautukset, joita opettaja ei ole arvioinut ja
+    joille ei ole vielä AI-arviointiehdotusta.
+
+    Args:
+        material (Material): Materiaali.
+
+    Returns:
+        QuerySet[Submission]: Arvioimattomat palautukset.
+    """
+    return (
+        Submission.objects
+        .filter(assignment__material=material, status=Submission.Status.SUBMITTED,
+                graded_at__isnull=True, ai_grade__isnull=True)
+        .select_related("assignment")
+        .order_by("submitted_at", "created_at")
+    )
+
+
+def grade_submissions_batch(
+    material: Material,
+    submissions: Optional[Iterable[Submission]] = None,
+    *,
+    workers: int = 4,
+    max_wait: Optional[float] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> int:
+    """
+    Luo AI-arviointiehdotukset usealle saman materiaalin palautukselle.
+
+    Rubriikki, kriteerit ja OPS-konteksti haetaan kerran koko erälle,
+    LLM-kutsut tehdään rinnakkain rajatulla säiepoolilla (ask_llm_many) ja
+    AIGrade-rivit kirjoitetaan bulk_create-kutsuilla (olemassa olevat
+    päivitetään). Epäonnistuneet kutsut (API-virhe tai nopeusrajoitin)
+    lasketaan erikseen: onnistuneet tallennetaan ensin, minkä jälkeen
+    nostetaan BatchGradingIncomplete, jotta työjono yrittää uudelleen
+    viiveellä. Epäonnistuneet jäävät arvioimattomiksi, joten seuraava ajo
+    jatkaa vain niistä. Demo- tai parsimattomalle vastaukselle ei tallenneta
+    sisältötiivistettä (ks. create_or_update_ai_grade).
+
+    Args:
+        material (Material): Materiaali, jonka palautukset arvioidaan.
+        submissions (Optional[Iterable[Submission]]): Arvioitavat palautukset
+            (oletus: ungraded_submissions(material)).
+        workers (int): Samanaikaisten LLM-kutsujen enimmäismäärä.
+        max_wait (Optional[float]): Nopeusrajoittimen suurin odotus kutsua
+            kohden (ks. ask_llm_many).
+        progress (Optional[Callable[[int, int], None]]): Kutsutaan
+            (tallennetut, yhteensä) alussa, jokaisen valmistuneen kutsun
+            jälkeen ja jokaisen kirjoituksen jälkeen. Luku kattaa vain
+            tietokantaan kirjoitetut arviot, joten keskeytynyt ajo ei näytä
+            tallentamattomia arvioita valmiina.
+
+    Returns:
+        int: Tallennettujen arviointiehdotusten määrä.
+
+    Raises:
+        BatchGradingIncomplete: Jos osa kutsuista epäonnistui (onnistuneet on tallennettu).
+    """
+    subs = list(ungraded_submissions(material) if submissions is None else submissions)
+    if progress:
+        progress(0, len(subs))
+    if not subs:
+        return 0
+
+    rubric = _ensure_default_rubric(material)
+    criteria = list(rubric.criteria.order_by("order", "id"))
+    ops_context = _ops_context(material)
+    prompts = [_build_prompt(material, sub, criteria, ops_context) for sub in subs]
+
+    pending: List[AIGrade] = []
+    real_model = bool(openai_client.api_key())  # muuten ask_llm_many palauttaa demovastauksia
+    saved = 0
+    failed = 0
+
+    def flush() -> None:
+        nonlocal saved
+        if pending:
+            AIGrade.objects.bulk_create(
+                pending, update_conflicts=True, unique_fields=["submission"],
+                update_fields=["rubric", "model_name", "total_points", "details", "teacher_confirmed", "content_hash"],
+            )
+            saved += len(pending)
+            pending.clear()
+            if progress:
+                progress(saved, len(subs))
+
+    def on_result(i: int, llm_text: Optional[str]) -> None:
+        nonlocal failed
+        if llm_text is None:
+            failed += 1
+        else:
+            total, details, parsed = _grade_details(rubric, criteria, llm_text)
+            pending.append(AIGrade(
+                submission=subs[i], rubric=rubric, model_name=CHAT_MODEL,
+                total_points=total, details=details, teacher_confirmed=False,
+                content_hash=grading_hash(subs[i], rubric, criteria) if real_model and parsed else "",
+            ))
+            if len(pending) >= BATCH_WRITE_SIZE:
+                flush()
+                return
+        # Jokainen valmistunut kutsu jatkaa työn lukkoa (ks. jobs._run_batch_grade)
+        if progress:
+            progress(saved, len(subs))
+
+    ask_llm_many(
+        prompts, user_id=material.author_id or 0, workers=workers, max_wait=max_wait, on_result=on_result,
+    )
+    flush()
+    if failed:
+        raise BatchGradingIncomplete(saved, failed)
+    return saved
\ No newline at end of file
@@ -1,10 +1,14 @@
 # materials/ai_service.py
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from openai import OpenAI
 import os, base64
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import httpx
+
+from . import llm_cache, openai_client, rate_limit
 
 #Chunk toiminta kirjastot
-from typing import List, Optional
+from typing import AsyncIterator, Callable, List, Optional, Tuple
 
 SYSTEM_FIN = (
     #Muutin tätä, et sain ops käytön toimii t. Mirka
@@ -16,6 +20,11 @@ SYSTEM_FIN = (
     "Luonnosteksti:\n- <Tähän varsinainen tehtävä tai tehtävät, jotka osoitetaan suoraan oppilaalle. Voit käyttää otsikointia, kuten 'Tehtävä 1:'.>"
 )
 
+CHAT_MODEL = "gpt-4o"  # voit vaihtaa esim. "gpt-4o-mini"
+CHAT_TEMPERATURE = 0.7
+IMAGE_MODEL = "dall-e-3"
+SPEECH_MODEL = "tts-1"
+
 def _demo(prompt: str) -> str:
     """
     Palauttaa demoversion tekoälyvastauksesta, kun API-avainta ei ole saatavilla.
@@ -37,48 +46,291 @@ def _demo(prompt: str) -> str:
         f"Luonnosteksti:\n- {p or 'Kirjoita pyyntö ylle ja lähetä.'}\n"
     )
 
-def ask_llm(prompt: str, *, user_id: int = 0) -> str:
+def _record_prompt(key: str, prompt: str, model: str, user_id: int, hit: bool) -> None:
+    """
+    Kirjaa kehotteen Prompt-malliin: uusi rivi generoinnista, osumalaskuri välimuistista.
+
+    Args:
+        key (str): Välimuistiavain.
+        prompt (str): Käyttäjän kehote.
+        model (str): Mallin tunnus.
+        user_id (int): Opettajan ID (0 = ei kirjausta uudelle riville).
+        hit (bool): Palautettiinko vastaus välimuistista.
+    """
+    from django.db.models import F
+    from django.utils import timezone
+    from .models import Prompt
+
+    try:
+        if hit:
+            pk = Prompt.objects.filter(cache_key=key).order_by("-created_at").values_list("pk", flat=True).first()
+            if pk is not None:
+                Prompt.objects.filter(pk=pk).update(cache_hits=F("cache_hits") + 1, last_hit_at=timezone.now())
+                return
+        if user_id:
+            Prompt.objects.create(
+                text=prompt, model=model, teacher_id=user_id, cache_key=key,
+                cache_hits=1 if hit else 0, last_hit_at=timezone.now() if hit else None,
+            )
+    except Exception as e:
+        print(f"DEBUG (ai_service): Prompt-kirjaus epäonnistui: {e}")
+
+def ask_llm(prompt: str, *, user_id: int = 0, regenerate: bool = False) -> str:
     """
     Kysyy Large Language Modelilta (LLM) vastausta annettuun promptiin.
     Käyttää OpenAI:n API:a. Jos API-avainta ei ole asetettu, palauttaa demovastauksen.
     Sisältää varautumismekanismin, jos LLM ei noudata annettua vastausformaattia.
+    Sama pyyntö palautetaan välimuistista (llm_cache), ellei regenerate=True.
 
     Args:
         prompt (str): Kysymys tai ohjeistus LLM:lle.
         user_id (int): Valinnainen käyttäjän ID, jota voidaan käyttää
                        API-kutsujen seurantaan tai personointiin.
+        regenerate (bool): Ohita välimuisti ja generoi uusi vastaus.
 
     Returns:
         str: LLM:n generoitu vastaus tai demovastaus virheen sattuessa.
     """
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
+    if not openai_client.api_key():
         return _demo(prompt)
 
     try:
-        client = OpenAI(api_key=api_key)
-        resp = client.chat.completions.create(  # virallinen Chat Completions -kutsu
-            model="gpt-4o",               # voit vaihtaa esim. "gpt-4o"
-            messages=[
-                {"role": "system", "content": SYSTEM_FIN},
-                {"role": "user", "content": prompt},
-            ],
-            temperature=0.7,
-        )
-        out = (resp.choices[0].message.content or "").strip()
-        # Varmistus: jos malli ei seurannut formaattia, tee kevyt fallback
-        if "Otsikkoehdotus:" not in out or "Luonnosteksti:" not in out:
-            out = (
-                "Otsikkoehdotus: Luonnos\n"
-                "Tavoitteet:\n1) ...\n2) ...\n3) ...\n\n"
-                f"Luonnosteksti:\n- {out}"
-            )
-        return out
+        out, key, hit = _chat_cached(prompt, regenerate, user_id=user_id)
     except Exception as e:
         # Älä kaada näkymää; palauta demomuoto virheilmoituksella
         return _demo(f"{prompt}\n\n[HUOM: API-virhe: {e}]")
+    _record_prompt(key, prompt, CHAT_MODEL, user_id, hit)
+    return out
+
+def ask_llm_or_raise(prompt: str, *, user_id: int = 0, regenerate: bool = False) -> str:
+    """
+    Kuten ask_llm, mutta epäonnistunut kutsu nostaa virheen demovastauksen
+    sijaan, jotta taustatyö palaa jonoon ja yritetään uudelleen.
+    Ilman API-avainta palauttaa demovastauksen (demotila).
+
+    Args:
+        prompt (str): Kysymys tai ohjeistus LLM:lle.
+        user_id (int): Käyttäjän ID (Prompt-kirjaus ja kiintiö).
+        regenerate (bool): Ohita välimuisti ja generoi uusi vastaus.
+
+    Returns:
+        str: LLM:n vastaus.
 
-def generate_image_bytes(prompt: str, size: str = "1024x1024") -> bytes:
+    Raises:
+        openai.OpenAIError: Jos API-kutsu epäonnistuu.
+        RateLimited: Jos kiintiötä ei saada aikarajassa.
+    """
+    if not openai_client.api_key():
+        return _demo(prompt)
+    out, key, hit = _chat_cached(prompt, regenerate, user_id=user_id)
+    _record_prompt(key, prompt, CHAT_MODEL, user_id, hit)
+    return out
+
+def _chat_cached(
+    prompt: str, regenerate: bool = False, *, user_id: int = 0, max_wait: Optional[float] = None,
+) -> Tuple[str, str, bool]:
+    """
+    Chat-kutsu välimuistin ja nopeusrajoittimen kautta ilman tietokantakirjauksia
+    (turvallinen säikeissä). Välimuistiosuma ei kuluta kiintiötä. max_wait on
+    nopeusrajoittimen suurin odotus (oletus: RATE_LIMITS["MAX_WAIT"]).
+
+    Returns:
+        Tuple[str, str, bool]: (vastaus, välimuistiavain, osuma).
+
+    Raises:
+        openai.OpenAIError: Jos API-kutsu epäonnistuu.
+        RateLimited: Jos kiintiötä ei saada max_wait-ajassa.
+    """
+    key = llm_cache.cache_key(CHAT_MODEL, SYSTEM_FIN, prompt, CHAT_TEMPERATURE)
+
+    def generate() -> str:
+        tokens = rate_limit.estimate_tokens(SYSTEM_FIN, prompt)
+        with rate_limit.limit(CHAT_MODEL, tokens=tokens, user_id=user_id, max_wait=max_wait):
+            resp = openai_client.call("chat", lambda client: client.chat.completions.create(  # virallinen Chat Completions -kutsu
+                model=CHAT_MODEL,
+                messages=_chat_messages(prompt),
+                temperature=CHAT_TEMPERATURE,
+            ))
+        return _format_reply(resp.choices[0].message.content or "")
+
+    out, hit = llm_cache.cached(key, generate, bypass=regenerate)
+    return out, key, hit
+
+def ask_llm_many(
+    prompts: List[str],
+    *,
+    user_id: int = 0,
+    workers: int = 4,
+    max_wait: Optional[float] = None,
+    on_result: Optional[Callable[[int, Optional[str]], None]] = None,
+) -> List[Optional[str]]:
+    """
+    Kysyy LLM:ltä useaan promptiin rinnakkain rajatulla säiepoolilla.
+
+    Säikeet tekevät vain API- ja välimuistikutsut; Prompt-kirjaukset ja
+    on_result-kutsut tehdään kutsuvassa säikeessä sitä mukaa kuin vastauksia
+    valmistuu. Toisin kuin ask_llm, epäonnistunut kutsu (myös RateLimited)
+    palauttaa None (ei demovastausta); kutsujan on käsiteltävä se, esim.
+    yritettävä myöhemmin uudelleen.
+
+    Args:
+        prompts (List[str]): Promptit.
+        user_id (int): Opettajan ID (Prompt-kirjaus).
+        workers (int): Samanaikaisten API-kutsujen enimmäismäärä.
+        max_wait (Optional[float]): Nopeusrajoittimen suurin odotus kutsua kohden
+            (oletus: RATE_LIMITS["MAX_WAIT"]; taustatöille pidempi).
+        on_result (Optional[Callable[[int, Optional[str]], None]]): Kutsutaan
+            (indeksi, vastaus) jokaisen valmistuneen promptin jälkeen.
+
+    Returns:
+        List[Optional[str]]: Vastaukset promptien järjestyksessä (None = virhe).
+    """
+    results: List[Optional[str]] = [None] * len(prompts)
+    if not openai_client.api_key():
+        for i, prompt in enumerate(prompts):
+            results[i] = _demo(prompt)
+            if on_result:
+                on_result(i, results[i])
+        return results
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(_chat_cached, prompt, user_id=user_id, max_wait=max_wait): i for i, prompt in enumerate(prompts)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                out, key, hit = future.result()
+            except Exception as e:
+                print(f"DEBUG (ai_service): LLM-kutsu {i + 1}/{len(prompts)} epäonnistui: {e}")
+            else:
+                results[i] = out
+                _record_prompt(key, prompts[i], CHAT_MODEL, user_id, hit)
+            if on_result:
+                on_result(i, results[i])
+    return results
+
+async def aask_llm(prompt: str, *, user_id: int = 0, regenerate: bool = False) -> str:
+    """
+    Async-versio ask_llm:stä ASGI-näkymille: odottaa vastausta varaamatta workeria.
+    Käyttää samaa välimuistia, muotoilua ja Prompt-kirjausta.
+
+    Args:
+        prompt (str): Kysymys tai ohjeistus LLM:lle.
+        user_id (int): Valinnainen käyttäjän ID (Prompt-kirjaus).
+        regenerate (bool): Ohita välimuisti ja generoi uusi vastaus.
+
+    Returns:
+        str: LLM:n generoitu vastaus tai demovastaus virheen sattuessa.
+    """
+    if not openai_client.api_key():
+        return _demo(prompt)
+
+    key = llm_cache.cache_key(CHAT_MODEL, SYSTEM_FIN, prompt, CHAT_TEMPERATURE)
+
+    async def generate() -> str:
+        async with rate_limit.alimit(CHAT_MODEL, tokens=rate_limit.estimate_tokens(SYSTEM_FIN, prompt), user_id=user_id):
+            resp = await openai_client.acall("chat", lambda client: client.chat.completions.create(
+                model=CHAT_MODEL,
+                messages=_chat_messages(prompt),
+                temperature=CHAT_TEMPERATURE,
+            ))
+        return _format_reply(resp.choices[0].message.content or "")
+
+    try:
+        out, hit = await llm_cache.acached(key, generate, bypass=regenerate)
+    except Exception as e:
+        return _demo(f"{prompt}\n\n[HUOM: API-virhe: {e}]")
+    await sync_to_async(_record_prompt)(key, prompt, CHAT_MODEL, user_id, hit)
+    return out
+
+def _chat_messages(prompt: str) -> list:
+    return [
+        {"role": "system", "content": SYSTEM_FIN},
+        {"role": "user", "content": prompt},
+    ]
+
+def _format_reply(out: str) -> str:
+    """Varmistus: jos malli ei seurannut formaattia, tee kevyt fallback."""
+    out = out.strip()
+    if "Otsikkoehdotus:" not in out or "Luonnosteksti:" not in out:
+        out = (
+            "Otsikkoehdotus: Luonnos\n"
+            "Tavoitteet:\n1) ...\n2) ...\n3) ...\n\n"
+            f"Luonnosteksti:\n- {out}"
+        )
+    return out
+
+async def astream_llm(prompt: str, *, user_id: int = 0, regenerate: bool = False) -> AsyncIterator[Tuple[str, str]]:
+    """
+    Suoratoistaa LLM:n vastauksen sitä mukaa kuin tokeneita saapuu.
+
+    Async-generaattori: ASGI:n alla tokenit välitetään asiakkaalle heti
+    eikä odottaminen varaa workeria. Käyttää samaa välimuistia kuin
+    ask_llm: osuma palautetaan heti yhtenä "done"-tapahtumana, ja
+    suoratoistettu vastaus tallennetaan lopuksi.
+
+    Args:
+        prompt (str): Kysymys tai ohjeistus LLM:lle.
+        user_id (int): Valinnainen käyttäjän ID (Prompt-kirjaus).
+        regenerate (bool): Ohita välimuisti ja generoi uusi vastaus.
+
+    Yields:
+        Tuple[str, str]: (tapahtuma, teksti), jossa tapahtuma on "delta"
+        (uusi tekstinpala), "done" (lopullinen, muotoiltu vastaus) tai
+        "error" (virheilmoitus; suoratoisto päättyy).
+    """
+    if not openai_client.api_key():
+        yield "done", _demo(prompt)
+        return
+
+    key = llm_cache.cache_key(CHAT_MODEL, SYSTEM_FIN, prompt, CHAT_TEMPERATURE)
+    if not regenerate:
+        cached = await sync_to_async(llm_cache.lookup)(key)
+        if cached is not None:
+            await sync_to_async(_record_prompt)(key, prompt, CHAT_MODEL, user_id, True)
+            yield "done", cached
+            return
+
+    parts = []
+    try:
+        async with rate_limit.alimit(CHAT_MODEL, tokens=rate_limit.estimate_tokens(SYSTEM_FIN, prompt), user_id=user_id):
+            stream = await openai_client.acall("chat", lambda client: client.chat.completions.create(
+                model=CHAT_MODEL,
+                messages=_chat_messages(prompt),
+                temperature=CHAT_TEMPERATURE,
+                stream=True,
+            ))
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    yield "delta", delta
+    except Exception as e:
+        yield "error", f"API-virhe: {e}"
+        return
+
+    out = _format_reply("".join(parts))
+    await sync_to_async(llm_cache.store)(key, out)
+    await sync_to_async(_record_prompt)(key, prompt, CHAT_MODEL, user_id, False)
+    yield "done", out
+
+def _demo_image(prompt: str) -> bytes:
+    """Piirtää demokuvan (PNG), kun API-avainta ei ole."""
+    from PIL import Image, ImageDraw, ImageFont
+    import io
+    img = Image.new("RGB", (1024, 1024), (28, 33, 40))
+    d = ImageDraw.Draw(img)
+    try:
+        font = ImageFont.truetype("DejaVuSans.ttf", 28)
+    except Exception:
+        font = ImageFont.load_default()
+    d.multiline_text((40, 40), f"DEMO IMAGE\n{prompt[:120]}", font=font, fill=(230, 230, 230), spacing=6)
+    buf = io.BytesIO(); img.save(buf, "PNG"); return buf.getvalue()
+
+def _check_image_size(size: str) -> None:
+    if size not in {"1024x1024", "1024x1792", "1792x1024"}:
+        raise ValueError("DALL·E 3 tukee vain kokoja: 1024x1024, 1024x1792 ja 1792x1024")
+
+def generate_image_bytes(prompt: str, size: str = "1024x1024", *, user_id: int = 0) -> bytes:
     """
     Generoi kuvan DALL·E 3 -tekoälymallilla ja palauttaa sen PNG-muotoisena
     binaaridatana. Jos OpenAI API -avainta ei ole asetettu, palauttaa demokuvan.
@@ -88,43 +340,33 @@ def generate_image_bytes(prompt: str, size: str = "1024x1024") -> bytes:
         prompt (str): Kuvaus siitä, millainen kuva halutaan generoida.
         size (str): Kuvan koko. DALL·E 3 tukee vain seuraavia arvoja:
                     "1024x1024", "1024x1792" ja "1792x1024".
+        user_id (int): Käyttäjän ID (käyttäjäkohtainen kiintiö).
 
     Returns:
         bytes: Generoitu kuva PNG-binaarimuodossa.
 
     Raises:
         ValueError: Jos annettu koko ei ole tuettu.
+        rate_limit.RateLimited: Jos kiintiö ei riitä aikarajassa.
         RuntimeError: Jos kuvan generoinnissa tapahtuu virhe tai
                       API-vastaus on epäkelpo.
     """
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        # DEMO-kuva
-        from PIL import Image, ImageDraw, ImageFont
-        import io
-        img = Image.new("RGB", (1024, 1024), (28, 33, 40))
-        d = ImageDraw.Draw(img)
-        try:
-            font = ImageFont.truetype("DejaVuSans.ttf", 28)
-        except Exception:
-            font = ImageFont.load_default()
-        d.multiline_text((40, 40), f"DEMO IMAGE\n{prompt[:120]}", font=font, fill=(230, 230, 230), spacing=6)
-        buf = io.BytesIO(); img.save(buf, "PNG"); return buf.getvalue()
+    if not openai_client.api_key():
+        return _demo_image(prompt)
 
     #if size not in {"256x256", "512x512", "1024x1024"}: #DALL·E 3 ei tue 256x256 tai 512x512 kokoja
     #    raise ValueError("DALL·E 2 tukee vain neliötä: 256/512/1024")
 
-    if size not in {"1024x1024", "1024x1792", "1792x1024"}:
-        raise ValueError("DALL·E 3 tukee vain kokoja: 1024x1024, 1024x1792 ja 1792x1024")
+    _check_image_size(size)
 
-    client = OpenAI(api_key=api_key)
     try:
-        resp = client.images.generate(
-            model="dall-e-3",  # Vaihto DALL·E 3:een
-            prompt=prompt,
-            size=size,
-            n=1,
-        )
+        with rate_limit.limit(IMAGE_MODEL, user_id=user_id):
+            resp = openai_client.call("image", lambda client: client.images.generate(
+                model=IMAGE_MODEL,  # Vaihto DALL·E 3:een
+                prompt=prompt,
+                size=size,
+                n=1,
+            ))
         item = resp.data[0]
 
         # 1) Yritä base64
@@ -143,11 +385,13 @@ def generate_image_bytes(prompt: str, size: str = "1024x1024") -> bytes:
         # 3) Ei kumpaakaan → virhe Vaihdettu oikea malli t. Mirka
         raise RuntimeError("DALL·E 3 ei palauttanut b64_json- tai url-kenttää.")
 
+    except rate_limit.RateLimited:
+        raise
     except Exception as e:
         raise RuntimeError(f"DALL·E 3 virhe: {e}") from e
 
 #Puheen generointi OpenAI:n TTS:llä
-def generate_speech(text_to_speak: str) -> bytes | None:
+def generate_speech(text_to_speak: str, *, user_id: int = 0) -> bytes | None:
     """
     Muuntaa annetun tekstin puheeksi käyttäen OpenAI:n TTS-rajapintaa.
     Palauttaa äänidatan (MP3) bitteinä tai None, jos virhe tapahtuu
@@ -155,28 +399,115 @@ def generate_speech(text_to_speak: str) -> bytes | None:
 
     Args:
         text_to_speak (str): Teksti, joka muunnetaan puheeksi.
+        user_id (int): Käyttäjän ID (käyttäjäkohtainen kiintiö).
 
     Returns:
         bytes | None: Äänidata MP3-muodossa tai None virheen sattuessa.
+
+    Raises:
+        rate_limit.RateLimited: Jos kiintiö ei riitä aikarajassa.
     """
-    api_key = os.environ.get("OPENAI_API_KEY") or getattr(settings, "OPENAI_API_KEY", None)
-    if not api_key:
+    if not openai_client.api_key():
         print("Text-to-Speech Error: OPENAI_API_KEY is not set.")
         return None
 
     try:
-        client = OpenAI(api_key=api_key)
-        
-        response = client.audio.speech.create(
-            model="tts-1",       # Voit kokeilla myös mallia "tts-1-hd"
-            voice="fable",       # Voit kokeilla muita ääniä: 'echo', 'fable', 'onyx', 'nova', 'shimmer'
-            input=text_to_speak,
-            speed=0.95           # Säädä puheen nopeutta (0.25 - 4.0)
-        )
+        with rate_limit.limit(SPEECH_MODEL, user_id=user_id):
+            response = openai_client.call("speech", lambda client: client.audio.speech.create(
+                model=SPEECH_MODEL,  # Voit kokeilla myös mallia "tts-1-hd"
+                voice="fable",       # Voit kokeilla muita ääniä: 'echo', 'fable', 'onyx', 'nova', 'shimmer'
+                input=text_to_speak,
+                speed=0.95           # Säädä puheen nopeutta (0.25 - 4.0)
+            ))
         
         # Palautetaan raaka äänidata
         return response.content
 
+    except rate_limit.RateLimited:
+        raise
+    except Exception as e:
+        print(f"An error occurred during TTS generation: {e}")
+        return None
+
+async def agenerate_image_bytes(prompt: str, size: str = "1024x1024", *, user_id: int = 0) -> bytes:
+    """
+    Async-versio generate_image_bytes:stä ASGI-näkymille.
+
+    Args:
+        prompt (str): Kuvaus siitä, millainen kuva halutaan generoida.
+        size (str): "1024x1024", "1024x1792" tai "1792x1024".
+        user_id (int): Käyttäjän ID (käyttäjäkohtainen kiintiö).
+
+    Returns:
+        bytes: Generoitu kuva PNG-binaarimuodossa.
+
+    Raises:
+        ValueError: Jos annettu koko ei ole tuettu.
+        rate_limit.RateLimited: Jos kiintiö ei riitä aikarajassa.
+        RuntimeError: Jos kuvan generoinnissa tapahtuu virhe.
+    """
+    if not openai_client.api_key():
+        return await sync_to_async(_demo_image, thread_sensitive=False)(prompt)
+    _check_image_size(size)
+
+    try:
+        async with rate_limit.alimit(IMAGE_MODEL, user_id=user_id):
+            resp = await openai_client.acall("image", lambda client: client.images.generate(
+                model=IMAGE_MODEL,
+                prompt=prompt,
+                size=size,
+                n=1,
+            ))
+        item = resp.data[0]
+
+        b64 = getattr(item, "b64_json", None)
+        if b64:
+            return base64.b64decode(b64)
+
+        url = getattr(item, "url", None)
+        if url:
+            async with httpx.AsyncClient(timeout=30) as http:
+                r = await http.get(url)
+                r.raise_for_status()
+                return r.content
+
+        raise RuntimeError("DALL·E 3 ei palauttanut b64_json- tai url-kenttää.")
+
+    except rate_limit.RateLimited:
+        raise
+    except Exception as e:
+        raise RuntimeError(f"DALL·E 3 virhe: {e}") from e
+
+async def agenerate_speech(text_to_speak: str, *, user_id: int = 0) -> bytes | None:
+    """
+    Async-versio generate_speech:stä ASGI-näkymille.
+
+    Args:
+        text_to_speak (str): Teksti, joka muunnetaan puheeksi.
+        user_id (int): Käyttäjän ID (käyttäjäkohtainen kiintiö).
+
+    Returns:
+        bytes | None: Äänidata MP3-muodossa tai None virheen sattuessa.
+
+    Raises:
+        rate_limit.RateLimited: Jos kiintiö ei riitä aikarajassa.
+    """
+    if not openai_client.api_key():
+        print("Text-to-Speech Error: OPENAI_API_KEY is not set.")
+        return None
+
+    try:
+        async with rate_limit.alimit(SPEECH_MODEL, user_id=user_id):
+            response = await openai_client.acall("speech", lambda client: client.audio.speech.create(
+                model=SPEECH_MODEL,
+                voice="fable",
+                input=text_to_speak,
+                speed=0.95
+            ))
+        return response.content
+
+    except rate_limit.RateLimited:
+        raise
     except Exception as e:
         print(f"An error occurred during TTS generation: {e}")
         return None
@@ -184,7 +515,7 @@ def generate_speech(text_to_speak: str) -> bytes | None:
 # --- OPS-konteksti LLM:lle ---
 try:
     # Hakee chunkit JSONista
-    from TaskuOpe.ops_chunks import retrieve_chunks, format_for_llm
+    from TaskuOpe.ops_chunks import count_tokens, format_for_llm, pack_chunks, retrieve_chunks
     _HAS_OPS = True
 except Exception:
     _HAS_OPS = False
@@ -222,7 +553,10 @@ def ask_llm_with_ops(
     ctypes: Optional[List[str]] = None,
     k: int = 6,
     user_id: int = 0,
-    max_chars: int = 8000
+    max_prompt_tokens: int = 2500,
+    scorer: str = "tf",
+    analyzer: str = "plain",
+    regenerate: bool = False
 ) -> dict:
     """
     Kysyy Large Language Modelilta (LLM) vastausta, johon on integroitu
@@ -237,37 +571,106 @@ def ask_llm_with_ops(
         ctypes (Optional[List[str]]): Valinnainen lista sisältötyypeistä.
         k (int): Kuinka monta OPS-chunkia haetaan.
         user_id (int): Valinnainen käyttäjän ID API-kutsuille.
-        max_chars (int): Maksimimerkkimäärä promptille,
-                         jonka jälkeen konteksti katkaistaan.
+        max_prompt_tokens (int): Promptin token-budjetti; OPS-chunkeja
+                         lisätään kokonaisina, kunnes budjetti täyttyy.
+        scorer (str): OPS-haun pisteytystapa ("tf" tai "bm25").
+        analyzer (str): OPS-haun analysaattori ("plain" tai "finnish").
+        regenerate (bool): Ohita LLM-vastausten välimuisti.
 
     Returns:
         dict: Sanakirja, joka sisältää LLM:n vastauksen ('answer')
-              ja käytetyt OPS-chunkit ('used_chunks').
+              ja promptiin mahtuneet OPS-chunkit ('used_chunks').
+    """
+    if not _HAS_OPS:
+        return {"answer": ask_llm(question, user_id=user_id, regenerate=regenerate), "used_chunks": []}
+
+    prompt, used = build_ops_prompt(
+        question, ops_query=ops_query, subjects=subjects, grades=grades, ctypes=ctypes,
+        k=k, max_prompt_tokens=max_prompt_tokens, scorer=scorer, analyzer=analyzer,
+    )
+    return {"answer": ask_llm(prompt, user_id=user_id, regenerate=regenerate), "used_chunks": used}
+
+async def aask_llm_with_ops(question: str, *, user_id: int = 0, regenerate: bool = False, **ops) -> dict:
+    """
+    Async-versio ask_llm_with_ops:sta ASGI-näkymille.
+
+    Args:
+        question (str): Käyttäjän kysymys tekoälylle.
+        user_id (int): Valinnainen käyttäjän ID (Prompt-kirjaus).
+        regenerate (bool): Ohita LLM-vastausten välimuisti.
+        **ops: build_ops_prompt-funktion hakuparametrit (subjects, grades, k, ...).
+
+    Returns:
+        dict: Sanakirja, jossa 'answer' ja 'used_chunks'.
     """
     if not _HAS_OPS:
-        return {"answer": ask_llm(question, user_id=user_id), "used_chunks": []}
+        return {"answer": await aask_llm(question, user_id=user_id, regenerate=regenerate), "used_chunks": []}
+
+    # OPS-haku on muistinvarainen, mutta ensimmäinen kutsu lukee datan levyltä
+    prompt, used = await sync_to_async(build_ops_prompt, thread_sensitive=False)(question, **ops)
+    return {"answer": await aask_llm(prompt, user_id=user_id, regenerate=regenerate), "used_chunks": used}
 
+def build_ops_prompt(
+    question: str,
+    *,
+    ops_query: str = "",
+    subjects: Optional[List[str]] = None,
+    grades: Optional[List[str]] = None,
+    ctypes: Optional[List[str]] = None,
+    k: int = 6,
+    max_prompt_tokens: int = 2500,
+    scorer: str = "tf",
+    analyzer: str = "plain"
+):
+    """
+    Hakee OPS-chunkit ja kokoaa niistä promptin (ks. ask_llm_with_ops).
+
+    Käytetään myös suoratoistonäkymässä, joka lähettää promptin astream_llm:lle.
+
+    Returns:
+        Tuple[str, List[dict]]: Prompt ja siihen mahtuneet chunkit; ilman
+        OPS-dataa pelkkä kysymys ja tyhjä lista.
+    """
+    if not _HAS_OPS:
+        return question, []
     chunks = retrieve_chunks(
         query=ops_query or "",
         k=k,
         subjects=subjects or [],
         grades=grades or [],
         ctypes=ctypes or [],
+        scorer=scorer,
+        analyzer=analyzer,
     )
-    context = format_for_llm(chunks)
-    prompt = _build_prompt_with_context(question, context)
+    return _prompt_within_budget(question, chunks, max_prompt_tokens)
 
-    if len(prompt) > max_chars:
-        prompt = prompt[:max_chars] + "\n\n[Katkaistu konteksti]"
+def _prompt_within_budget(question: str, chunks: List[dict], max_prompt_tokens: int):
+    """
+    Kokoaa promptin niin, että se mahtuu token-budjettiin.
+
+    Kysymys ja ohjeet pidetään aina kokonaisina; jäljelle jäävä budjetti
+    täytetään kokonaisilla OPS-chunkeilla pistejärjestyksessä.
+
+    Args:
+        question (str): Käyttäjän kysymys.
+        chunks (List[dict]): Ehdokaschunkit.
+        max_prompt_tokens (int): Koko promptin token-budjetti.
+
+    Returns:
+        Tuple[str, List[dict]]: Prompt ja siihen mahtuneet chunkit.
+    """
+    overhead = count_tokens(_build_prompt_with_context(question, ""))
+    used = pack_chunks(chunks, max(0, max_prompt_tokens - overhead))
+    return _build_prompt_with_context(question, format_for_llm(used)), used
 
-    return {"answer": ask_llm(prompt, user_id=user_id), "used_chunks": chunks}
 
 def ask_llm_with_given_chunks(
     question: str,
     chunks: List[dict],
     *,
     user_id: int = 0,
-    max_chars: int = 8000
+    max_prompt_tokens: int = 2500,
+    regenerate: bool = False
 ) -> dict:
     """
     Kysyy Large Language Modelilta (LLM) vastausta käyttäen ennalta annettuja
@@ -278,22 +681,18 @@ def ask_llm_with_given_chunks(
         question (str): Käyttäjän kysymys tekoälylle.
         chunks (List[dict]): Lista OPS-chunkeista, jotka annetaan kontekstina.
         user_id (int): Valinnainen käyttäjän ID API-kutsuille.
-        max_chars (int): Maksimimerkkimäärä promptille,
-                         jonka jälkeen konteksti katkaistaan.
+        max_prompt_tokens (int): Promptin token-budjetti; OPS-chunkeja
+                         lisätään kokonaisina, kunnes budjetti täyttyy.
+        regenerate (bool): Ohita LLM-vastausten välimuisti.
 
     Returns:
         dict: Sanakirja, joka sisältää LLM:n vastauksen ('answer')
-              ja käytetyt OPS-chunkit ('used_chunks').
+              ja promptiin mahtuneet OPS-chunkit ('used_chunks').
     """
     if not chunks:
-        return {"answer": ask_llm(question, user_id=user_id), "used_chunks": []}
-
-    context = format_for_llm(chunks)
-    prompt = _build_prompt_with_context(question, context)
-
-    if len(prompt) > max_chars:
-        prompt = prompt[:max_chars] + "\n\n[Katkaistu konteksti]"
+        return {"answer": ask_llm(question, user_id=user_id, regenerate=regenerate), "used_chunks": []}
 
-    return {"answer": ask_llm(prompt, user_id=user_id), "used_chunks": chunks}
+    prompt, used = _prompt_within_budget(question, chunks, max_prompt_tokens)
+    return {"answer": ask_llm(prompt, user_id=user_id, regenerate=regenerate), "used_chunks": used}
 
 
@@ -0,0 +1,215 @@
+# materials/class_similarity.py
+"""
+Koko luokan palautusten pareittainen samankaltaisuus ("kuka kopioi keneltä").
+
+Palautuskohtainen tarkistus (materials.plagiarism) vertaa yhtä palautusta
+kerrallaan, joten koko luokan läpikäynti olisi n erillistä hakua. Tässä
+materiaalin palautukset vektorisoidaan kerran (TF-IDF, 1–3-grammit kuten
+materials.tfidf_index; termit tiivistetään HashingVectorizerilla, mikä on
+sanaston rakentamista usean kertaa nopeampaa), kaikkien parien
+kosinisamankaltaisuus lasketaan yhdellä harvalla matriisitulolla ja lähes
+identtiset vastaukset ryhmitellään yhtenäisiksi komponenteiksi
+(samankaltaisuus >= NEAR_DUPLICATE_SIM). Ryhmän varhaisin palautus on todennäköisin lähde.
+
+Tulokset tallennetaan palautuksittain PlagiarismReport-riveille
+bulk-kirjoituksina (paikallisina esiarvioina; palautuskohtaisen tarkistuksen
+raportteja ei korvata) ja lämpökarttana ClassSimilarity-riville
+palautussivua varten.
+"""
+
+import html
+import time
+from typing import Dict, List
+
+import numpy as np
+from django.db import transaction
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+
+from .models import ClassSimilarity, Material, PlagiarismReport, Submission
+
+# Tätä samankaltaisemmat vastaukset ovat lähes identtisiä (sama ryhmä)
+NEAR_DUPLICATE_SIM = 0.8
+# Tätä pienemmät parit jätetään matriisista ja lämpökartasta pois
+HEATMAP_MIN_SIM = 0.3
+# Tiivistettyjen termien sarakkeita; törmäykset ovat tällä koolla merkityksettömiä
+N_FEATURES = 2 ** 20
+
+
+def _latest_submissions(material: Material) -> List[Submission]:
+    """Oppilaiden viimeisimmät palautetut vastaukset palautusjärjestyksessä."""
+    latest: Dict[object, Submission] = {}
+    qs = (
+        Submission.objects.filter(assignment__material=material, status=Submission.Status.SUBMITTED)
+        .exclude(response="")
+        .select_related("student")
+        .order_by("created_at")
+    )
+    for sub in qs:
+        latest[sub.assignment_id] = sub
+    return sorted(latest.values(), key=lambda s: s.submitted_at or s.created_at)
+
+
+def similarity_matrix(texts: List[str]) -> csr_matrix:
+    """
+    Laskee vastausten pareittaisen kosinisamankaltaisuuden.
+
+    Args:
+        texts (List[str]): Vastaukset.
+
+    Returns:
+        csr_matrix: Symmetrinen n x n -matriisi ilman diagonaalia; alle
+        HEATMAP_MIN_SIM:n arvot on poistettu.
+    """
+    if not texts:
+        return csr_matrix((0, 0), dtype=np.float32)
+    counts = HashingVectorizer(
+        strip_accents="unicode", lowercase=True, ngram_range=(1, 3),
+        alternate_sign=False, norm=None, n_features=N_FEATURES, dtype=np.float32,
+    ).transform(texts)
+    X = TfidfTransformer().fit_transform(counts)  # smooth_idf + l2-normitus: tulo on kosini
+    S = (X @ X.T).tocsr()
+    S.setdiag(0)
+    S.data[S.data < HEATMAP_MIN_SIM] = 0
+    S.eliminate_zeros()
+    return S
+
+
+def near_duplicate_clusters(S: csr_matrix) -> List[List[int]]:
+    """
+    Ryhmittelee lähes identtiset vastaukset.
+
+    Args:
+        S (csr_matrix): similarity_matrix-funktion tulos.
+
+    Returns:
+        List[List[int]]: Vähintään kahden vastauksen ryhmät rivi-indekseinä,
+        kukin nousevassa järjestyksessä (varhaisin ensin).
+    """
+    A = S.copy()
+    A.data = (A.data >= NEAR_DUPLICATE_SIM).astype(np.int8)
+    A.eliminate_zeros()
+    _n, labels = connected_components(A, directed=False)
+    groups: Dict[int, List[int]] = {}
+    for i, label in enumerate(labels):
+        groups.setdefault(int(label), []).append(i)
+    return sorted((g for g in groups.values() if len(g) > 1), key=lambda g: g[0])
+
+
+def _report_html(sub: Submission, best: Submission, sim: float, source: Submission, size: int) -> str:
+    parts = ["<div><strong>Koko luokan vertailu:</strong> "]
+    if best is None:
+        parts.append("ei samankaltaisia palautuksia.</div>")
+    else:
+        parts.append(f"samankaltaisin palautus {html.escape(best.student.username)} ({sim:.2f}).</div>")
+    if size:
+        parts.append(f"<div><small>Lähes identtisten vastausten ryhmässä {size} palautusta; ")
+        if source is not None:
+            parts.append(f"aiemmin palautettu lähde: {html.escape(source.student.username)}.")
+        else:
+            parts.append("tämä palautus on ryhmän ensimmäinen.")
+        parts.append("</small></div>")
+    parts.append('<hr><div style="white-space:pre-wrap;">')
+    parts.append((sub.response or "").strip())
+    parts.append("</div>")
+    return "".join(parts)
+
+
+def analyze_material(material: Material) -> ClassSimilarity:
+    """
+    Vertaa materiaalin kaikkia palautuksia keskenään ja tallentaa tulokset.
+
+    Palautus, jolla ei ole raporttia, saa paikallisen PlagiarismReportin:
+    riski on suurin samankaltaisuus muihin ja epäilty lähde on samankaltaisin
+    aiemmin palautettu lähes identtinen vastaus. Aiemman vertailun raportit
+    päivitetään; palautuskohtaisen tarkistuksen raportteja (esiarvio tai
+    tekoälyarvio) ei muuteta. Raportit luetaan lukittuina ja kirjoitetaan
+    samassa transaktiossa, joten samanaikaisesti tallennettu raportti säilyy.
+
+    Vertailun raporttien content_hash on tyhjä: ne eivät ole koskaan ajan
+    tasalla materials.plagiarism.build_or_update_reportin kannalta, joten
+    palautuskohtainen tarkistus korvaa ne aina.
+
+    Args:
+        material (Material): Materiaali, jonka palautukset vertaillaan.
+
+    Returns:
+        ClassSimilarity: Päivitetty vertailu (heatmap: labels, cells [i, j, sim],
+        clusters, threshold).
+    """
+    t0 = time.perf_counter()
+    subs = _latest_submissions(material)
+    S = similarity_matrix([s.response for s in subs])
+    clusters = near_duplicate_clusters(S)
+    cluster_of = {i: k for k, members in enumerate(clusters) for i in members}
+    elapsed = (time.perf_counter() - t0) * 1000
+
+    reports = []
+    for i, sub in enumerate(subs):
+        row = S.getrow(i)
+        best, best_sim, source, source_sim = None, 0.0, None, 0.0
+        for j, sim in zip(row.indices, row.data):
+            sim = float(sim)
+            if sim > best_sim:
+                best, best_sim = subs[j], sim
+            if j < i and sim >= NEAR_DUPLICATE_SIM and sim > source_sim:
+                source, source_sim = subs[j], sim
+        cluster = cluster_of.get(i)
+        size = len(clusters[cluster]) if cluster is not None else 0
+        reports.append(PlagiarismReport(
+            submission=sub,
+            suspected_source=source,
+            score=round(min(1.0, best_sim), 4),
+            highlights=_report_html(sub, best, best_sim, source, size),
+            method=PlagiarismReport.Method.LOCAL,
+            content_hash="",
+            notes={"class_similarity": {
+                "max_similarity": best_sim,
+                "most_similar_id": str(best.pk) if best else None,
+                "cluster": cluster,
+                "cluster_size": size,
+            }},
+        ))
+
+    # Lämpökartta: ryhmät peräkkäin, jotta ne näkyvät kartassa lohkoina
+    order = [i for members in clusters for i in members]
+    order += [i for i in range(len(subs)) if i not in cluster_of]
+    position = {i: p for p, i in enumerate(order)}
+    coo = S.tocoo()
+    cells = sorted(
+        [position[i], position[j], round(float(v), 3)]
+        for i, j, v in zip(coo.row, coo.col, coo.data) if position[i] < position[j]
+    )
+    heatmap = {
+        "labels": [
+            {"submission_id": str(subs[i].pk), "student": subs[i].student.get_full_name() or subs[i].student.username}
+            for i in order
+        ],
+        "cells": cells,
+        "clusters": [[position[i] for i in members] for members in clusters],
+        "threshold": NEAR_DUPLICATE_SIM,
+        "min_similarity": HEATMAP_MIN_SIM,
+        "elapsed_ms": round(elapsed, 1),
+    }
+
+    with transaction.atomic():
+        existing = {
+            r.submission_id: r
+            for r in PlagiarismReport.objects.select_for_update().filter(submission__in=subs).only("pk", "submission", "notes")
+        }
+        new, refresh = [], []
+        for report in reports:
+            current = existing.get(report.submission_id)
+            if current is None:
+                new.append(report)
+            elif "class_similarity" in (current.notes or {}):
+                report.pk = current.pk
+                refresh.append(report)
+        PlagiarismReport.objects.bulk_update(
+            refresh, ["suspected_source", "score", "highlights", "method", "notes", "content_hash"],
+        )
+        # Rivi, joka ilmestyi lukituksen jälkeen, on palautuskohtaisen tarkistuksen: se säilyy
+        PlagiarismReport.objects.bulk_create(new, ignore_conflicts=True)
+        result, _ = ClassSimilarity.objects.update_or_create(material=material, defaults={"heatmap": heatmap})
+    return result
@@ -0,0 +1,283 @@
+# materials/jobs.py
+"""
+Tietokantapohjainen työjono hitaille tekoälytoiminnoille (AIJob).
+
+Näkymät eivät enää odota OpenAI-vastausta (eivätkä pidä tietokanta-
+transaktiota auki sen ajan), vaan lisäävät työn jonoon ja arviointisivu
+kyselee sen tilaa. Worker-komento (python manage.py ai_worker) ottaa
+työt käsittelyyn:
+
+- Idempotenssi: samalle palautukselle ja työtyypille on kerrallaan vain
+  yksi keskeneräinen työ; uusi pyyntö palauttaa olemassa olevan.
+- Visibility timeout: käsittelyyn otettu työ lukitaan VISIBILITY_TIMEOUT
+  sekunniksi. Jos worker kaatuu, työ palaa jonoon lukon vanhennuttua.
+- Uudelleenyritykset: epäonnistunut työ palaa jonoon kasvavalla viiveellä,
+  kunnes max_attempts täyttyy (tila FAILED).
+
+Koko luokan arviointi (BATCH_GRADE) kohdistuu materiaaliin: työ kirjaa
+edistymisen (progress/total) ja jatkaa samalla lukkoaan jokaisen valmistuneen
+palautuksen jälkeen. Jos osa kutsuista epäonnistuu (API-virhe tai
+nopeusrajoitin), työ palaa jonoon kuten muutkin epäonnistuneet työt, ja uusi
+yritys arvioi vain vielä arvioimattomat palautukset. Taustatyö saa odottaa
+nopeusrajoitinta pidempään (BATCH_MAX_WAIT) kuin interaktiiviset pyynnöt.
+
+Palautuskohtaiset työt eivät kutsu mallia uudelleen, jos tallennetun tuloksen
+sisältötiiviste on ennallaan (vastaus, verrokit/kriteerit, malli), ellei
+opettaja pakota uutta ajoa (AIJob.force).
+
+Asetukset (settings.AI_JOBS): VISIBILITY_TIMEOUT, MAX_ATTEMPTS,
+RETRY_BASE, RETRY_MAX, BATCH_WORKERS, BATCH_MAX_WAIT.
+"""
+
+import os
+import random
+import socket
+import time
+import uuid
+from datetime import timedelta
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .ai_rubric import create_or_update_ai_grade, grade_submissions_batch
+from .models import AIJob, Material, Submission
+from .plagiarism import build_or_update_report
+
+VISIBILITY_TIMEOUT = 300
+MAX_ATTEMPTS = 3
+RETRY_BASE = 10.0
+RETRY_MAX = 600.0
+# Koko luokan arvioinnin samanaikaiset LLM-kutsut
+BATCH_WORKERS = 4
+# Koko luokan arvioinnin suurin odotus nopeusrajoittimessa kutsua kohden (s);
+# oltava selvästi alle VISIBILITY_TIMEOUTin, jota edistyminen jatkaa
+BATCH_MAX_WAIT = 120.0
+# Kuinka monta valmista työtä claim kokeilee, jos toinen worker ehtii ensin
+CLAIM_BATCH = 10
+
+ACTIVE = (AIJob.Status.QUEUED, AIJob.Status.RUNNING)
+
+def _conf(name: str, default):
+    return (getattr(settings, "AI_JOBS", None) or {}).get(name, default)
+
+
+def _run_batch_grade(job: AIJob) -> None:
+    """Arvioi materiaalin arvioimattomat palautukset ja kirjaa edistymisen työhön."""
+    owned = AIJob.objects.filter(pk=job.pk, locked_by=job.locked_by)
+
+    def progress(done: int, total: int) -> None:
+        # Edistyvä työ ei saa vanhentua kesken: jatka lukkoa samalla
+        owned.update(
+            progress=done, total=total,
+            locked_until=timezone.now() + timedelta(seconds=_conf("VISIBILITY_TIMEOUT", VISIBILITY_TIMEOUT)),
+        )
+
+    grade_submissions_batch(
+        job.material,
+        workers=_conf("BATCH_WORKERS", BATCH_WORKERS),
+        max_wait=_conf("BATCH_MAX_WAIT", BATCH_MAX_WAIT),
+        progress=progress,
+    )
+
+
+HANDLERS: Dict[str, Callable[[AIJob], None]] = {
+    AIJob.Kind.AI_GRADE: lambda job: create_or_update_ai_grade(job.submission, force=job.force),
+    AIJob.Kind.PLAGIARISM: lambda job: build_or_update_report(job.submission, force=job.force),
+    AIJob.Kind.PLAGIARISM_LLM: lambda job: build_or_update_report(job.submission, force_llm=True, force=job.force),
+    AIJob.Kind.BATCH_GRADE: _run_batch_grade,
+}
+
+
+def idempotency_key(kind: str, submission: Optional[Submission] = None, material: Optional[Material] = None) -> str:
+    """Palauttaa työn idempotenssiavaimen (tyyppi ja palautus tai materiaali)."""
+    if submission is None:
+        return f"{kind}:material:{material.pk}"
+    return f"{kind}:{submission.pk}"
+
+
+def enqueue(
+    kind: str,
+    submission: Optional[Submission] = None,
+    *,
+    material: Optional[Material] = None,
+    requested_by=None,
+    force: bool = False,
+) -> Tuple[AIJob, bool]:
+    """
+    Lisää työn jonoon, ellei samalla avaimella ole jo keskeneräistä työtä.
+
+    Args:
+        kind (str): AIJob.Kind-arvo.
+        submission (Optional[Submission]): Käsiteltävä palautus.
+        material (Optional[Material]): Käsiteltävä materiaali
+            (materiaalikohtaiset työt, esim. BATCH_GRADE).
+        requested_by: Pyytänyt käyttäjä (valinnainen).
+        force (bool): Laske tulos uudelleen, vaikka tallennettu tulos olisi
+            ajan tasalla (sisältötiiviste ennallaan).
+
+    Returns:
+        Tuple[AIJob, bool]: Työ ja tieto, luotiinko se nyt (False =
+        olemassa oleva keskeneräinen työ).
+    """
+    key = idempotency_key(kind, submission, material)
+    active = AIJob.objects.filter(idempotency_key=key, status__in=ACTIVE).first()
+    if active is not None:
+        return active, False
+    try:
+        with transaction.atomic():
+            job = AIJob.objects.create(
+                kind=kind, submission=submission, material=material, idempotency_key=key, requested_by=requested_by,
+                force=force, max_attempts=_conf("MAX_ATTEMPTS", MAX_ATTEMPTS),
+            )
+        return job, True
+    except IntegrityError:
+        # Rinnakkainen pyyntö ehti lisätä saman työn
+        active = AIJob.objects.filter(idempotency_key=key, status__in=ACTIVE).first()
+        if active is None:
+            raise
+        return active, False
+
+
+def latest_jobs(submission: Optional[Submission] = None, material: Optional[Material] = None) -> Dict[str, AIJob]:
+    """Palauttaa palautuksen tai materiaalin uusimman työn kustakin tyypistä (tyyppi -> AIJob)."""
+    qs = AIJob.objects.filter(submission=submission) if submission is not None else AIJob.objects.filter(material=material)
+    jobs = {}
+    for job in qs.order_by("created_at"):
+        jobs[job.kind] = job
+    return jobs
+
+
+def retry_delay(attempt: int) -> float:
+    """Odotusaika (s) ennen uutta yritystä: eksponentiaalinen, satunnaistettu, rajattu."""
+    base = _conf("RETRY_BASE", RETRY_BASE)
+    cap = _conf("RETRY_MAX", RETRY_MAX)
+    return min(cap, base * (2 ** max(0, attempt - 1))) * random.uniform(0.5, 1.0)
+
+
+def claim(worker: str, kinds: Optional[Iterable[str]] = None) -> Optional[AIJob]:
+    """
+    Ottaa seuraavan suoritettavan työn käsittelyyn.
+
+    Suoritettavia ovat jonossa olevat työt, joiden available_at on ohitettu,
+    sekä käsittelyssä olevat työt, joiden lukko on vanhentunut (worker
+    kaatui). Lukitus tehdään ehdollisella UPDATE:lla, joten sama työ ei voi
+    päätyä kahdelle workerille (toimii myös SQLitellä).
+
+    Args:
+        worker (str): Workerin tunniste.
+        kinds (Optional[Iterable[str]]): Rajaa työtyyppeihin.
+
+    Returns:
+        Optional[AIJob]: Lukittu työ tai None, jos suoritettavaa ei ole.
+    """
+    now = timezone.now()
+    ready = (
+        Q(status=AIJob.Status.QUEUED, available_at__lte=now)
+        | Q(status=AIJob.Status.RUNNING, locked_until__lt=now)
+    )
+    qs = AIJob.objects.filter(ready)
+    if kinds:
+        qs = qs.filter(kind__in=list(kinds))
+    for job in qs.order_by("available_at")[:CLAIM_BATCH]:
+        current = AIJob.objects.filter(pk=job.pk, status=job.status, attempts=job.attempts, locked_by=job.locked_by)
+        if job.status == AIJob.Status.RUNNING and job.attempts >= job.max_attempts:
+            # Viimeinenkin yritys jäi kesken (worker kaatui tai työ kesti liian kauan)
+            current.update(
+                status=AIJob.Status.FAILED, finished_at=now, locked_until=None,
+                last_error="Käsittely keskeytyi (visibility timeout).",
+            )
+            continue
+        token = f"{worker}:{uuid.uuid4().hex[:8]}"
+        locked = current.update(
+            status=AIJob.Status.RUNNING, attempts=F("attempts") + 1, locked_by=token,
+            locked_until=now + timedelta(seconds=_conf("VISIBILITY_TIMEOUT", VISIBILITY_TIMEOUT)),
+        )
+        if locked:
+            job.refresh_from_db()
+            return job
+    return None
+
+
+def run_job(job: AIJob) -> bool:
+    """
+    Suorittaa lukitun työn ja kirjaa lopputuloksen.
+
+    Tila päivitetään vain, jos työ on yhä tämän workerin lukossa (muuten
+    lukko vanheni ja toinen worker on ottanut työn).
+
+    Args:
+        job (AIJob): claim-funktion palauttama työ.
+
+    Returns:
+        bool: True, jos työ onnistui.
+    """
+    owned = AIJob.objects.filter(pk=job.pk, locked_by=job.locked_by, status=AIJob.Status.RUNNING)
+    try:
+        HANDLERS[job.kind](job)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        print(f"AI-työ {job.pk} ({job.kind}) epäonnistui, yritys {job.attempts}/{job.max_attempts}: {error}")
+        if job.attempts < job.max_attempts:
+            updated = owned.update(
+                status=AIJob.Status.QUEUED, locked_until=None, last_error=error,
+                available_at=timezone.now() + timedelta(seconds=retry_delay(job.attempts)),
+            )
+        else:
+            updated = owned.update(
+                status=AIJob.Status.FAILED, locked_until=None, last_error=error, finished_at=timezone.now(),
+            )
+        ok = False
+    else:
+        updated = owned.update(
+            status=AIJob.Status.DONE, locked_until=None, last_error="", finished_at=timezone.now(),
+        )
+        ok = True
+    if not updated:
+        print(f"AI-työ {job.pk}: lukko vanheni ennen valmistumista; tulosta ei kirjattu tilaan.")
+    return ok
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def work(
+    worker: Optional[str] = None,
+    *,
+    kinds: Optional[Iterable[str]] = None,
+    once: bool = False,
+    poll: float = 1.0,
+    max_jobs: Optional[int] = None,
+) -> int:
+    """
+    Workerin pääsilmukka: ottaa töitä käsittelyyn ja suorittaa ne yksi kerrallaan.
+
+    Args:
+        worker (Optional[str]): Workerin tunniste (oletus: kone ja pid).
+        kinds (Optional[Iterable[str]]): Rajaa työtyyppeihin.
+        once (bool): Käsittele jonossa olevat työt ja palaa, kun jono on tyhjä.
+        poll (float): Odotus (s) tyhjän jonon tarkistusten välillä.
+        max_jobs (Optional[int]): Lopeta, kun näin monta työtä on käsitelty.
+
+    Returns:
+        int: Käsiteltyjen töiden määrä.
+    """
+    worker = worker or default_worker_id()
+    processed = 0
+    while max_jobs is None or processed < max_jobs:
+        # Pitkäikäinen prosessi: sulje vanhentuneet tietokantayhteydet
+        # (ei transaktion sisällä, esim. testeissä)
+        if not connection.in_atomic_block:
+            close_old_connections()
+        job = claim(worker, kinds)
+        if job is None:
+            if once:
+                break
+            time.sleep(poll)
+            continue
+        run_job(job)
+        processed += 1
+    return processed
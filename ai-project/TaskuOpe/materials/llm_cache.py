@@ -0,0 +1,440 @@
+# materials/llm_cache.py
+"""
+Sisältöosoitteinen välimuisti LLM-vastauksille.
+
+Avain on SHA-256 (malli, järjestelmäkehote, käyttäjän kehote, lämpötila ja
+muut pyynnön parametrit), joten sama pyyntö palautuu välimuistista
+millisekunneissa eikä maksa mitään. Tausta valitaan asetuksella
+settings.LLM_CACHE:
+
+    LLM_CACHE = {
+        "BACKEND": "django",      # "django" (Djangon cache), "sqlite" tai "none"
+        "ALIAS": "default",       # Djangon cache-alias ("django")
+        "PATH": "llm_cache.sqlite3",  # tiedosto ("sqlite")
+        "TTL": 7 * 24 * 3600,     # vanhenemisaika sekunteina
+        "MAX_ENTRIES": 5000,      # "sqlite": vanhimmat (LRU) poistetaan yli menevältä osalta
+        "LOCK_TIMEOUT": 120,      # kuinka kauan muut workerit odottavat käynnissä olevaa kutsua
+    }
+
+Django-taustalla koko rajataan cache-taustan omalla MAX_ENTRIES-asetuksella.
+"Generoi uudelleen" -toiminnot ohittavat välimuistin (bypass=True) ja
+korvaavat tallennetun vastauksen uudella.
+
+Samanaikaiset identtiset pyynnöt yhdistetään (single-flight): prosessin
+sisällä säikeet odottavat samaa kutsua, ja workerien välillä taustaan
+otetaan lukko (cache.add / SQLite-rivi), jonka haltija tekee kutsun ja muut
+lukevat valmiin vastauksen välimuistista. Async-näkymät käyttävät samaa
+logiikkaa acached-funktion kautta (odotus ei varaa workeria).
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_MAX_ENTRIES = 5000
+DEFAULT_LOCK_TIMEOUT = 120
+# Kuinka usein (s) toisen workerin lukkoa odottava tarkistaa tilanteen
+POLL_INTERVAL = 0.2
+KEY_PREFIX = "llm:"
+LOCK_PREFIX = "llm-lock:"
+
+_BACKEND = None
+_BACKEND_CONF: Optional[str] = None
+_LOCK = threading.Lock()
+# Prosessin sisäiset käynnissä olevat kutsut: avain -> _Flight
+_INFLIGHT: Dict[str, "_Flight"] = {}
+_INFLIGHT_LOCK = threading.Lock()
+# Async-kutsut: (tapahtumasilmukan id, avain) -> asyncio.Future
+_AINFLIGHT: Dict[Tuple[int, str], "asyncio.Future"] = {}
+
+
+def cache_key(model: str, system: str, prompt: str, temperature: Optional[float], **extra: Any) -> str:
+    """
+    Laskee pyynnön sisältöosoitteisen avaimen.
+
+    Args:
+        model (str): Mallin tunnus.
+        system (str): Järjestelmäkehote ("" jos ei käytössä).
+        prompt (str): Käyttäjän kehote.
+        temperature (Optional[float]): Lämpötila (None = mallin oletus).
+        **extra: Muut vastaukseen vaikuttavat parametrit (esim. response_format).
+
+    Returns:
+        str: 64-merkkinen heksadesimaalitiiviste.
+    """
+    payload = json.dumps(
+        {"model": model, "system": system, "prompt": prompt, "temperature": temperature, **extra},
+        sort_keys=True, ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class DjangoCacheBackend:
+    """Tallentaa vastaukset Djangon cache-taustaan (esim. LocMem, Redis, tietokanta)."""
+
+    def __init__(self, alias: str = "default", ttl: int = DEFAULT_TTL):
+        self.cache = caches[alias]
+        self.ttl = ttl
+
+    def get(self, key: str) -> Any:
+        return self.cache.get(KEY_PREFIX + key)
+
+    def set(self, key: str, value: Any) -> None:
+        self.cache.set(KEY_PREFIX + key, value, timeout=self.ttl)
+
+    def delete(self, key: str) -> None:
+        self.cache.delete(KEY_PREFIX + key)
+
+    def acquire(self, key: str, token: str, timeout: int) -> bool:
+        # cache.add on atominen (Redis, Memcached, tietokanta; ks. settings.CACHES); LocMem vain prosessin sisällä
+        return self.cache.add(LOCK_PREFIX + key, token, timeout=timeout)
+
+    def locked(self, key: str) -> bool:
+        return self.cache.get(LOCK_PREFIX + key) is not None
+
+    def release(self, key: str, token: str) -> None:
+        if self.cache.get(LOCK_PREFIX + key) == token:
+            self.cache.delete(LOCK_PREFIX + key)
+
+
+class SQLiteBackend:
+    """
+    Tallentaa vastaukset paikalliseen SQLite-tiedostoon.
+
+    Tiedosto on saman palvelimen kaikkien workerien yhteinen. Vanhentuneet
+    rivit poistetaan kirjoitusten yhteydessä, ja jos rivejä on yli
+    max_entries, vähiten äskettäin käytetyt poistetaan.
+    """
+
+    def __init__(self, path: str, ttl: int = DEFAULT_TTL, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed_at)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_locks (key TEXT PRIMARY KEY, token TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def _conn(self) -> sqlite3.Connection:
+        # Yhteys säie- ja prosessikohtaisesti (sqlite-yhteyttä ei saa jakaa forkin yli)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key: str) -> Any:
+        conn = self._conn()
+        now = time.time()
+        row = conn.execute("SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] <= now:
+            with conn:
+                conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            return None
+        with conn:
+            conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any) -> None:
+        conn = self._conn()
+        now = time.time()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now + self.ttl, now),
+            )
+            conn.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (now,))
+            (count,) = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+            if count > self.max_entries:
+                conn.execute(
+                    "DELETE FROM llm_cache WHERE key IN "
+                    "(SELECT key FROM llm_cache ORDER BY accessed_at LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+
+    def delete(self, key: str) -> None:
+        with self._conn() as conn:
+            conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+
+    def acquire(self, key: str, token: str, timeout: int) -> bool:
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute("DELETE FROM llm_locks WHERE key = ? AND expires_at <= ?", (key, now))
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO llm_locks (key, token, expires_at) VALUES (?, ?, ?)",
+                (key, token, now + timeout),
+            )
+            return cur.rowcount == 1
+
+    def locked(self, key: str) -> bool:
+        row = self._conn().execute(
+            "SELECT 1 FROM llm_locks WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return row is not None
+
+    def release(self, key: str, token: str) -> None:
+        with self._conn() as conn:
+            conn.execute("DELETE FROM llm_locks WHERE key = ? AND token = ?", (key, token))
+
+
+def get_backend():
+    """
+    Palauttaa asetusten mukaisen välimuistitaustan (None, jos pois käytöstä).
+
+    Tausta luodaan uudelleen vain, jos settings.LLM_CACHE muuttuu.
+    """
+    global _BACKEND, _BACKEND_CONF
+    conf: Dict[str, Any] = getattr(settings, "LLM_CACHE", None) or {}
+    conf_key = json.dumps(conf, sort_keys=True, default=str)
+    with _LOCK:
+        if _BACKEND_CONF != conf_key:
+            kind = conf.get("BACKEND", "django")
+            ttl = int(conf.get("TTL", DEFAULT_TTL))
+            if kind == "sqlite":
+                path = str(conf.get("PATH") or os.path.join(settings.BASE_DIR, "llm_cache.sqlite3"))
+                _BACKEND = SQLiteBackend(path, ttl, int(conf.get("MAX_ENTRIES", DEFAULT_MAX_ENTRIES)))
+            elif kind == "django":
+                _BACKEND = DjangoCacheBackend(conf.get("ALIAS", "default"), ttl)
+            else:
+                _BACKEND = None
+            _BACKEND_CONF = conf_key
+        return _BACKEND
+
+
+class _Flight:
+    """Prosessin sisällä käynnissä oleva kutsu, jota muut säikeet odottavat."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value: Any = None
+        self.error: Optional[BaseException] = None
+
+
+def _safe_get(backend, key: str) -> Any:
+    try:
+        return backend.get(key)
+    except Exception as e:
+        print(f"LLM-välimuistin luku epäonnistui: {e}")
+        return None
+
+
+def lookup(key: str) -> Any:
+    """Palauttaa tallennetun vastauksen tai None (myös, jos välimuisti on pois käytöstä)."""
+    backend = get_backend()
+    return _safe_get(backend, key) if backend is not None else None
+
+
+def store(key: str, value: Any) -> None:
+    """Tallentaa vastauksen (esim. suoratoiston päätteeksi); virheet vain kirjataan."""
+    backend = get_backend()
+    if backend is None:
+        return
+    try:
+        backend.set(key, value)
+    except Exception as e:
+        print(f"LLM-välimuistiin kirjoitus epäonnistui: {e}")
+
+
+def _lock_timeout() -> int:
+    conf = getattr(settings, "LLM_CACHE", None) or {}
+    return int(conf.get("LOCK_TIMEOUT", DEFAULT_LOCK_TIMEOUT))
+
+
+def cached(key: str, fn: Callable[[], Any], *, bypass: bool = False) -> Tuple[Any, bool]:
+    """
+    Palauttaa välimuistissa olevan vastauksen tai laskee ja tallentaa sen.
+
+    Vain onnistuneet vastaukset tallennetaan: jos fn nostaa poikkeuksen,
+    se välitetään kutsujalle eikä mitään tallenneta. Välimuistin omat
+    virheet eivät kaada kutsua (vastaus lasketaan silloin aina).
+
+    Jos sama avain on jo laskettavana tässä prosessissa, kutsu odottaa sitä
+    ja jakaa sen tuloksen (myös virheen); ohitus (bypass) ei aloita toista
+    rinnakkaista kutsua. Muiden workerien kanssa koordinoidaan _compute-funktiossa.
+
+    Args:
+        key (str): cache_key-funktion avain.
+        fn (Callable[[], Any]): Laskee vastauksen (JSON-serialisoituva).
+        bypass (bool): True ohittaa haun ("generoi uudelleen") ja korvaa tallennetun arvon.
+
+    Returns:
+        Tuple[Any, bool]: Vastaus ja tieto, saatiinko se ilman omaa kutsua
+        (välimuisti tai toisen pyynnön jaettu tulos).
+    """
+    backend = get_backend()
+    if backend is not None and not bypass:
+        value = _safe_get(backend, key)
+        if value is not None:
+            return value, True
+
+    with _INFLIGHT_LOCK:
+        flight = _INFLIGHT.get(key)
+        leader = flight is None
+        if leader:
+            flight = _INFLIGHT[key] = _Flight()
+    if not leader:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.value, True
+
+    try:
+        flight.value, hit = _compute(backend, key, fn, bypass)
+        return flight.value, hit
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with _INFLIGHT_LOCK:
+            _INFLIGHT.pop(key, None)
+        flight.done.set()
+
+
+def _compute(backend, key: str, fn: Callable[[], Any], bypass: bool) -> Tuple[Any, bool]:
+    """
+    Laskee vastauksen workerien välisen lukon alla.
+
+    Lukon saanut worker kutsuu fn:ää ja tallentaa tuloksen; muut odottavat
+    lukon vapautumista (enintään LOCK_TIMEOUT) ja lukevat tuloksen
+    välimuistista. Jos sitä ei löydy (kutsu epäonnistui tai lukko vanheni),
+    ne laskevat vastauksen itse.
+    """
+    if backend is None:
+        return fn(), False
+    timeout = _lock_timeout()
+    token = f"{os.getpid()}-{threading.get_ident()}-{time.time()}"
+    try:
+        acquired = backend.acquire(key, token, timeout)
+    except Exception as e:
+        print(f"LLM-välimuistin lukitus epäonnistui: {e}")
+        acquired = False
+    else:
+        if not acquired:
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline and backend.locked(key):
+                time.sleep(POLL_INTERVAL)
+            value = _safe_get(backend, key)
+            if value is not None:
+                return value, True
+        elif not bypass:
+            # Toinen worker ehti ehkä valmiiksi hakumme ja lukituksemme välissä
+            value = _safe_get(backend, key)
+            if value is not None:
+                backend.release(key, token)
+                return value, True
+    try:
+        value = fn()
+        try:
+            backend.set(key, value)
+        except Exception as e:
+            print(f"LLM-välimuistiin kirjoitus epäonnistui: {e}")
+        return value, False
+    finally:
+        if acquired:
+            backend.release(key, token)
+
+
+async def acached(key: str, fn: Callable[[], Awaitable[Any]], *, bypass: bool = False) -> Tuple[Any, bool]:
+    """
+    Async-versio cached-funktiosta (ASGI-näkymät).
+
+    Samat säännöt kuin cached-funktiossa: saman tapahtumasilmukan
+    identtiset kutsut odottavat yhtä laskentaa, ja workerien välillä
+    koordinoidaan taustan lukolla. Taustan kutsut ajetaan sync_to_asyncilla.
+
+    Args:
+        key (str): cache_key-funktion avain.
+        fn (Callable[[], Awaitable[Any]]): Laskee vastauksen (JSON-serialisoituva).
+        bypass (bool): True ohittaa haun ja korvaa tallennetun arvon.
+
+    Returns:
+        Tuple[Any, bool]: Vastaus ja tieto, saatiinko se ilman omaa kutsua.
+    """
+    backend = await sync_to_async(get_backend)()
+    if backend is not None and not bypass:
+        value = await sync_to_async(_safe_get)(backend, key)
+        if value is not None:
+            return value, True
+
+    loop = asyncio.get_running_loop()
+    flight_key = (id(loop), key)
+    flight = _AINFLIGHT.get(flight_key)
+    if flight is not None:
+        try:
+            # shield: odottajan peruutus ei peru muiden jakamaa kutsua
+            return await asyncio.shield(flight), True
+        except asyncio.CancelledError:
+            if not flight.cancelled():
+                raise
+            # Laskeva pyyntö peruttiin (esim. asiakas katkaisi yhteyden); lasketaan itse
+            return await acached(key, fn, bypass=bypass)
+
+    flight = _AINFLIGHT[flight_key] = loop.create_future()
+    try:
+        value, hit = await _acompute(backend, key, fn, bypass)
+        flight.set_result(value)
+        return value, hit
+    except asyncio.CancelledError:
+        flight.cancel()
+        raise
+    except BaseException as e:
+        flight.set_exception(e)
+        flight.exception()  # merkitään käsitellyksi, vaikka odottajia ei olisi
+        raise
+    finally:
+        _AINFLIGHT.pop(flight_key, None)
+
+
+async def _acompute(backend, key: str, fn: Callable[[], Awaitable[Any]], bypass: bool) -> Tuple[Any, bool]:
+    """Async-versio _compute-funktiosta (workerien välinen lukko)."""
+    if backend is None:
+        return await fn(), False
+    timeout = _lock_timeout()
+    token = f"{os.getpid()}-{id(asyncio.current_task())}-{time.time()}"
+    try:
+        acquired = await sync_to_async(backend.acquire)(key, token, timeout)
+    except Exception as e:
+        print(f"LLM-välimuistin lukitus epäonnistui: {e}")
+        acquired = False
+    else:
+        if not acquired:
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline and await sync_to_async(backend.locked)(key):
+                await asyncio.sleep(POLL_INTERVAL)
+            value = await sync_to_async(_safe_get)(backend, key)
+            if value is not None:
+                return value, True
+        elif not bypass:
+            value = await sync_to_async(_safe_get)(backend, key)
+            if value is not None:
+                await sync_to_async(backend.release)(key, token)
+                return value, True
+    try:
+        value = await fn()
+        try:
+            await sync_to_async(backend.set)(key, value)
+        except Exception as e:
+            print(f"LLM-välimuistiin kirjoitus epäonnistui: {e}")
+        return value, False
+    finally:
+        if acquired:
+            await sync_to_async(backend.release)(key, token)
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+
+from materials import jobs
+from materials.models import AIJob
+
+
+class Command(BaseCommand):
+    """
+    Suorittaa tekoälytyöjonon (AIJob) töitä: AI-arviointiehdotukset ja
+    alkuperäisyysraportit.
+
+    Workereita voi ajaa useita rinnakkain (myös eri koneilla); sama työ ei
+    päädy kahdelle workerille. Kaatuneen workerin työt palaavat jonoon
+    lukon (settings.AI_JOBS["VISIBILITY_TIMEOUT"]) vanhennuttua.
+
+    Käyttö: python manage.py ai_worker [--once] [--kind AI_GRADE]
+    """
+    help = "Suorittaa tekoälytyöjonon töitä (AI-arviointi, alkuperäisyysraportti)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Käsittele jonossa olevat työt ja lopeta.")
+        parser.add_argument(
+            "--kind", action="append", choices=AIJob.Kind.values,
+            help="Käsittele vain tätä työtyyppiä (voi toistaa).",
+        )
+        parser.add_argument("--poll", type=float, default=1.0, help="Tyhjän jonon tarkistusväli (s).")
+        parser.add_argument("--max-jobs", type=int, default=None, help="Lopeta näin monen työn jälkeen.")
+        parser.add_argument("--worker-id", default=None, help="Workerin tunniste (oletus: kone-pid).")
+
+    def handle(self, *args, **opts):
+        worker = opts["worker_id"] or jobs.default_worker_id()
+        self.stdout.write(f"AI-worker {worker} käynnissä (työtyypit: {', '.join(opts['kind'] or AIJob.Kind.values)})")
+        try:
+            count = jobs.work(
+                worker, kinds=opts["kind"], once=opts["once"], poll=opts["poll"], max_jobs=opts["max_jobs"],
+            )
+        except KeyboardInterrupt:
+            self.stdout.write("Pysäytetty.")
+            return
+        self.stdout.write(f"Käsitelty {count} työtä.")
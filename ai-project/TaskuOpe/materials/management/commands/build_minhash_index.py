@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from materials import minhash_index
+from materials.models import Submission
+
+
+class Command(BaseCommand):
+    """
+    Laskee MinHash-allekirjoitukset ja LSH-ämpärit palautuksille, joilta ne puuttuvat.
+
+    Uudet ja muuttuneet palautukset indeksoidaan tallennuksen yhteydessä;
+    komentoa tarvitaan indeksin käyttöönotossa vanhoille palautuksille.
+
+    Käyttö: python manage.py build_minhash_index [--all]
+    """
+    help = "Indeksoi palautukset lähes identtisten vastausten hakuun (MinHash/LSH)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all", action="store_true",
+            help="Tarkista kaikki palautukset (muuttuneet vastaukset lasketaan uudelleen).",
+        )
+
+    def handle(self, *args, **opts):
+        t0 = time.perf_counter()
+        qs = Submission.objects.exclude(response="")
+        if not opts["all"]:
+            qs = qs.filter(minhash__isnull=True)
+        count = 0
+        for sub in qs.only("id", "response").iterator():
+            minhash_index.index_submission(sub)
+            count += 1
+        elapsed = (time.perf_counter() - t0) * 1000
+        self.stdout.write(self.style.SUCCESS(f"MinHash-indeksi päivitetty: {count} palautusta ({elapsed:.0f} ms)"))
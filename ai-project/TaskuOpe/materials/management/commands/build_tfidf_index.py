@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from materials import tfidf_index
+from materials.models import Submission
+
+
+class Command(BaseCommand):
+    """
+    Laskee TF-IDF-vektorit palautuksille, joilta ne puuttuvat.
+
+    Uudet ja muuttuneet palautukset indeksoidaan tallennuksen yhteydessä;
+    komentoa tarvitaan indeksin käyttöönotossa vanhoille palautuksille.
+
+    Käyttö: python manage.py build_tfidf_index [--all]
+    """
+    help = "Indeksoi palautukset saman tehtävänannon verrokkien hakuun (TF-IDF)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all", action="store_true",
+            help="Tarkista kaikki palautukset (muuttuneet vastaukset lasketaan uudelleen).",
+        )
+
+    def handle(self, *args, **opts):
+        t0 = time.perf_counter()
+        qs = Submission.objects.all()
+        if not opts["all"]:
+            qs = qs.filter(tfidf__isnull=True)
+        count = 0
+        for sub in qs.only("id", "assignment_id", "response").iterator():
+            tfidf_index.index_submission(sub)
+            count += 1
+        elapsed = (time.perf_counter() - t0) * 1000
+        self.stdout.write(self.style.SUCCESS(f"TF-IDF-indeksi päivitetty: {count} palautusta ({elapsed:.0f} ms)"))
@@ -0,0 +1,107 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from TaskuOpe import ops_chunks
+
+
+class Command(BaseCommand):
+    """
+    Mittaa OPS-haun kyselykohtaisen viiveen eri hakupoluilla.
+
+    Vertailee alkuperäistä koko datan läpikäyntiä (_score jokaiselle riville),
+    käänteisen indeksin posting-listoja ("python") ja CSR-matriisituloa
+    ("sparse") sekä eräpolkua (retrieve_chunks_many). Kyselyt arvotaan datasta kiinteällä siemenellä, joten ajot
+    ovat vertailukelpoisia keskenään. Oletuksena termit arvotaan
+    esiintymien suhteessa (yleiset sanat kuten oikeissa hauissa);
+    --uniform arpoo tasaisesti sanastosta (enimmäkseen harvinaisia termejä).
+
+    Käyttö: python manage.py ops_benchmark --queries 500 --k 3
+    """
+    help = "Mittaa OPS-haun viiveen (full scan vs. käänteinen indeksi vs. sparse)."
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--queries", type=int, default=300, help="Kyselyiden määrä.")
+        parser.add_argument("--k", type=int, default=8, help="Palautettavien chunkien määrä.")
+        parser.add_argument("--terms", type=int, default=3, help="Termejä kyselyä kohden (max).")
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument("--uniform", action="store_true", help="Arvo termit tasaisesti sanastosta.")
+        parser.add_argument("--batch", type=int, default=50, help="Eräkoko retrieve_chunks_many-mittaukseen.")
+        parser.add_argument(
+            "--analyzer", default="plain", choices=ops_chunks.ANALYZERS,
+            help="Indeksoitujen polkujen analysaattori (full scan käyttää aina plain-tokeneita).",
+        )
+
+    def handle(self, *args, **opts):
+        ops_chunks._load_data(force=True)
+        # Koko datan läpikäynti tarvitsee _tf-laskurit, joten rivit luetaan JSONista
+        rows = ops_chunks._read_rows()
+        rng = random.Random(opts["seed"])
+        vocab = sorted({t for r in rows for t in r["_tf"]})
+        if opts["uniform"]:
+            pool = vocab
+        else:
+            pool = [t for r in rows for t in r["_tokens"]]
+        queries = [
+            " ".join(rng.choice(pool) for _ in range(rng.randint(1, opts["terms"])))
+            for _ in range(opts["queries"])
+        ]
+        k = opts["k"]
+
+        def full_scan(query, scorer):
+            # Alkuperäinen toteutus: _score jokaiselle riville + koko lajittelu
+            q_tokens = ops_chunks._tokenize(query)
+            scored = [(ops_chunks._score(q_tokens, r), r) for r in rows]
+            scored = [(s, r) for s, r in scored if s > 0.0]
+            scored.sort(key=lambda x: x[0], reverse=True)
+            return scored[:k]
+
+        paths = [("full scan (_score)", "tf", full_scan)]
+        engines = ["python"] + (["sparse", "auto"] if ops_chunks._HAS_SPARSE else [])
+        for scorer in ops_chunks.SCORERS:
+            for engine in engines:
+                paths.append((
+                    f"{engine} / {scorer}", scorer,
+                    lambda q, sc, e=engine: ops_chunks.retrieve_chunks(
+                        q, k=k, scorer=sc, engine=e, cache=False, analyzer=opts["analyzer"]
+                    ),
+                ))
+        # Välimuistin osumapolku: samat kyselyt uudelleen (ensimmäinen kierros täyttää)
+        paths.append(("cache hit / tf", "tf", lambda q, sc: ops_chunks.retrieve_chunks(q, k=k, scorer=sc)))
+
+        self.stdout.write(
+            f"{len(rows)} riviä, {len(vocab)} termiä, {len(queries)} kyselyä, k={k}, "
+            f"indeksi: {ops_chunks._state().source}"
+        )
+        self.stdout.write(f"{'polku':<22}{'keskiarvo µs':>14}{'p50 µs':>10}{'p95 µs':>10}")
+        for label, scorer, fn in paths:
+            if label.startswith("cache"):
+                for q in queries:
+                    fn(q, scorer)
+            timings = []
+            for q in queries:
+                t0 = time.perf_counter()
+                fn(q, scorer)
+                timings.append((time.perf_counter() - t0) * 1e6)
+            timings.sort()
+            mean = sum(timings) / len(timings)
+            p50 = timings[len(timings) // 2]
+            p95 = timings[int(len(timings) * 0.95)]
+            self.stdout.write(f"{label:<22}{mean:>14.1f}{p50:>10.1f}{p95:>10.1f}")
+        # Eräpolku: kyselykohtainen aika, kun kyselyt haetaan --batch kerrallaan
+        size = max(1, opts["batch"])
+        batches = [queries[i:i + size] for i in range(0, len(queries), size)]
+        for scorer in ops_chunks.SCORERS:
+            for engine in engines:
+                timings = []
+                for batch in batches:
+                    t0 = time.perf_counter()
+                    ops_chunks.retrieve_chunks_many(
+                        batch, k=k, scorer=scorer, engine=engine, analyzer=opts["analyzer"]
+                    )
+                    timings.append((time.perf_counter() - t0) * 1e6 / len(batch))
+                mean = sum(timings) / len(timings)
+                self.stdout.write(f"{f'batch {engine} / {scorer}':<22}{mean:>14.1f}{'':>10}{'':>10}")
+        self.stdout.write(f"välimuisti: {ops_chunks.retrieve_cache_info()}")
@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from TaskuOpe import ops_chunks
+
+
+class Command(BaseCommand):
+    """
+    Rakentaa OPS-datasta binääri-indeksin, jonka gunicorn-workerit muistikartoittavat.
+
+    Indeksi sisältää posting-listat, BM25-painot, facet-tunnisteet ja rivien
+    tekstit litteinä taulukoina. Workerit jakavat tiedoston muistisivut eikä
+    JSONia tarvitse jäsentää jokaisessa prosessissa. Jos JSON muuttuu eikä
+    indeksiä rakenneta uudelleen, haku palaa automaattisesti JSON-lataukseen.
+
+    Käyttö: python manage.py ops_build_index [--output polku]
+    """
+    help = "Rakentaa muistikartoitettavan OPS-hakuindeksin (ops_data/*.idx)."
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--output", default=None,
+            help="Kohdetiedosto (oletus: settings.OPS_INDEX_PATH tai ops_data/*.idx).",
+        )
+
+    def handle(self, *args, **opts):
+        t0 = time.perf_counter()
+        path, size = ops_chunks.build_index_file(opts["output"])
+        elapsed = (time.perf_counter() - t0) * 1000
+        self.stdout.write(self.style.SUCCESS(
+            f"OPS-indeksi kirjoitettu: {path} ({size / 1024:.0f} KiB, {elapsed:.0f} ms)"
+        ))
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.6 on 2026-10-17 05:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prompt',
+            name='cache_hits',
+            field=models.PositiveIntegerField(default=0, verbose_name='Välimuistiosumat'),
+        ),
+        migrations.AddField(
+            model_name='prompt',
+            name='cache_key',
+            field=models.CharField(blank=True, db_index=True, max_length=64, verbose_name='Välimuistiavain'),
+        ),
+        migrations.AddField(
+            model_name='prompt',
+            name='last_hit_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Viimeisin osuma'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.6 on 2026-10-17 05:32
+
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0003_prompt_cache_hits'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AIJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('AI_GRADE', 'AI-arviointiehdotus'), ('PLAGIARISM', 'Alkuperäisyysraportti')], max_length=20, verbose_name='Tyyppi')),
+                ('idempotency_key', models.CharField(max_length=200, verbose_name='Idempotenssiavain')),
+                ('status', models.CharField(choices=[('QUEUED', 'Jonossa'), ('RUNNING', 'Käsittelyssä'), ('DONE', 'Valmis'), ('FAILED', 'Epäonnistui')], default='QUEUED', max_length=10, verbose_name='Tila')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Yrityksiä')),
+                ('max_attempts', models.PositiveIntegerField(default=3, verbose_name='Yrityksiä enintään')),
+                ('available_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='Suoritettavissa alkaen')),
+                ('locked_until', models.DateTimeField(blank=True, null=True, verbose_name='Lukittu asti')),
+                ('locked_by', models.CharField(blank=True, max_length=100, verbose_name='Käsittelijä')),
+                ('last_error', models.TextField(blank=True, verbose_name='Viimeisin virhe')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Luotu')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Valmistunut')),
+                ('requested_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='ai_jobs', to=settings.AUTH_USER_MODEL, verbose_name='Pyytäjä')),
+                ('submission', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='ai_jobs', to='materials.submission', verbose_name='Palautus')),
+            ],
+            options={
+                'verbose_name': 'AI-työ',
+                'verbose_name_plural': 'AI-työt',
+                'ordering': ['created_at'],
+                'indexes': [models.Index(fields=['status', 'available_at'], name='materials_a_status_810aec_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('status__in', ['QUEUED', 'RUNNING'])), fields=('idempotency_key',), name='aijob_unique_active_key')],
+            },
+        ),
+    ]
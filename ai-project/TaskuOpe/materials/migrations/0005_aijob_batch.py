@@ -0,0 +1,34 @@
+# Generated by Django 5.2.6 on 2026-10-17 05:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0004_aijob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aijob',
+            name='material',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='ai_jobs', to='materials.material', verbose_name='Materiaali'),
+        ),
+        migrations.AddField(
+            model_name='aijob',
+            name='progress',
+            field=models.PositiveIntegerField(default=0, verbose_name='Käsitelty'),
+        ),
+        migrations.AddField(
+            model_name='aijob',
+            name='total',
+            field=models.PositiveIntegerField(default=0, verbose_name='Yhteensä'),
+        ),
+        migrations.AlterField(
+            model_name='aijob',
+            name='kind',
+            field=models.CharField(choices=[('AI_GRADE', 'AI-arviointiehdotus'), ('PLAGIARISM', 'Alkuperäisyysraportti'), ('BATCH_GRADE', 'Koko luokan AI-arviointi')], max_length=20, verbose_name='Tyyppi'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.6 on 2026-10-17 05:43
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0005_aijob_batch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TfidfIndex',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('vocabulary', models.JSONField(default=dict, verbose_name='Sanasto')),
+                ('doc_freq', models.JSONField(default=list, verbose_name='Dokumenttifrekvenssit')),
+                ('vectors', models.JSONField(default=dict, verbose_name='Dokumenttivektorit')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Päivitetty')),
+                ('assignment', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='tfidf_index', to='materials.assignment', verbose_name='Tehtävänanto')),
+            ],
+            options={
+                'verbose_name': 'TF-IDF-indeksi',
+                'verbose_name_plural': 'TF-IDF-indeksit',
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.6 on 2026-10-17 05:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0006_tfidfindex'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubmissionSignature',
+            fields=[
+                ('submission', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='minhash', serialize=False, to='materials.submission', verbose_name='Palautus')),
+                ('signature', models.BinaryField(verbose_name='MinHash-allekirjoitus')),
+                ('response_hash', models.CharField(max_length=40, verbose_name='Vastauksen tiiviste')),
+            ],
+            options={
+                'verbose_name': 'MinHash-allekirjoitus',
+                'verbose_name_plural': 'MinHash-allekirjoitukset',
+            },
+        ),
+        migrations.CreateModel(
+            name='MinHashBand',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.BigIntegerField(db_index=True, verbose_name='Ämpäri')),
+                ('submission', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='minhash_bands', to='materials.submission', verbose_name='Palautus')),
+            ],
+            options={
+                'verbose_name': 'LSH-ämpäri',
+                'verbose_name_plural': 'LSH-ämpärit',
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.6 on 2026-10-17 05:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0007_minhash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='plagiarismreport',
+            name='method',
+            field=models.CharField(choices=[('LOCAL', 'Paikallinen esiarvio'), ('LLM', 'Tekoälyarvio')], default='LLM', max_length=10, verbose_name='Menetelmä'),
+        ),
+        migrations.AddField(
+            model_name='plagiarismreport',
+            name='notes',
+            field=models.JSONField(blank=True, default=dict, verbose_name='Lisätiedot'),
+        ),
+        migrations.AlterField(
+            model_name='aijob',
+            name='kind',
+            field=models.CharField(choices=[('AI_GRADE', 'AI-arviointiehdotus'), ('PLAGIARISM', 'Alkuperäisyysraportti'), ('PLAGIARISM_LLM', 'Alkuperäisyysraportti (tekoälyarvio)'), ('BATCH_GRADE', 'Koko luokan AI-arviointi')], max_length=20, verbose_name='Tyyppi'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.6 on 2026-10-17 05:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0008_plagiarism_prefilter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClassSimilarity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('heatmap', models.JSONField(default=dict, verbose_name='Lämpökartta')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Päivitetty')),
+                ('material', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='class_similarity', to='materials.material', verbose_name='Materiaali')),
+            ],
+            options={
+                'verbose_name': 'Luokan samankaltaisuusvertailu',
+                'verbose_name_plural': 'Luokan samankaltaisuusvertailut',
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.6 on 2026-10-17 05:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0009_classsimilarity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aigrade',
+            name='content_hash',
+            field=models.CharField(blank=True, max_length=64, verbose_name='Sisällön tiiviste'),
+        ),
+        migrations.AddField(
+            model_name='aijob',
+            name='force',
+            field=models.BooleanField(default=False, verbose_name='Pakotettu'),
+        ),
+        migrations.AddField(
+            model_name='plagiarismreport',
+            name='content_hash',
+            field=models.CharField(blank=True, max_length=64, verbose_name='Sisällön tiiviste'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.6 on 2026-10-17 06:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0010_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TfidfTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.TextField(verbose_name='Termi')),
+                ('doc_freq', models.IntegerField(default=0, verbose_name='Dokumenttifrekvenssi')),
+                ('assignment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tfidf_terms', to='materials.assignment', verbose_name='Tehtävänanto')),
+            ],
+            options={
+                'verbose_name': 'TF-IDF-termi',
+                'verbose_name_plural': 'TF-IDF-termit',
+            },
+        ),
+        migrations.CreateModel(
+            name='TfidfVector',
+            fields=[
+                ('submission', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='tfidf', serialize=False, to='materials.submission', verbose_name='Palautus')),
+                ('response_hash', models.CharField(max_length=40, verbose_name='Vastauksen tiiviste')),
+                ('terms', models.JSONField(default=list, verbose_name='Termit')),
+                ('counts', models.JSONField(default=list, verbose_name='Lukumäärät')),
+                ('assignment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tfidf_vectors', to='materials.assignment', verbose_name='Tehtävänanto')),
+            ],
+            options={
+                'verbose_name': 'TF-IDF-vektori',
+                'verbose_name_plural': 'TF-IDF-vektorit',
+            },
+        ),
+        migrations.DeleteModel(
+            name='TfidfIndex',
+        ),
+        migrations.AddConstraint(
+            model_name='tfidfterm',
+            constraint=models.UniqueConstraint(fields=('assignment', 'term'), name='unique_tfidf_term_per_assignment'),
+        ),
+    ]
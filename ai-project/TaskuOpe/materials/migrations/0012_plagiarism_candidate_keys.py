@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-17 06:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0011_tfidf_rows'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='plagiarismreport',
+            name='candidate_keys',
+            field=models.JSONField(blank=True, default=list, verbose_name='Verrokit'),
+        ),
+    ]
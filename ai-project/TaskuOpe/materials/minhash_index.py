@@ -0,0 +1,161 @@
+# materials/minhash_index.py
+"""
+MinHash/LSH-indeksi lähes identtisten vastausten hakuun koko koulun
+palautuksista.
+
+TF-IDF-verrokit (materials.tfidf_index) haetaan vain saman tehtävänannon
+sisältä, joten kopiointi rinnakkaisten luokkien tai uudelleen jaettujen
+materiaalien välillä jää huomaamatta. Kaikkien palautusten vertaaminen
+keskenään olisi neliöllistä, joten:
+
+- Vastaus normalisoidaan ja pilkotaan SHINGLE_SIZE merkin paloiksi.
+- Paloista lasketaan NUM_PERM minimitiivisteen allekirjoitus (MinHash);
+  kahden allekirjoituksen yhtenevien arvojen osuus arvioi palasarjojen
+  Jaccard-samankaltaisuutta.
+- Allekirjoitus jaetaan BANDS kaistaan, ja kunkin kaistan tiiviste
+  tallennetaan indeksoituun MinHashBand-tauluun. Ehdokkaat ovat
+  palautuksia, joilla on vähintään yksi yhteinen kaista (haku indeksistä),
+  ja ne tarkistetaan allekirjoituksia vertaamalla.
+
+Allekirjoitus lasketaan palautusta tallennettaessa (post_save). Vanhat
+palautukset indeksoidaan komennolla: python manage.py build_minhash_index
+"""
+
+import hashlib
+import re
+import unicodedata
+from typing import List, Optional, Set, Tuple
+
+import numpy as np
+from django.db import transaction
+
+from .models import MinHashBand, Submission, SubmissionSignature
+
+NUM_PERM = 128
+BANDS = 32
+ROWS = NUM_PERM // BANDS  # 4 riviä/kaista: ehdokkaaksi päätyy n. Jaccard >= 0.4
+SHINGLE_SIZE = 5
+# Ehdokkaiden alaraja arvioidulle Jaccard-samankaltaisuudelle
+MIN_JACCARD = 0.5
+
+_MERSENNE = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+# Pysyvä siemen: tallennetut allekirjoitukset ovat vertailukelpoisia vain samoilla permutaatioilla
+_RNG = np.random.RandomState(2024)
+_A = _RNG.randint(1, (1 << 61) - 1, size=NUM_PERM, dtype=np.uint64)
+_B = _RNG.randint(0, (1 << 61) - 1, size=NUM_PERM, dtype=np.uint64)
+
+
+def _normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKD", (text or "").lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+
+def _shingles(text: str) -> Set[str]:
+    norm = _normalize(text)
+    if len(norm) <= SHINGLE_SIZE:
+        return {norm} if norm else set()
+    return {norm[i:i + SHINGLE_SIZE] for i in range(len(norm) - SHINGLE_SIZE + 1)}
+
+
+def _hash32(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=4).digest(), "little")
+
+
+def signature(text: str) -> Optional[np.ndarray]:
+    """
+    Laskee vastauksen MinHash-allekirjoituksen.
+
+    Args:
+        text (str): Vastaus.
+
+    Returns:
+        Optional[np.ndarray]: NUM_PERM kappaletta uint32-arvoja tai None, jos vastaus on tyhjä.
+    """
+    shingles = _shingles(text)
+    if not shingles:
+        return None
+    hv = np.fromiter((_hash32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+    # Universaalit tiivistefunktiot (a*x + b) mod p; uint64-ylivuoto on tässä harmiton
+    phv = ((np.outer(hv, _A) + _B) % _MERSENNE) & _MAX_HASH
+    return phv.min(axis=0).astype(np.uint32)
+
+
+def band_buckets(sig: np.ndarray) -> List[int]:
+    """Palauttaa allekirjoituksen LSH-kaistojen ämpärit (kaista ja rivit samaan 64-bittiseen avaimeen)."""
+    out = []
+    for band in range(BANDS):
+        rows = sig[band * ROWS:(band + 1) * ROWS].tobytes()
+        digest = hashlib.blake2b(band.to_bytes(2, "little") + rows, digest_size=8).digest()
+        out.append(int.from_bytes(digest, "little", signed=True))
+    return out
+
+
+def _response_hash(text: str) -> str:
+    return hashlib.sha1((text or "").encode("utf-8")).hexdigest()
+
+
+def index_submission(sub: Submission) -> None:
+    """
+    Laskee palautuksen allekirjoituksen ja LSH-ämpärit, jos vastaus muuttui.
+
+    Tyhjä vastaus poistetaan indeksistä. Virhe ei kaada palautuksen
+    tallennusta; palautus voidaan indeksoida myöhemmin uudelleen.
+
+    Args:
+        sub (Submission): Tallennettu palautus.
+    """
+    response_hash = _response_hash(sub.response)
+    try:
+        if SubmissionSignature.objects.filter(submission_id=sub.pk, response_hash=response_hash).exists():
+            return
+        sig = signature(sub.response)
+        with transaction.atomic():
+            MinHashBand.objects.filter(submission_id=sub.pk).delete()
+            if sig is None:
+                SubmissionSignature.objects.filter(submission_id=sub.pk).delete()
+                return
+            SubmissionSignature.objects.update_or_create(
+                submission_id=sub.pk, defaults={"signature": sig.tobytes(), "response_hash": response_hash},
+            )
+            MinHashBand.objects.bulk_create(
+                MinHashBand(submission_id=sub.pk, bucket=bucket) for bucket in band_buckets(sig)
+            )
+    except Exception as e:
+        print(f"DEBUG (minhash_index): Indeksointi epäonnistui ({sub.pk}): {e}")
+
+
+def near_duplicates(sub: Submission, top_k: int = 3, min_jaccard: float = MIN_JACCARD) -> List[Tuple[Submission, float]]:
+    """
+    Hakee koko koulun palautuksista lähes identtiset vastaukset.
+
+    Ehdokkaat haetaan LSH-ämpäreistä (indeksihaku) ja niiden
+    samankaltaisuus arvioidaan allekirjoituksista.
+
+    Args:
+        sub (Submission): Verrattava palautus.
+        top_k (int): Kuinka monta samankaltaisinta palautetaan.
+        min_jaccard (float): Arvioidun Jaccard-samankaltaisuuden alaraja.
+
+    Returns:
+        List[Tuple[Submission, float]]: (palautus, arvioitu Jaccard) laskevassa järjestyksessä.
+    """
+    sig = signature(sub.response)
+    if sig is None:
+        return []
+    candidate_ids = (
+        MinHashBand.objects.filter(bucket__in=band_buckets(sig))
+        .exclude(submission_id=sub.pk)
+        .values_list("submission_id", flat=True)
+        .distinct()
+    )
+    scored = []
+    for other_id, raw in SubmissionSignature.objects.filter(submission_id__in=list(candidate_ids)).values_list("submission_id", "signature"):
+        jaccard = float(np.mean(np.frombuffer(bytes(raw), dtype=np.uint32) == sig))
+        if jaccard >= min_jaccard:
+            scored.append((other_id, jaccard))
+    scored.sort(key=lambda t: t[1], reverse=True)
+    scored = scored[:top_k]
+    subs = Submission.objects.select_related("student").in_bulk([pk for pk, _ in scored])
+    return [(subs[pk], jaccard) for pk, jaccard in scored if pk in subs]
@@ -5,8 +5,9 @@ import re
 from django.conf import settings
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
-from django.db.models.signals import post_delete
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from imagekit.models import ImageSpecField
 from imagekit.processors import ResizeToFill
@@ -22,6 +23,9 @@ class Prompt(models.Model):
         model (CharField): Käytetyn tekoälymallin nimi/tunnus.
         teacher (ForeignKey): Viittaus opettajaan, joka kehotteen loi.
         created_at (DateTimeField): Kehotteen luontiaika.
+        cache_key (CharField): LLM-vastausvälimuistin avain (ks. llm_cache.cache_key).
+        cache_hits (PositiveIntegerField): Kuinka monta kertaa vastaus palautettiin välimuistista.
+        last_hit_at (DateTimeField): Viimeisin välimuistiosuma.
     """
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -34,6 +38,9 @@ class Prompt(models.Model):
         verbose_name=_("Opettaja"),
     )
     created_at = models.DateTimeField(auto_now_add=True, verbose_name=_("Luotu"))
+    cache_key = models.CharField(max_length=64, blank=True, db_index=True, verbose_name=_("Välimuistiavain"))
+    cache_hits = models.PositiveIntegerField(default=0, verbose_name=_("Välimuistiosumat"))
+    last_hit_at = models.DateTimeField(null=True, blank=True, verbose_name=_("Viimeisin osuma"))
 
     class Meta:
         """
@@ -340,8 +347,15 @@ class PlagiarismReport(models.Model):
     Malli plagiointiraporteille, jotka liittyvät opiskelijoiden palautuksiin.
 
     Tallentaa plagiointiriskin pistemäärän ja mahdolliset korostukset.
+    Paikallisen esiarvion (method=LOCAL) raportti on alustava: tekoälyarvio
+    tehdään vain, jos esiarvio ylittää kynnysarvot tai opettaja pyytää sitä.
     """
 
+    class Method(models.TextChoices):
+        """Millä raportti on tuotettu."""
+        LOCAL = 'LOCAL', _('Paikallinen esiarvio')
+        LLM = 'LLM', _('Tekoälyarvio')
+
     submission = models.OneToOneField(Submission, on_delete=models.CASCADE, related_name="plagiarism_report", verbose_name=_("Palautus"))
     suspected_source = models.ForeignKey(
         Submission,
@@ -361,6 +375,14 @@ class PlagiarismReport(models.Model):
         help_text=_("AI:n huomiot ja korostukset (HTML tai JSON)"),
         verbose_name=_("Huomiot"),
     )
+    method = models.CharField(max_length=10, choices=Method.choices, default=Method.LLM, verbose_name=_("Menetelmä"))
+    notes = models.JSONField(default=dict, blank=True, verbose_name=_("Lisätiedot"))
+    # Vastauksen, verrokkijoukon ja mallin tiiviste (materials.plagiarism.report_hash);
+    # sama tiiviste = raportti on ajan tasalla eikä analyysia tarvitse toistaa
+    content_hash = models.CharField(max_length=64, blank=True, verbose_name=_("Sisällön tiiviste"))
+    # Tiivisteessä käytetyt verrokit [palautuksen ID, lähde]; arviointisivu tarkistaa
+    # niiden avulla ajantasaisuuden hakematta verrokkeja uudelleen
+    candidate_keys = models.JSONField(default=list, blank=True, verbose_name=_("Verrokit"))
     created_at = models.DateTimeField(auto_now_add=True, verbose_name=_("Luotu"))
 
     class Meta:
@@ -370,6 +392,127 @@ class PlagiarismReport(models.Model):
         verbose_name = _("Alkuperäisyysraportti")
         verbose_name_plural = _("Alkuperäisyysraportit")
 
+    @property
+    def is_provisional(self) -> bool:
+        """Onko raportti vain paikallinen esiarvio (ei tekoälyarviota)."""
+        return self.method == self.Method.LOCAL
+
+
+class TfidfTerm(models.Model):
+    """
+    Tehtävänannon TF-IDF-sanaston termi ja sen dokumenttifrekvenssi
+    plagiointiverrokkien hakuun (materials.tfidf_index).
+
+    Dokumenttifrekvenssiä päivitetään F()-lausekkeilla vain niille termeille,
+    jotka palautuksen muuttunut vastaus lisää tai poistaa, joten tallennus ei
+    kirjoita koko tehtävänannon tilaa uudelleen.
+    """
+    assignment = models.ForeignKey(
+        'materials.Assignment', on_delete=models.CASCADE, related_name='tfidf_terms', verbose_name=_("Tehtävänanto"),
+    )
+    term = models.TextField(verbose_name=_("Termi"))
+    doc_freq = models.IntegerField(default=0, verbose_name=_("Dokumenttifrekvenssi"))
+
+    class Meta:
+        """
+        Metatiedot TfidfTerm-mallille.
+        """
+        verbose_name = _("TF-IDF-termi")
+        verbose_name_plural = _("TF-IDF-termit")
+        constraints = [
+            models.UniqueConstraint(fields=['assignment', 'term'], name='unique_tfidf_term_per_assignment'),
+        ]
+
+
+class TfidfVector(models.Model):
+    """
+    Palautuksen vastauksen harva termifrekvenssivektori (materials.tfidf_index).
+
+    Vektori lasketaan palautusta tallennettaessa, joten tarkistus vektorisoi
+    vain uuden vastauksen eikä sovita TF-IDF:ää koko korpukseen uudelleen.
+    """
+    submission = models.OneToOneField(
+        Submission, on_delete=models.CASCADE, primary_key=True, related_name='tfidf', verbose_name=_("Palautus"),
+    )
+    # Palautuksen tehtävänanto indeksointihetkellä (haku tehdään tämän mukaan)
+    assignment = models.ForeignKey(
+        'materials.Assignment', on_delete=models.CASCADE, related_name='tfidf_vectors', verbose_name=_("Tehtävänanto"),
+    )
+    response_hash = models.CharField(max_length=40, verbose_name=_("Vastauksen tiiviste"))
+    # TfidfTerm-rivien ID:t ja niiden lukumäärät vastauksessa
+    terms = models.JSONField(default=list, verbose_name=_("Termit"))
+    counts = models.JSONField(default=list, verbose_name=_("Lukumäärät"))
+
+    class Meta:
+        """
+        Metatiedot TfidfVector-mallille.
+        """
+        verbose_name = _("TF-IDF-vektori")
+        verbose_name_plural = _("TF-IDF-vektorit")
+
+
+class SubmissionSignature(models.Model):
+    """
+    Palautuksen vastauksen MinHash-allekirjoitus lähes identtisten vastausten
+    hakuun koko koulun palautuksista (materials.minhash_index).
+
+    Allekirjoitus on NUM_PERM kappaletta 32-bittisiä minimitiivisteitä
+    tavuina. LSH-kaistojen ämpärit ovat MinHashBand-taulussa.
+    """
+    submission = models.OneToOneField(
+        Submission, on_delete=models.CASCADE, primary_key=True, related_name='minhash', verbose_name=_("Palautus"),
+    )
+    signature = models.BinaryField(verbose_name=_("MinHash-allekirjoitus"))
+    response_hash = models.CharField(max_length=40, verbose_name=_("Vastauksen tiiviste"))
+
+    class Meta:
+        """
+        Metatiedot SubmissionSignature-mallille.
+        """
+        verbose_name = _("MinHash-allekirjoitus")
+        verbose_name_plural = _("MinHash-allekirjoitukset")
+
+
+class MinHashBand(models.Model):
+    """
+    LSH-kaistan ämpäri: palautukset, joiden allekirjoituksen jokin kaista on
+    sama, ovat lähes identtisten vastausten ehdokkaita. Haku tehdään
+    bucket-indeksillä, joten se ei käy läpi kaikkia palautuksia.
+    """
+    submission = models.ForeignKey(
+        Submission, on_delete=models.CASCADE, related_name='minhash_bands', verbose_name=_("Palautus"),
+    )
+    # Kaistan numero ja sen rivit tiivistettynä yhdeksi 64-bittiseksi avaimeksi
+    bucket = models.BigIntegerField(db_index=True, verbose_name=_("Ämpäri"))
+
+    class Meta:
+        """
+        Metatiedot MinHashBand-mallille.
+        """
+        verbose_name = _("LSH-ämpäri")
+        verbose_name_plural = _("LSH-ämpärit")
+
+
+class ClassSimilarity(models.Model):
+    """
+    Materiaalin koko luokan palautusten pareittainen samankaltaisuus
+    (materials.class_similarity). Tallentaa palautussivun lämpökartan
+    JSON-muodossa; palautuskohtaiset tulokset tallennetaan
+    PlagiarismReport-riveille.
+    """
+    material = models.OneToOneField(
+        Material, on_delete=models.CASCADE, related_name='class_similarity', verbose_name=_("Materiaali"),
+    )
+    heatmap = models.JSONField(default=dict, verbose_name=_("Lämpökartta"))
+    updated_at = models.DateTimeField(auto_now=True, verbose_name=_("Päivitetty"))
+
+    class Meta:
+        """
+        Metatiedot ClassSimilarity-mallille.
+        """
+        verbose_name = _("Luokan samankaltaisuusvertailu")
+        verbose_name_plural = _("Luokan samankaltaisuusvertailut")
+
 
 class Rubric(models.Model):
     """
@@ -444,6 +587,8 @@ class AIGrade(models.Model):
     )
     teacher_confirmed = models.BooleanField(default=False, verbose_name=_("Opettaja vahvistanut"))
     teacher_notes = models.TextField(blank=True, verbose_name=_("Opettajan muistiinpanot"))
+    # Vastauksen, kriteeristön ja mallin tiiviste (materials.ai_rubric.grading_hash)
+    content_hash = models.CharField(max_length=64, blank=True, verbose_name=_("Sisällön tiiviste"))
     created_at = models.DateTimeField(auto_now_add=True, verbose_name=_("Luotu"))
 
     class Meta:
@@ -453,6 +598,91 @@ class AIGrade(models.Model):
         verbose_name = _("AI-arvio")
         verbose_name_plural = _("AI-arviot")
 
+class AIJob(models.Model):
+    """
+    Tietokantapohjainen työjono hitaille tekoälytoiminnoille (AI-arviointi,
+    alkuperäisyysraportti, koko luokan AI-arviointi).
+
+    Näkymä lisää työn jonoon (materials.jobs.enqueue) ja worker-komento
+    (python manage.py ai_worker) suorittaa sen. Samalle palautukselle voi olla
+    kerrallaan vain yksi keskeneräinen työ samalla idempotenssiavaimella.
+    Käsittelyyn otettu työ on lukittu locked_until-hetkeen asti
+    (visibility timeout); jos worker kaatuu, työ palaa jonoon lukon
+    vanhennuttua.
+    """
+
+    class Kind(models.TextChoices):
+        """Työn tyyppi."""
+        AI_GRADE = 'AI_GRADE', _('AI-arviointiehdotus')
+        PLAGIARISM = 'PLAGIARISM', _('Alkuperäisyysraportti')
+        PLAGIARISM_LLM = 'PLAGIARISM_LLM', _('Alkuperäisyysraportti (tekoälyarvio)')
+        BATCH_GRADE = 'BATCH_GRADE', _('Koko luokan AI-arviointi')
+
+    class Status(models.TextChoices):
+        """Työn tila."""
+        QUEUED = 'QUEUED', _('Jonossa')
+        RUNNING = 'RUNNING', _('Käsittelyssä')
+        DONE = 'DONE', _('Valmis')
+        FAILED = 'FAILED', _('Epäonnistui')
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    kind = models.CharField(max_length=20, choices=Kind.choices, verbose_name=_("Tyyppi"))
+    submission = models.ForeignKey(
+        Submission, on_delete=models.CASCADE, null=True, blank=True,
+        related_name='ai_jobs', verbose_name=_("Palautus"),
+    )
+    # Materiaalikohtaiset työt (BATCH_GRADE) kohdistuvat materiaaliin palautuksen sijaan
+    material = models.ForeignKey(
+        Material, on_delete=models.CASCADE, null=True, blank=True,
+        related_name='ai_jobs', verbose_name=_("Materiaali"),
+    )
+    idempotency_key = models.CharField(max_length=200, verbose_name=_("Idempotenssiavain"))
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.QUEUED, verbose_name=_("Tila"))
+    requested_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True,
+        related_name='ai_jobs', verbose_name=_("Pyytäjä"),
+    )
+    attempts = models.PositiveIntegerField(default=0, verbose_name=_("Yrityksiä"))
+    max_attempts = models.PositiveIntegerField(default=3, verbose_name=_("Yrityksiä enintään"))
+    available_at = models.DateTimeField(default=timezone.now, db_index=True, verbose_name=_("Suoritettavissa alkaen"))
+    locked_until = models.DateTimeField(null=True, blank=True, verbose_name=_("Lukittu asti"))
+    locked_by = models.CharField(max_length=100, blank=True, verbose_name=_("Käsittelijä"))
+    last_error = models.TextField(blank=True, verbose_name=_("Viimeisin virhe"))
+    progress = models.PositiveIntegerField(default=0, verbose_name=_("Käsitelty"))
+    total = models.PositiveIntegerField(default=0, verbose_name=_("Yhteensä"))
+    # Opettaja pyysi uutta ajoa, vaikka tallennettu tulos olisi ajan tasalla
+    force = models.BooleanField(default=False, verbose_name=_("Pakotettu"))
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name=_("Luotu"))
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name=_("Valmistunut"))
+
+    class Meta:
+        """
+        Metatiedot AIJob-mallille.
+        """
+        verbose_name = _("AI-työ")
+        verbose_name_plural = _("AI-työt")
+        ordering = ['created_at']
+        indexes = [models.Index(fields=['status', 'available_at'])]
+        constraints = [
+            # Vain yksi keskeneräinen työ avainta kohden (idempotenssi)
+            models.UniqueConstraint(
+                fields=['idempotency_key'],
+                condition=models.Q(status__in=['QUEUED', 'RUNNING']),
+                name='aijob_unique_active_key',
+            ),
+        ]
+
+    def __str__(self):
+        """
+        Palauttaa työn tyypin ja tilan.
+        """
+        return f"{self.get_kind_display()} ({self.get_status_display()})"
+
+    @property
+    def is_active(self) -> bool:
+        """True, jos työ on jonossa tai käsittelyssä."""
+        return self.status in (self.Status.QUEUED, self.Status.RUNNING)
+
 class MaterialImage(models.Model):
     """
     Malli materiaaleihin liitetyille kuville.
@@ -491,3 +721,54 @@ def delete_image_file(sender, instance, **kwargs):
     """
     if instance.image:
         instance.image.delete(save=False)
+
+@receiver(post_save, sender=Submission)
+def index_submission_tfidf(sender, instance, raw=False, **kwargs):
+    """
+    Signal-vastaanottaja, joka päivittää tehtävänannon TF-IDF-indeksin
+    palautuksen tallennuksen yhteydessä (vain, jos vastaus muuttui).
+
+    Args:
+        sender: Signaalin lähettäjä (tässä Submission-malli).
+        instance (Submission): Tallennettu palautus.
+        raw (bool): True fixtureja ladattaessa (indeksiä ei päivitetä).
+        **kwargs: Muut signaaliargumentit.
+    """
+    if raw:
+        return
+    from .tfidf_index import index_submission
+    index_submission(instance)
+
+@receiver(post_save, sender=Submission)
+def index_submission_minhash(sender, instance, raw=False, **kwargs):
+    """
+    Signal-vastaanottaja, joka laskee palautuksen MinHash-allekirjoituksen ja
+    LSH-ämpärit tallennuksen yhteydessä (vain, jos vastaus muuttui).
+
+    Args:
+        sender: Signaalin lähettäjä (tässä Submission-malli).
+        instance (Submission): Tallennettu palautus.
+        raw (bool): True fixtureja ladattaessa (indeksiä ei päivitetä).
+        **kwargs: Muut signaaliargumentit.
+    """
+    if raw:
+        return
+    from .minhash_index import index_submission
+    index_submission(instance)
+
+@receiver(pre_delete, sender=Submission)
+def unindex_submission_tfidf(sender, instance, **kwargs):
+    """
+    Signal-vastaanottaja, joka poistaa palautuksen TF-IDF-indeksistä.
+
+    Ajetaan ennen poistoa (samassa transaktiossa), koska vektoririvi
+    poistuu palautuksen mukana ja sen termien dokumenttifrekvenssit on
+    vähennettävä sitä ennen.
+
+    Args:
+        sender: Signaalin lähettäjä (tässä Submission-malli).
+        instance (Submission): Poistettava palautus.
+        **kwargs: Muut signaaliargumentit.
+    """
+    from .tfidf_index import remove_submission
+    remove_submission(instance)
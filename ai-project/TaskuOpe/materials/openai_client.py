@@ -0,0 +1,285 @@
+# materials/openai_client.py
+"""
+Prosessikohtainen, jaettu OpenAI-asiakas.
+
+Kaikki OpenAI-kutsut (chat, kuvat, puhe) käyttävät samaa httpx-yhteyspoolia,
+joten TLS-kättely tehdään kerran ja yhteydet pysyvät auki (keep-alive).
+Aikakatkaisut ovat operaatiokohtaisia (settings.OPENAI_TIMEOUTS) ja
+429/5xx-vastaukset sekä yhteysvirheet yritetään uudelleen eksponentiaalisella,
+satunnaistetulla viiveellä (settings.OPENAI_MAX_RETRIES, OPENAI_BACKOFF_BASE,
+OPENAI_BACKOFF_MAX).
+
+Async-näkymät (ASGI) käyttävät vastaavaa AsyncOpenAI-asiakasta acall-funktion
+kautta; httpx:n async-pooli on sidottu tapahtumasilmukkaan, joten asiakas
+luodaan silmukkakohtaisesti ja suljetaan, kun silmukka ajetaan alas.
+
+Käyttö:
+    resp = openai_client.call("chat", lambda c: c.chat.completions.create(...))
+    resp = await openai_client.acall("chat", lambda c: c.chat.completions.create(...))
+"""
+
+import asyncio
+import os
+import random
+import threading
+import time
+import weakref
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple, TypeVar
+
+from django.conf import settings
+from openai import (
+    APIConnectionError, AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient,
+    InternalServerError, OpenAI, RateLimitError,
+)
+import httpx
+
+T = TypeVar("T")
+
+# Oletusarvot, jos asetuksia ei ole määritelty
+DEFAULT_TIMEOUTS = {"chat": 60.0, "image": 120.0, "speech": 60.0}
+CONNECT_TIMEOUT = 5.0
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 20.0
+POOL_SIZE = 20
+# Async-asiakas palvelee koko ASGI-workerin samanaikaisia pyyntöjä
+ASYNC_POOL_SIZE = 100
+KEEPALIVE_EXPIRY = 30.0
+
+_CLIENT: Optional[OpenAI] = None
+_CLIENT_PID: Optional[int] = None
+_VIEWS: Dict[str, OpenAI] = {}
+_LOCK = threading.Lock()
+# Tapahtumasilmukka -> (AsyncOpenAI, operaatiokohtaiset näkymät)
+_ASYNC: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Tuple[AsyncOpenAI, Dict[str, AsyncOpenAI]]]" = (
+    weakref.WeakKeyDictionary()
+)
+# Silmukoiden sulkijatehtävät (asyncio pitää tehtävistä vain heikkoja viitteitä)
+_CLOSERS: Set["asyncio.Task[None]"] = set()
+
+
+def api_key() -> Optional[str]:
+    """Palauttaa OpenAI-avaimen ympäristöstä tai asetuksista (None, jos puuttuu)."""
+    return os.getenv("OPENAI_API_KEY") or getattr(settings, "OPENAI_API_KEY", None)
+
+
+def _timeout(operation: str) -> float:
+    timeouts = dict(DEFAULT_TIMEOUTS, **getattr(settings, "OPENAI_TIMEOUTS", {}))
+    return float(timeouts.get(operation, timeouts["chat"]))
+
+
+def _limits(pool: int) -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=pool, max_keepalive_connections=pool, keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+
+
+def get_client(operation: str = "chat") -> OpenAI:
+    """
+    Palauttaa jaetun asiakkaan operaation aikakatkaisulla.
+
+    Asiakas luodaan prosessissa kerran (myös forkatuissa gunicorn-workereissa
+    omansa, koska avoimia yhteyksiä ei voi jakaa prosessien kesken).
+    Operaatiokohtaiset näkymät (with_options) käyttävät samaa yhteyspoolia.
+    SDK:n omat uudelleenyritykset on kytketty pois; ne tehdään call-funktiossa.
+
+    Args:
+        operation (str): "chat", "image" tai "speech" (ks. settings.OPENAI_TIMEOUTS).
+
+    Returns:
+        OpenAI: Asiakas, jonka aikakatkaisu vastaa operaatiota.
+    """
+    global _CLIENT, _CLIENT_PID
+    pid = os.getpid()
+    with _LOCK:
+        if _CLIENT is None or _CLIENT_PID != pid:
+            http_client = DefaultHttpxClient(
+                limits=_limits(getattr(settings, "OPENAI_POOL_SIZE", POOL_SIZE)),
+                timeout=httpx.Timeout(_timeout("chat"), connect=CONNECT_TIMEOUT),
+            )
+            _CLIENT = OpenAI(api_key=api_key(), http_client=http_client, max_retries=0)
+            _CLIENT_PID = pid
+            _VIEWS.clear()
+        view = _VIEWS.get(operation)
+        if view is None:
+            view = _CLIENT.with_options(
+                timeout=httpx.Timeout(_timeout(operation), connect=CONNECT_TIMEOUT)
+            )
+            _VIEWS[operation] = view
+        return view
+
+
+async def _close_with_loop(loop: asyncio.AbstractEventLoop, client: AsyncOpenAI) -> None:
+    """
+    Odottaa, kunnes silmukka ajetaan alas, ja sulkee silmukan asiakkaan.
+
+    asyncio.run (ja asgirefin async_to_sync) peruu silmukan jäljellä olevat
+    tehtävät ennen sulkemista, joten yhteyspooli suljetaan vielä toimivassa
+    silmukassa eikä jää vuotamaan pyyntökohtaisten silmukoiden mukana.
+    """
+    try:
+        await loop.create_future()
+    finally:
+        with _LOCK:
+            if _ASYNC.get(loop, (None,))[0] is client:
+                del _ASYNC[loop]
+        await client.close()
+
+
+def get_async_client(operation: str = "chat") -> AsyncOpenAI:
+    """
+    Palauttaa käynnissä olevan tapahtumasilmukan jaetun AsyncOpenAI-asiakkaan.
+
+    ASGI-workerissa silmukoita on yksi, joten kaikki pyynnöt jakavat saman
+    yhteyspoolin. WSGI:n alla Django ajaa async-näkymän omassa silmukassaan,
+    jolloin pyyntö saa oman asiakkaan, joka suljetaan silmukan mukana (ks.
+    _close_with_loop).
+
+    Args:
+        operation (str): "chat", "image" tai "speech" (ks. settings.OPENAI_TIMEOUTS).
+
+    Returns:
+        AsyncOpenAI: Asiakas, jonka aikakatkaisu vastaa operaatiota.
+    """
+    loop = asyncio.get_running_loop()
+    with _LOCK:
+        entry = _ASYNC.get(loop)
+        if entry is None:
+            # Silmukat, jotka suljettiin perumatta tehtäviä, vapautetaan
+            for task in [t for t in _CLOSERS if t.get_loop().is_closed()]:
+                _CLOSERS.discard(task)
+            http_client = DefaultAsyncHttpxClient(
+                limits=_limits(getattr(settings, "OPENAI_ASYNC_POOL_SIZE", ASYNC_POOL_SIZE)),
+                timeout=httpx.Timeout(_timeout("chat"), connect=CONNECT_TIMEOUT),
+            )
+            client = AsyncOpenAI(api_key=api_key(), http_client=http_client, max_retries=0)
+            entry = _ASYNC[loop] = (client, {})
+            closer = loop.create_task(_close_with_loop(loop, client))
+            _CLOSERS.add(closer)
+            closer.add_done_callback(_CLOSERS.discard)
+        client, views = entry
+        view = views.get(operation)
+        if view is None:
+            view = views[operation] = client.with_options(
+                timeout=httpx.Timeout(_timeout(operation), connect=CONNECT_TIMEOUT)
+            )
+        return view
+
+
+def reset_client() -> None:
+    """Sulkee jaetut asiakkaat; seuraava get_client luo uuden (esim. asetusten muututtua)."""
+    global _CLIENT, _CLIENT_PID
+    with _LOCK:
+        if _CLIENT is not None and _CLIENT_PID == os.getpid():
+            _CLIENT.close()
+        _CLIENT = None
+        _CLIENT_PID = None
+        _VIEWS.clear()
+        _ASYNC.clear()
+        closers = list(_CLOSERS)
+    # Async-asiakkaat suljetaan omissa silmukoissaan
+    for task in closers:
+        try:
+            task.get_loop().call_soon_threadsafe(task.cancel)
+        except RuntimeError:  # silmukka on jo suljettu
+            _CLOSERS.discard(task)
+
+
+def _is_retryable(exc: Exception) -> bool:
+    # APITimeoutError on APIConnectionErrorin aliluokka
+    return isinstance(exc, (RateLimitError, InternalServerError, APIConnectionError))
+
+
+def _retry_after(exc: Exception) -> Optional[float]:
+    """Lukee Retry-After-otsakkeen (sekunteina), jos palvelin antoi sen."""
+    response = getattr(exc, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """
+    Laskee odotusajan ennen uusintayritystä ("full jitter").
+
+    Args:
+        attempt (int): Monesko uusintayritys (0 = ensimmäinen).
+        retry_after (Optional[float]): Palvelimen pyytämä vähimmäisodotus.
+
+    Returns:
+        float: Odotusaika sekunteina, enintään OPENAI_BACKOFF_MAX.
+    """
+    base = getattr(settings, "OPENAI_BACKOFF_BASE", BACKOFF_BASE)
+    cap = getattr(settings, "OPENAI_BACKOFF_MAX", BACKOFF_MAX)
+    delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return min(delay, cap)
+
+
+def call(operation: str, fn: Callable[[OpenAI], T], *, sleep: Callable[[float], None] = time.sleep) -> T:
+    """
+    Suorittaa fn(asiakas) ja yrittää uudelleen ohimenevien virheiden jälkeen.
+
+    Uudelleen yritetään 429- ja 5xx-vastauksilla sekä yhteys- ja
+    aikakatkaisuvirheillä; muut virheet (esim. 400, 401) nostetaan heti.
+
+    Args:
+        operation (str): Operaatio (määrää aikakatkaisun, ks. get_client).
+        fn (Callable[[OpenAI], T]): Varsinainen API-kutsu.
+        sleep (Callable[[float], None]): Odotusfunktio (testeissä korvattavissa).
+
+    Returns:
+        T: fn:n palauttama arvo.
+
+    Raises:
+        openai.OpenAIError: Viimeisen yrityksen virhe, jos kaikki epäonnistuvat.
+    """
+    retries = getattr(settings, "OPENAI_MAX_RETRIES", MAX_RETRIES)
+    client = get_client(operation)
+    for attempt in range(retries + 1):
+        try:
+            return fn(client)
+        except Exception as e:
+            if attempt >= retries or not _is_retryable(e):
+                raise
+            delay = backoff_delay(attempt, _retry_after(e))
+            print(f"OpenAI {operation}: {type(e).__name__}, uusi yritys {attempt + 1}/{retries} {delay:.1f} s kuluttua")
+            sleep(delay)
+
+
+async def acall(
+    operation: str,
+    fn: Callable[[AsyncOpenAI], Awaitable[T]],
+    *,
+    sleep: Callable[[float], Awaitable[None]] = asyncio.sleep,
+) -> T:
+    """
+    Async-versio call-funktiosta: await fn(asiakas) samoin uusintayrityksin.
+
+    Odotus ei varaa workeria, joten muut pyynnöt etenevät sillä välin.
+
+    Args:
+        operation (str): Operaatio (määrää aikakatkaisun, ks. get_async_client).
+        fn (Callable[[AsyncOpenAI], Awaitable[T]]): Varsinainen API-kutsu.
+        sleep (Callable[[float], Awaitable[None]]): Odotusfunktio (testeissä korvattavissa).
+
+    Returns:
+        T: fn:n palauttama arvo.
+
+    Raises:
+        openai.OpenAIError: Viimeisen yrityksen virhe, jos kaikki epäonnistuvat.
+    """
+    retries = getattr(settings, "OPENAI_MAX_RETRIES", MAX_RETRIES)
+    client = get_async_client(operation)
+    for attempt in range(retries + 1):
+        try:
+            return await fn(client)
+        except Exception as e:
+            if attempt >= retries or not _is_retryable(e):
+                raise
+            delay = backoff_delay(attempt, _retry_after(e))
+            print(f"OpenAI {operation}: {type(e).__name__}, uusi yritys {attempt + 1}/{retries} {delay:.1f} s kuluttua")
+            await sleep(delay)
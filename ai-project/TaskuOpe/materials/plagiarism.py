@@ -2,43 +2,39 @@
 Moduuli plagioinnin ja tekoälyn käytön analysointiin opiskelijapalautuksissa.
 
 Käyttää OpenAI GPT-mallia arvioimaan palautusten alkuperäisyyttä ja
-mahdollista tekoälyn tuottamaa sisältöä.
+mahdollista tekoälyn tuottamaa sisältöä. Paikallinen esiarvio
+(materials.plagiarism_prefilter) päättää, tarvitaanko mallia lainkaan.
 """
 
 from __future__ import annotations
 
+import hashlib
 import html
 import json
 import os
 import re
+import time
 from typing import Dict, List, Tuple
 
 from django.db import transaction
 from django.utils import timezone
 
-# --- OpenAI SDK (v1.x) ---
-try:
-    from openai import OpenAI
-except ImportError as e:
-    raise ImportError("Asenna OpenAI-kirjasto: pip install openai>=1.0.0") from e
-
-# --- Kevyt TF-IDF vain verrokkien hakuun (retrieval). Varsinaisen arvion tekee LLM. ---
-try:
-    from sklearn.feature_extraction.text import TfidfVectorizer
-    from sklearn.metrics.pairwise import cosine_similarity
-except ImportError as e:
-    raise ImportError("Asenna scikit-learn: pip install scikit-learn") from e
-
+# Kevyt TF-IDF (tfidf_index) ja MinHash vain verrokkien hakuun (retrieval). Varsinaisen arvion tekee LLM.
+from . import minhash_index, openai_client, plagiarism_prefilter, rate_limit, tfidf_index
 from .models import PlagiarismReport, Submission
 
-# Alusta OpenAI-asiakas
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 MODEL_NAME = os.getenv("OPENAI_MODEL_NAME", "gpt-4o")
 
 # Kuinka monta sisäistä verrokkia annetaan mallille luettavaksi
 TOP_K = 3
 # TF-IDF minimiraja verrokeille; alle tämän ei tarjota LLM:lle melun vähentämiseksi
 RETRIEVAL_MIN_SIM = 0.15
+# Kuinka monta lähes identtistä vastausta haetaan koko koulusta (MinHash/LSH)
+NEAR_DUPLICATE_TOP_K = 3
+
+# Verrokki: (palautus, samankaltaisuus, lähde); lähde "tfidf" (sama tehtävänanto,
+# kosini) tai "minhash" (koko koulu, arvioitu Jaccard)
+Candidate = Tuple[Submission, float, str]
 
 
 def _get_internal_candidates(new: Submission, top_k: int = TOP_K) -> List[Tuple[Submission, float]]:
@@ -46,6 +42,9 @@ def _get_internal_candidates(new: Submission, top_k: int = TOP_K) -> List[Tuple[
     Palauttaa listan (Submission, similarity) saman tehtävän aiemmista palautuksista,
     rankattuna TF-IDF kosini-samankaltaisuuden mukaan. Käytetään vain LLM:n tukiverrokeiksi.
 
+    Vertailu tehdään tehtävänannon tallennettua TF-IDF-indeksiä vasten
+    (materials.tfidf_index), joten vain uusi vastaus vektorisoidaan.
+
     Args:
         new (Submission): Uusi palautus, jota verrataan.
         top_k (int): Kuinka monta samankaltaisinta verrokkia palautetaan.
@@ -54,41 +53,42 @@ def _get_internal_candidates(new: Submission, top_k: int = TOP_K) -> List[Tuple[
         List[Tuple[Submission, float]]: Lista tupleja, joissa on palautusobjekti ja
                                          sen samankaltaisuusarvo (0.0-1.0).
     """
-    # Hae kaikki saman tehtävän aiemmat palautukset paitsi käsiteltävä palautus itse
-    qs = Submission.objects.filter(assignment=new.assignment).exclude(id=new.id)
-    past = list(qs)
-    if not past:
+    # Verrokit, joiden samankaltaisuus ylittää minimirajan, samankaltaisimmat ensin
+    ranked = tfidf_index.similar_submissions(new, top_k=top_k, min_sim=RETRIEVAL_MIN_SIM)
+    if not ranked:
         return []
+    past = {str(pk): s for pk, s in Submission.objects.select_related("student").in_bulk([pk for pk, _ in ranked]).items()}
+    return [(past[pk], sc) for pk, sc in ranked if pk in past]
+
+
+def _get_candidates(new: Submission) -> List[Candidate]:
+    """
+    Yhdistää verrokit: saman tehtävänannon TF-IDF-verrokit ja koko koulun
+    lähes identtiset vastaukset (MinHash/LSH), kukin palautus kerran.
+
+    Args:
+        new (Submission): Uusi palautus, jota verrataan.
 
-    student_text = (new.response or "").strip()
-    # Muodosta korpus TF-IDF:ää varten: uusi palautus ja kaikki aiemmat palautukset
-    corpus = [student_text] + [(p.response or "") for p in past]
-
-    # Alusta ja sovita TF-IDF-vektorisoija korpukseen
-    vec = TfidfVectorizer(strip_accents="unicode", lowercase=True, ngram_range=(1, 3), min_df=1).fit(corpus)
-    # Muunna tekstit vektoreiksi
-    X = vec.transform(corpus)
-    # Laske kosini-samankaltaisuus uuden palautuksen ja muiden välillä
-    sims = cosine_similarity(X[0], X[1:])[0]
-    # Järjestä verrokit samankaltaisuuden mukaan laskevasti
-    ranked = sorted(enumerate(sims), key=lambda t: t[1], reverse=True)
-
-    out: List[Tuple[Submission, float]] = []
-    for idx, sc in ranked[:top_k]:
-        # Lisää verrokki listaan vain, jos samankaltaisuus ylittää minimirajan
-        if sc >= RETRIEVAL_MIN_SIM:
-            out.append((past[idx], float(sc)))
+    Returns:
+        List[Candidate]: Verrokit lähteineen.
+    """
+    out: List[Candidate] = [(s, sim, "tfidf") for s, sim in _get_internal_candidates(new, top_k=TOP_K)]
+    seen = {s.pk for s, _, _ in out}
+    for s, jaccard in minhash_index.near_duplicates(new, top_k=NEAR_DUPLICATE_TOP_K):
+        if s.pk not in seen:
+            out.append((s, jaccard, "minhash"))
+            seen.add(s.pk)
     return out
 
 
-def _build_prompt_payload(sub: Submission, cands: List[Tuple[Submission, float]]) -> dict:
+def _build_prompt_payload(sub: Submission, cands: List[Candidate]) -> dict:
     """
     Muodostaa tiiviin JSON-payloadin OpenAI-mallille.
 
     Args:
         sub (Submission): Opiskelijan palautus, jota arvioidaan.
-        cands (List[Tuple[Submission, float]]): Lista sisäisistä verrokkipalautuksista
-                                                 ja niiden samankaltaisuusarvoista.
+        cands (List[Candidate]): Lista sisäisistä verrokkipalautuksista,
+                                 niiden samankaltaisuusarvoista ja lähteistä.
 
     Returns:
         dict: JSON-muotoinen sanakirja, joka lähetetään LLM:lle.
@@ -110,39 +110,36 @@ def _build_prompt_payload(sub: Submission, cands: List[Tuple[Submission, float]]
             {
                 "submission_id": str(s.id),
                 "student_hint": getattr(s.student, "username", None),
-                "similarity_hint": sim,  # TF-IDF cosine vihje mallille (vain suuntaa antava)
+                "similarity_hint": sim,  # vihje mallille (vain suuntaa antava)
+                # "tfidf" = saman tehtävän kosini, "minhash" = lähes identtinen vastaus muualta koulusta
+                "similarity_source": source,
                 "text": s.response or ""
             }
-            for s, sim in cands
+            for s, sim, source in cands
         ]
     }
 
 
-def _call_openai(payload: dict) -> dict:
-    """
-    Kutsuu GPT-4o-miniä OpenAI API:n kautta ja palauttaa parsitun JSON-vastauksen.
+SYSTEM_PROMPT = (
+    "Toimi suomalaisena akateemisen integriteetin avustajana. "
+    "Ole varovainen: yksittäinen heuristiikka ei riitä. "
+    "Palauta täsmälleen JSON-objekti ilman vapaata tekstiä ympärillä."
+)
 
-    Args:
-        payload (dict): JSON-muotoinen sanakirja, joka sisältää mallille lähetettävät tiedot.
 
-    Returns:
-        dict: Parsittu JSON-vastaus OpenAI-mallilta.
-    """
-    system = (
-        "Toimi suomalaisena akateemisen integriteetin avustajana. "
-        "Ole varovainen: yksittäinen heuristiikka ei riitä. "
-        "Palauta täsmälleen JSON-objekti ilman vapaata tekstiä ympärillä."
-    )
-    resp = client.chat.completions.create(
+def _request_kwargs(payload: dict) -> dict:
+    return dict(
         model=MODEL_NAME,
         temperature=0,
         response_format={"type": "json_object"},
         messages=[
-            {"role": "system", "content": system},
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": json.dumps(payload, ensure_ascii=False)}
         ],
     )
-    content = resp.choices[0].message.content
+
+
+def _parse_json(content: str) -> dict:
     try:
         return json.loads(content)
     except json.JSONDecodeError:
@@ -153,6 +150,27 @@ def _call_openai(payload: dict) -> dict:
         return json.loads(cleaned)
 
 
+def _call_openai(payload: dict, *, user_id: int = 0) -> dict:
+    """
+    Kutsuu GPT-4o-miniä OpenAI API:n kautta ja palauttaa parsitun JSON-vastauksen.
+
+    Args:
+        payload (dict): JSON-muotoinen sanakirja, joka sisältää mallille lähetettävät tiedot.
+        user_id (int): Opettajan ID (käyttäjäkohtainen kiintiö).
+
+    Returns:
+        dict: Parsittu JSON-vastaus OpenAI-mallilta.
+
+    Raises:
+        rate_limit.RateLimited: Jos kiintiö ei riitä aikarajassa (työjono yrittää myöhemmin uudelleen).
+    """
+    kwargs = _request_kwargs(payload)
+    tokens = rate_limit.estimate_tokens(*(m["content"] for m in kwargs["messages"]))
+    with rate_limit.limit(MODEL_NAME, tokens=tokens, user_id=user_id):
+        resp = openai_client.call("chat", lambda client: client.chat.completions.create(**kwargs))
+    return _parse_json(resp.choices[0].message.content)
+
+
 def _render_highlights_html(student_text: str, evidence: List[Dict]) -> str:
     """
     Rakentaa HTML-merkkijonon LLM:n antamista sitaateista/huomioista
@@ -185,36 +203,199 @@ def _render_highlights_html(student_text: str, evidence: List[Dict]) -> str:
     return "".join(parts)
 
 
-def analyze_plagiarism(new_submission: Submission) -> Dict[str, object]:
+def analyze_plagiarism(new_submission: Submission, *, force_llm: bool = False) -> Dict[str, object]:
     """
-    Suorittaa tekoälypohjaisen plagioinnin ja tekoälyn käytön analyysin
-    uudelle opiskelijapalautukselle.
+    Suorittaa plagioinnin ja tekoälyn käytön analyysin uudelle opiskelijapalautukselle.
+
+    Palautus arvioidaan ensin paikallisesti (materials.plagiarism_prefilter).
+    LLM-arvio pyydetään vain, jos esiarvio ylittää kynnysarvot tai opettaja
+    pyytää sitä (force_llm); muuten tulos on alustava paikallinen esiarvio.
 
     Args:
         new_submission (Submission): Uusi opiskelijapalautus, joka analysoidaan.
+        force_llm (bool): Pyydä LLM-arvio esiarviosta riippumatta.
 
     Returns:
         Dict[str, object]: Sanakirja, joka sisältää analyysin tulokset:
                            - "best_submission": Mahdollisesti plagioitu lähdepalautus (Submission-objekti).
                            - "best_score": Plagiointiriski (float 0.0-1.0).
                            - "highlight_html": HTML-muotoinen yhteenveto ja korostukset.
-                           - "notes": Lisätietoja analyysistä (esim. AI-todennäköisyys).
+                           - "method": PlagiarismReport.Method (LOCAL tai LLM).
+                           - "notes": Lisätietoja analyysistä (esim. AI-todennäköisyys, esiarvion tunnusluvut).
     """
-    student_text = (new_submission.response or "").strip()
-    if not student_text:
-        return {
-            "best_submission": None,
-            "best_score": 0.0,
-            "highlight_html": "Vastaus on tyhjä.",
-            "notes": {"reason": "empty_response"},
-        }
+    prepared = _prepare_analysis(new_submission)
+    if prepared is None:
+        return _empty_result()
+    return _run_analysis(new_submission, *prepared, force_llm=force_llm)
+
+
+def _run_analysis(new_submission: Submission, candidates: List[Candidate], payload: dict, *, force_llm: bool) -> Dict[str, object]:
+    """Paikallinen esiarvio ja tarvittaessa LLM-arvio valmiiksi haetuille verrokeille."""
+    # 2) Paikallinen esiarvio: useimmat tarkistukset päättyvät tähän
+    t0 = time.perf_counter()
+    local = plagiarism_prefilter.score(new_submission, candidates)
+    local["elapsed_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    if not (local["escalate"] or force_llm):
+        return _local_result(new_submission, local)
+
+    # 3) Pyydä arvio LLM:ltä
+    data = _call_openai(payload, user_id=new_submission.assignment.assigned_by_id or 0)
+    result = _analysis_result(new_submission, candidates, data)
+    result["notes"]["local"] = _local_notes(local)
+    return result
+
+
+def _text_hash(text: str) -> str:
+    return hashlib.sha1((text or "").encode("utf-8")).hexdigest()
+
+
+def report_hash(new_submission: Submission, candidates: List[Candidate]) -> str:
+    """
+    Laskee raportin sisältötiivisteen: vastaus, verrokkijoukko (palautukset ja
+    niiden vastaukset) ja malli. Jos mikään näistä muuttuu, tallennettu raportti
+    on vanhentunut.
+
+    Args:
+        new_submission (Submission): Tarkistettava palautus.
+        candidates (List[Candidate]): Palautuksen verrokit (ks. _get_candidates).
+
+    Returns:
+        str: SHA-256-tiiviste heksamuodossa.
+    """
+    return _hash_key(new_submission.response, [(str(s.pk), s.response, source) for s, _sim, source in candidates])
+
+
+def _hash_key(response: str, candidates: List[Tuple[str, str, str]]) -> str:
+    """report_hash verrokeille muodossa (palautuksen ID, vastaus, lähde)."""
+    key = {
+        "response": _text_hash(response),
+        "candidates": sorted([pk, _text_hash(text), source] for pk, text, source in candidates),
+        "model": MODEL_NAME,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _candidate_keys(candidates: List[Candidate]) -> List[List[str]]:
+    return sorted([str(s.pk), source] for s, _sim, source in candidates)
+
+
+def _is_current(report, key: str, *, require_llm: bool = False) -> bool:
+    if report is None or not report.content_hash or report.content_hash != key:
+        return False
+    return not (require_llm and report.is_provisional)
+
+
+def stored_report_is_current(report: PlagiarismReport, new_submission: Submission) -> bool:
+    """
+    Halpa ajantasaisuuden tarkistus arviointisivun näyttämiseen.
+
+    Vertaa raportin tiivistettä palautuksen nykyiseen vastaukseen ja
+    raportin tallennushetken verrokkien (candidate_keys) nykyisiin
+    vastauksiin yhdellä haulla. Verrokkeja ei haeta uudelleen eikä indeksiä
+    päivitetä, joten sen jälkeen ilmestyneet uudet verrokit huomataan vasta
+    tarkistusta ajettaessa (ks. report_is_current).
+
+    Args:
+        report (PlagiarismReport): Palautuksen tallennettu raportti.
+        new_submission (Submission): Raportin palautus.
+
+    Returns:
+        bool: True, jos vastaus ja tallennetut verrokit ovat ennallaan.
+    """
+    if not report.content_hash:
+        return False
+    keys = report.candidate_keys or []
+    responses = {
+        str(pk): text
+        for pk, text in Submission.objects.filter(pk__in=[pk for pk, _source in keys]).values_list("pk", "response")
+    }
+    if len(responses) < len({pk for pk, _source in keys}):
+        return False  # verrokki on poistettu
+    key = _hash_key(new_submission.response, [(pk, responses[pk], source) for pk, source in keys])
+    return report.content_hash == key
+
+
+def report_is_current(new_submission: Submission, *, require_llm: bool = False) -> bool:
+    """
+    Kertoo, vastaako tallennettu raportti palautuksen nykyistä vastausta ja verrokkeja.
+
+    Hakee verrokit uudelleen (kuten build_or_update_report); sivun
+    näyttämiseen riittää stored_report_is_current.
+
+    Args:
+        new_submission (Submission): Tarkistettava palautus.
+        require_llm (bool): Alustavaa (paikallista) raporttia ei lasketa ajantasaiseksi.
+
+    Returns:
+        bool: True, jos analyysia ei tarvitse toistaa.
+    """
+    report = PlagiarismReport.objects.filter(submission=new_submission).first()
+    if report is None or not report.content_hash:
+        return False
+    prepared = _prepare_analysis(new_submission)
+    key = report_hash(new_submission, prepared[0] if prepared else [])
+    return _is_current(report, key, require_llm=require_llm)
+
+
+def _empty_result() -> Dict[str, object]:
+    return {
+        "best_submission": None,
+        "best_score": 0.0,
+        "highlight_html": "Vastaus on tyhjä.",
+        "method": PlagiarismReport.Method.LOCAL,
+        "notes": {"reason": "empty_response"},
+    }
+
+
+def _local_notes(local: Dict[str, object]) -> Dict[str, object]:
+    best = local["best_submission"]
+    return {
+        "max_similarity": local["max_similarity"],
+        "winnowing": local["winnowing"],
+        "style_deviation": local["style_deviation"],
+        "best_submission_id": str(best.id) if best else None,
+        "escalated": local["escalate"],
+        "elapsed_ms": local["elapsed_ms"],
+    }
+
+
+def _local_result(new_submission: Submission, local: Dict[str, object]) -> Dict[str, object]:
+    """Muuntaa paikallisen esiarvion alustavan raportin kentiksi."""
+    style = local["style_deviation"]
+    html_block = [
+        "<div><strong>Paikallinen esiarvio:</strong> ei viitteitä kopioinnista. "
+        "Tekoälyarviota ei tehty; voit pyytää sen erikseen.</div>",
+        "<div><small>",
+        f"Suurin samankaltaisuus = {local['max_similarity']:.2f}, "
+        f"yhteiset sormenjäljet = {local['winnowing']:.2f}, ",
+        f"tyylipoikkeama = {style:.2f}" if style is not None else "tyylipoikkeama = — (ei vertailuaineistoa)",
+        "</small></div>",
+        '<hr><div style="white-space:pre-wrap;">',
+        (new_submission.response or "").strip(),
+        "</div>",
+    ]
+    # Alustava riski: suurempi tekstin samankaltaisuudesta ja yhteisistä jaksoista
+    return {
+        "best_submission": local["best_submission"],
+        "best_score": float(max(local["max_similarity"], local["winnowing"])),
+        "highlight_html": "".join(html_block),
+        "method": PlagiarismReport.Method.LOCAL,
+        "notes": {"local": _local_notes(local)},
+    }
 
-    # 1) Hae top-k sisäiset verrokit (vain LLM:n tueksi)
-    candidates = _get_internal_candidates(new_submission, top_k=TOP_K)
-    payload = _build_prompt_payload(new_submission, candidates)
 
-    # 2) Pyydä arvio LLM:ltä
-    data = _call_openai(payload)
+def _prepare_analysis(new_submission: Submission):
+    """Palauttaa (verrokit, LLM-payload) tai None, jos vastaus on tyhjä."""
+    if not (new_submission.response or "").strip():
+        return None
+    # 1) Hae sisäiset verrokit (vain LLM:n tueksi)
+    candidates = _get_candidates(new_submission)
+    return candidates, _build_prompt_payload(new_submission, candidates)
+
+
+def _analysis_result(new_submission: Submission, candidates: List[Candidate], data: dict) -> Dict[str, object]:
+    """Muuntaa LLM:n JSON-arvion raportin kentiksi."""
+    student_text = (new_submission.response or "").strip()
 
     # Käsittele ja rajoita LLM:n antamat arvot välille 0.0-1.0
     ai_like = float(max(0.0, min(1.0, data.get("ai_generated_likelihood", 0.0))))
@@ -249,7 +430,7 @@ def analyze_plagiarism(new_submission: Submission) -> Dict[str, object]:
         "ai_generated_likelihood": ai_like,
         "plagiarism_risk": plag_risk,
         "internal_candidates_used": [
-            {"submission_id": str(s.id), "similarity_hint": sim} for s, sim in candidates
+            {"submission_id": str(s.id), "similarity_hint": sim, "source": source} for s, sim, source in candidates
         ]
     }
 
@@ -257,24 +438,46 @@ def analyze_plagiarism(new_submission: Submission) -> Dict[str, object]:
         "best_submission": suspected,
         "best_score": plag_risk,
         "highlight_html": highlight_html,
+        "method": PlagiarismReport.Method.LLM,
         "notes": notes,
     }
 
 
-@transaction.atomic
-def build_or_update_report(new_submission: Submission) -> PlagiarismReport:
+def build_or_update_report(
+    new_submission: Submission, *, force_llm: bool = False, force: bool = False,
+) -> PlagiarismReport:
     """
     Luo tai päivittää PlagiarismReport-objektin annetulle opiskelijapalautukselle
-    analysoimalla sen sisällön.
+    analysoimalla sen sisällön. LLM-arvio tehdään transaktion ulkopuolella;
+    vain tallennus on atominen.
+
+    Jos tallennetun raportin sisältötiiviste (ks. report_hash) vastaa nykyistä
+    vastausta ja verrokkijoukkoa, raportti palautetaan sellaisenaan.
 
     Args:
         new_submission (Submission): Opiskelijan palautus, jolle raportti luodaan/päivitetään.
+        force_llm (bool): Pyydä LLM-arvio, vaikka paikallinen esiarvio ei sitä vaatisi.
+        force (bool): Analysoi uudelleen, vaikka raportti olisi ajan tasalla.
 
     Returns:
         PlagiarismReport: Luotu tai päivitetty plagiointiraportti.
     """
-    result = analyze_plagiarism(new_submission)
+    prepared = _prepare_analysis(new_submission)
+    key = report_hash(new_submission, prepared[0] if prepared else [])
+    if not force:
+        report = PlagiarismReport.objects.filter(submission=new_submission).first()
+        if _is_current(report, key, require_llm=force_llm):
+            print(f"DEBUG (plagiarism): Raportti on ajan tasalla, analyysi ohitetaan ({new_submission.pk})")
+            return report
+
+    result = _empty_result() if prepared is None else _run_analysis(new_submission, *prepared, force_llm=force_llm)
+    result["content_hash"] = key
+    result["candidate_keys"] = _candidate_keys(prepared[0]) if prepared else []
+    return _save_report(new_submission, result)
 
+
+@transaction.atomic
+def _save_report(new_submission: Submission, result: Dict[str, object]) -> PlagiarismReport:
     report, _ = PlagiarismReport.objects.select_for_update().get_or_create(
         submission=new_submission,
         defaults={
@@ -286,12 +489,10 @@ def build_or_update_report(new_submission: Submission) -> PlagiarismReport:
     report.suspected_source = result["best_submission"]
     report.score = result["best_score"]
     report.highlights = result["highlight_html"]
-    # Jos malliin on myöhemmin lisätty notes-kenttä, tallennetaan:
-    if hasattr(report, "notes"):
-        try:
-            report.notes = result["notes"]
-        except Exception: # Pyydystä tarkempi virhe, jos mahdollista
-            pass
+    report.method = result["method"]
+    report.notes = result["notes"]
+    report.content_hash = result.get("content_hash", "")
+    report.candidate_keys = result.get("candidate_keys", [])
     report.created_at = report.created_at or timezone.now()
     report.save()
-    return report
\ No newline at end of file
+    return report
@@ -0,0 +1,196 @@
+# materials/plagiarism_prefilter.py
+"""
+Paikallinen esiarvio alkuperäisyystarkistukselle ennen LLM-kutsua.
+
+Suurin osa palautuksista ei anna mitään aihetta epäilyyn, joten jokaisen
+tarkistuksen lähettäminen mallille on hidasta ja maksullista. Esiarvio
+laskee verrokeista (materials.plagiarism._get_candidates) ja oppilaan
+aiemmista palautuksista kolme tunnuslukua:
+
+- max_similarity: suurin verrokin samankaltaisuus (TF-IDF-kosini tai
+  MinHash-Jaccard).
+- winnowing: yhteisten winnowing-sormenjälkien osuus vastauksen
+  sormenjäljistä (Schleimer ym. 2003; merkkitason k-grammien tiivisteistä
+  valitaan kunkin ikkunan pienin), suurin verrokeista. Tunnistaa kopioidut
+  jaksot, vaikka muu teksti olisi muokattu.
+- style_deviation: kuinka paljon vastauksen tyyli (lauseen ja sanan
+  pituus, sanaston monipuolisuus, välimerkit) poikkeaa oppilaan aiemmista
+  palautuksista (0..1). Äkillinen tyylin muutos voi viitata ulkopuoliseen
+  lähteeseen tai tekoälyyn.
+
+LLM-arvio tehdään vain, jos jokin tunnusluku ylittää kynnyksensä
+(settings.PLAGIARISM) tai opettaja pyytää sitä erikseen.
+"""
+
+import hashlib
+import re
+import unicodedata
+from typing import Dict, Iterable, List, Optional, Sequence, Set
+
+import numpy as np
+from django.conf import settings
+
+from .models import Submission
+
+# Winnowing: k-grammin pituus (merkkiä ilman välilyöntejä) ja ikkunan koko.
+# Vähintään WINDOW + KGRAM - 1 merkin yhteinen jakso löytyy aina.
+KGRAM = 8
+WINDOW = 4
+# Tyylivertailu: montako aiempaa palautusta ja kuinka pitkistä vastauksista
+STYLE_HISTORY = 10
+STYLE_MIN_WORDS = 30
+
+# Oletuskynnykset LLM-arvioon siirtymiselle (ks. settings.PLAGIARISM)
+ESCALATE_SIMILARITY = 0.5
+ESCALATE_WINNOWING = 0.3
+ESCALATE_STYLE = 0.6
+
+_WORD_RE = re.compile(r"\w+")
+_SENTENCE_RE = re.compile(r"[.!?]+")
+_PUNCT_RE = re.compile(r"[^\w\s]")
+
+
+def _conf(name: str, default):
+    return (getattr(settings, "PLAGIARISM", None) or {}).get(name, default)
+
+
+def _normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKD", (text or "").lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return re.sub(r"[\W_]+", "", text)
+
+
+def _hash(gram: str) -> int:
+    return int.from_bytes(hashlib.blake2b(gram.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def fingerprints(text: str, k: int = KGRAM, window: int = WINDOW) -> Set[int]:
+    """
+    Laskee tekstin winnowing-sormenjäljet.
+
+    Args:
+        text (str): Vastaus.
+        k (int): k-grammin pituus merkkeinä.
+        window (int): Ikkunan koko (peräkkäisiä k-grammeja).
+
+    Returns:
+        Set[int]: Valitut k-grammien tiivisteet (tyhjä joukko tyhjälle vastaukselle).
+    """
+    norm = _normalize(text)
+    if not norm:
+        return set()
+    if len(norm) < k:
+        return {_hash(norm)}
+    hashes = [_hash(norm[i:i + k]) for i in range(len(norm) - k + 1)]
+    if len(hashes) <= window:
+        return {min(hashes)}
+    return {min(hashes[i:i + window]) for i in range(len(hashes) - window + 1)}
+
+
+def fingerprint_overlap(fp: Set[int], other: Set[int]) -> float:
+    """Osuus vastauksen sormenjäljistä, jotka löytyvät myös verrokista (0..1)."""
+    if not fp:
+        return 0.0
+    return len(fp & other) / len(fp)
+
+
+def style_features(text: str) -> Optional[np.ndarray]:
+    """
+    Laskee vastauksen yksinkertaiset tyylipiirteet.
+
+    Args:
+        text (str): Vastaus.
+
+    Returns:
+        Optional[np.ndarray]: [sanoja/lause, sanan keskipituus, eri sanojen osuus,
+        välimerkkejä/sana] tai None, jos vastaus on liian lyhyt (STYLE_MIN_WORDS).
+    """
+    words = _WORD_RE.findall((text or "").lower())
+    if len(words) < STYLE_MIN_WORDS:
+        return None
+    sentences = max(1, len([s for s in _SENTENCE_RE.split(text) if s.strip()]))
+    # Eri sanojen osuus riippuu tekstin pituudesta: verrataan samanmittaisia alkuja
+    head = words[:STYLE_MIN_WORDS]
+    return np.array([
+        len(words) / sentences,
+        sum(len(w) for w in words) / len(words),
+        len(set(head)) / len(head),
+        len(_PUNCT_RE.findall(text)) / len(words),
+    ])
+
+
+def style_deviation(text: str, history: Iterable[str]) -> Optional[float]:
+    """
+    Arvioi, kuinka paljon vastauksen tyyli poikkeaa oppilaan aiemmista vastauksista.
+
+    Poikkeama on piirteiden keskimääräinen z-luku suhteessa aiempiin
+    vastauksiin (hajonta vähintään neljännes keskiarvosta, jotta muutama
+    samankaltainen aiempi vastaus ei tee pienestäkin erosta suurta), jaettuna
+    kolmella ja rajattuna välille 0..1.
+
+    Args:
+        text (str): Vastaus.
+        history (Iterable[str]): Oppilaan aiemmat vastaukset.
+
+    Returns:
+        Optional[float]: Poikkeama 0..1 tai None, jos vertailuun ei ole riittävän pitkiä vastauksia.
+    """
+    features = style_features(text)
+    past = [f for f in (style_features(t) for t in history) if f is not None]
+    if features is None or not past:
+        return None
+    past = np.vstack(past)
+    mean = past.mean(axis=0)
+    std = np.maximum(past.std(axis=0), 0.25 * np.abs(mean) + 1e-6)
+    z = np.abs(features - mean) / std
+    return float(min(1.0, z.mean() / 3.0))
+
+
+def _history(sub: Submission) -> List[str]:
+    return list(
+        Submission.objects.filter(student_id=sub.student_id)
+        .exclude(pk=sub.pk)
+        .exclude(response="")
+        .order_by("-created_at")
+        .values_list("response", flat=True)[:STYLE_HISTORY]
+    )
+
+
+def score(sub: Submission, candidates: Sequence) -> Dict[str, object]:
+    """
+    Laskee palautuksen paikallisen esiarvion.
+
+    Args:
+        sub (Submission): Tarkistettava palautus.
+        candidates (Sequence): Verrokit (palautus, samankaltaisuus, lähde),
+            ks. materials.plagiarism.Candidate.
+
+    Returns:
+        Dict[str, object]: max_similarity, winnowing, style_deviation (None,
+        jos vertailuaineistoa ei ole), best_submission (verrokki, jolla suurin
+        sormenjälkien tai samankaltaisuuden osuma) ja escalate (ylittyikö
+        jokin kynnys).
+    """
+    fp = fingerprints(sub.response)
+    best, best_value = None, 0.0
+    max_similarity = winnowing = 0.0
+    for other, sim, _source in candidates:
+        overlap = fingerprint_overlap(fp, fingerprints(other.response))
+        max_similarity = max(max_similarity, float(sim))
+        winnowing = max(winnowing, overlap)
+        if max(sim, overlap) > best_value:
+            best, best_value = other, max(float(sim), overlap)
+    style = style_deviation(sub.response, _history(sub))
+
+    escalate = (
+        max_similarity >= _conf("ESCALATE_SIMILARITY", ESCALATE_SIMILARITY)
+        or winnowing >= _conf("ESCALATE_WINNOWING", ESCALATE_WINNOWING)
+        or (style is not None and style >= _conf("ESCALATE_STYLE", ESCALATE_STYLE))
+    )
+    return {
+        "max_similarity": max_similarity,
+        "winnowing": winnowing,
+        "style_deviation": style,
+        "best_submission": best,
+        "escalate": escalate,
+    }
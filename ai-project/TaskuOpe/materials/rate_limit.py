@@ -0,0 +1,260 @@
+# materials/rate_limit.py
+"""
+Jaettu nopeusrajoitin OpenAI-kutsuille (token bucket + samanaikaisuusraja).
+
+Kun koko luokka painaa TTS-nappia tai opettaja generoi kuvia sarjana,
+OpenAI:n minuuttirajat ylittyvät ja kaikki pyynnöt kaatuvat yhtä aikaa.
+Rajoitin jonouttaa kutsut ennen lähettämistä:
+
+- Mallikohtaiset kiintiöt: pyynnöt/min (RPM) ja tokenit/min (TPM).
+- Käyttäjäkohtaiset kiintiöt (RPM, TPM) kaikille malleille yhteensä.
+- Kutsu varaa kiintiön heti, vaikka ämpäri menisi miinukselle, ja odottaa
+  vuoroaan; näin odottajat palvellaan saapumisjärjestyksessä. Jos odotus
+  ylittäisi aikarajan (MAX_WAIT), nostetaan heti RateLimited eikä kiintiötä
+  varata.
+- Samanaikaisten kutsujen enimmäismäärä mallia kohden (CONCURRENCY) on
+  prosessikohtainen.
+
+Ämpärien tila on Djangon cachessa (alias settings.RATE_LIMITS["ALIAS"]),
+joten kaikki workerit jakavat sen, kun cache on jaettu (Redis, Memcached
+tai tietokanta-cache; oletuksena tietokanta, ks. settings.CACHES).
+Päivitykset tehdään cache.add-lukon alla.
+
+    RATE_LIMITS = {
+        "ENABLED": True,
+        "ALIAS": "default",
+        "MAX_WAIT": 20.0,       # kauanko kutsu saa enintään jonottaa (s)
+        "COMPLETION_TOKENS": 800,  # vastauksen token-arvio TPM-kiintiöön
+        "MODELS": {"gpt-4o": {"RPM": 500, "TPM": 30000, "CONCURRENCY": 20}, ...},
+        "USER": {"RPM": 30, "TPM": 60000},
+    }
+
+Käyttö:
+    with rate_limit.limit("gpt-4o", tokens=n, user_id=user.id):
+        resp = openai_client.call("chat", ...)
+    async with rate_limit.alimit("tts-1", user_id=user.id):
+        resp = await openai_client.acall("speech", ...)
+"""
+
+import asyncio
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+DEFAULT_MAX_WAIT = 20.0
+DEFAULT_COMPLETION_TOKENS = 800
+KEY_PREFIX = "ratelimit:"
+LOCK_KEY = "ratelimit-lock"
+# Lukon automaattinen vanheneminen (s), jos haltija kaatuu kesken päivityksen
+LOCK_TIMEOUT = 5
+# Kauanko lukkoa odotetaan: kaatuneen haltijan lukko ehtii vanhentua
+LOCK_WAIT = LOCK_TIMEOUT + 1.0
+POLL_INTERVAL = 0.05
+
+_SEMAPHORES: Dict[str, threading.BoundedSemaphore] = {}
+_SEM_LOCK = threading.Lock()
+
+
+class RateLimited(RuntimeError):
+    """Kiintiö ei riitä aikarajan sisällä; retry_after kertoo arvioidun odotuksen (s)."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _conf() -> dict:
+    return getattr(settings, "RATE_LIMITS", None) or {}
+
+
+def enabled() -> bool:
+    conf = _conf()
+    return bool(conf.get("ENABLED", True) and (conf.get("MODELS") or conf.get("USER")))
+
+
+def estimate_tokens(*texts: str, completion: Optional[int] = None) -> int:
+    """
+    Arvioi kutsun tokenimäärän TPM-kiintiötä varten: syöte + vastauksen arvio.
+
+    Args:
+        *texts (str): Kutsun syötetekstit (järjestelmäkehote, prompt, ...).
+        completion (Optional[int]): Vastauksen tokenit (oletus: COMPLETION_TOKENS).
+
+    Returns:
+        int: Arvioitu tokenimäärä.
+    """
+    from TaskuOpe.ops_chunks import count_tokens
+
+    if completion is None:
+        completion = int(_conf().get("COMPLETION_TOKENS", DEFAULT_COMPLETION_TOKENS))
+    return sum(count_tokens(t or "") for t in texts) + completion
+
+
+def _buckets(model: str, tokens: int, user_id: int) -> List[Tuple[str, float, float]]:
+    """Palauttaa kutsun ämpärit: (avain, kapasiteetti minuutissa, hinta)."""
+    conf = _conf()
+    out = []
+    limits = (conf.get("MODELS") or {}).get(model) or {}
+    if limits.get("RPM"):
+        out.append((f"model:{model}:rpm", float(limits["RPM"]), 1.0))
+    if limits.get("TPM") and tokens:
+        out.append((f"model:{model}:tpm", float(limits["TPM"]), float(tokens)))
+    user = conf.get("USER") or {}
+    if user_id and user.get("RPM"):
+        out.append((f"user:{user_id}:rpm", float(user["RPM"]), 1.0))
+    if user_id and user.get("TPM") and tokens:
+        out.append((f"user:{user_id}:tpm", float(user["TPM"]), float(tokens)))
+    return out
+
+
+def reserve(model: str, *, tokens: int = 0, user_id: int = 0, max_wait: Optional[float] = None) -> float:
+    """
+    Varaa kutsulle kiintiön kaikista sen ämpäreistä ja palauttaa odotusajan.
+
+    Ämpäri täyttyy tasaisesti (kapasiteetti / 60 s) ja voi mennä miinukselle:
+    jonossa olevat varaukset siirtävät myöhempien odotusta eteenpäin.
+    Kapasiteettia suurempi hinta rajataan kapasiteettiin, jotta iso pyyntö
+    ei jää odottamaan ikuisesti.
+
+    Args:
+        model (str): Mallin tunnus (settings.RATE_LIMITS["MODELS"]).
+        tokens (int): Arvioitu tokenimäärä (0 = vain RPM).
+        user_id (int): Käyttäjän ID (0 = ei käyttäjäkiintiötä).
+        max_wait (Optional[float]): Suurin sallittu odotus (oletus: MAX_WAIT).
+
+    Returns:
+        float: Kuinka monta sekuntia kutsun on odotettava ennen lähettämistä.
+
+    Raises:
+        RateLimited: Jos odotus ylittäisi max_wait tai ämpärien lukkoa ei
+            saada LOCK_WAIT sekunnissa (mitään ei varata).
+    """
+    buckets = _buckets(model, tokens, user_id)
+    if not buckets:
+        return 0.0
+    if max_wait is None:
+        max_wait = float(_conf().get("MAX_WAIT", DEFAULT_MAX_WAIT))
+    cache = caches[_conf().get("ALIAS", "default")]
+    keys = [KEY_PREFIX + key for key, _, _ in buckets]
+
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + LOCK_WAIT
+    # cache.add on atominen (Redis, Memcached, tietokanta). Ilman lukkoa ämpäreitä
+    # ei päivitetä: samanaikaiset luku-kirjoitukset päästäisivät liikaa kutsuja läpi.
+    while not cache.add(LOCK_KEY, token, timeout=LOCK_TIMEOUT):
+        if time.monotonic() >= deadline:
+            raise RateLimited("Nopeusrajoittimen lukko varattu, yritä hetken kuluttua uudelleen.", POLL_INTERVAL * 20)
+        time.sleep(POLL_INTERVAL / 5)
+    try:
+        now = time.time()
+        states = cache.get_many(keys)
+        levels = []
+        wait = 0.0
+        for key, (_, capacity, cost) in zip(keys, buckets):
+            rate = capacity / 60.0
+            level, ts = states.get(key, (capacity, now))
+            level = min(capacity, level + (now - ts) * rate)
+            cost = min(cost, capacity)
+            wait = max(wait, (cost - level) / rate)
+            levels.append(level - cost)
+        if wait > max_wait:
+            raise RateLimited(f"OpenAI-kiintiö täynnä ({model}), yritä {wait:.0f} s kuluttua uudelleen.", wait)
+        # Täysi ämpäri ei tarvitse tilaa: se vanhenee, kun täyttyminen on varmasti ohi
+        cache.set_many({key: (level, now) for key, level in zip(keys, levels)}, timeout=int(60 + max_wait) + 60)
+        return max(0.0, wait)
+    finally:
+        if cache.get(LOCK_KEY) == token:
+            cache.delete(LOCK_KEY)
+
+
+def _semaphore(model: str) -> Optional[threading.BoundedSemaphore]:
+    size = ((_conf().get("MODELS") or {}).get(model) or {}).get("CONCURRENCY")
+    if not size:
+        return None
+    with _SEM_LOCK:
+        sem = _SEMAPHORES.get(model)
+        if sem is None:
+            sem = _SEMAPHORES[model] = threading.BoundedSemaphore(int(size))
+        return sem
+
+
+@contextmanager
+def limit(
+    model: str,
+    *,
+    tokens: int = 0,
+    user_id: int = 0,
+    max_wait: Optional[float] = None,
+    sleep: Callable[[float], None] = time.sleep,
+):
+    """
+    Odottaa kiintiön ja vapaan paikan ennen lohkon suoritusta (ks. reserve).
+
+    Args:
+        model (str): Mallin tunnus.
+        tokens (int): Arvioitu tokenimäärä (ks. estimate_tokens).
+        user_id (int): Käyttäjän ID (0 = ei käyttäjäkiintiötä).
+        max_wait (Optional[float]): Suurin sallittu kokonaisodotus (oletus: MAX_WAIT).
+        sleep (Callable[[float], None]): Odotusfunktio (testeissä korvattavissa).
+
+    Raises:
+        RateLimited: Jos kiintiötä tai paikkaa ei saada aikarajassa.
+    """
+    if not enabled():
+        yield
+        return
+    if max_wait is None:
+        max_wait = float(_conf().get("MAX_WAIT", DEFAULT_MAX_WAIT))
+    wait = reserve(model, tokens=tokens, user_id=user_id, max_wait=max_wait)
+    if wait > 0:
+        sleep(wait)
+    sem = _semaphore(model)
+    if sem is not None and not sem.acquire(timeout=max(0.0, max_wait - wait)):
+        raise RateLimited(f"Liian monta samanaikaista kutsua ({model}).", 1.0)
+    try:
+        yield
+    finally:
+        if sem is not None:
+            sem.release()
+
+
+@asynccontextmanager
+async def alimit(model: str, *, tokens: int = 0, user_id: int = 0, max_wait: Optional[float] = None):
+    """
+    Async-versio limit-funktiosta: odotus ei varaa workeria.
+
+    Args:
+        model (str): Mallin tunnus.
+        tokens (int): Arvioitu tokenimäärä (ks. estimate_tokens).
+        user_id (int): Käyttäjän ID (0 = ei käyttäjäkiintiötä).
+        max_wait (Optional[float]): Suurin sallittu kokonaisodotus (oletus: MAX_WAIT).
+
+    Raises:
+        RateLimited: Jos kiintiötä tai paikkaa ei saada aikarajassa.
+    """
+    if not enabled():
+        yield
+        return
+    if max_wait is None:
+        max_wait = float(_conf().get("MAX_WAIT", DEFAULT_MAX_WAIT))
+    wait = await sync_to_async(reserve)(model, tokens=tokens, user_id=user_id, max_wait=max_wait)
+    if wait > 0:
+        await asyncio.sleep(wait)
+    sem = _semaphore(model)
+    if sem is not None:
+        deadline = time.monotonic() + max(0.0, max_wait - wait)
+        while not sem.acquire(blocking=False):
+            if time.monotonic() >= deadline:
+                raise RateLimited(f"Liian monta samanaikaista kutsua ({model}).", 1.0)
+            await asyncio.sleep(POLL_INTERVAL)
+    try:
+        yield
+    finally:
+        if sem is not None:
+            sem.release()
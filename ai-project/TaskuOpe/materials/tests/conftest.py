@@ -0,0 +1,18 @@
+import pytest
+
+
+@pytest.fixture
+def openai_key(monkeypatch):
+    """Testiavain: ilman avainta palvelut palauttavat demovastauksen eivätkä kutsu (korvattua) asiakasta."""
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    return "sk-test"
+
+
+@pytest.fixture(autouse=True)
+def locmem_cache(settings):
+    """
+    Testit ajetaan yhdessä prosessissa, joten prosessin oma cache riittää.
+    Tietokanta-cache ei toimisi säikeistä (koko luokan arviointi), koska
+    SQLite-testikanta on lukittu testin transaktion ajan.
+    """
+    settings.CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
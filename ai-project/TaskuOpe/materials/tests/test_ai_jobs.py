@@ -0,0 +1,300 @@
+import json
+import threading
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+
+import pytest
+from django.urls import reverse
+from django.utils import timezone
+
+from materials import ai_rubric, ai_service, jobs
+from materials.models import AIGrade, AIJob, Assignment, Material, Submission
+from users.models import CustomUser
+
+pytestmark = pytest.mark.usefixtures("openai_key")
+
+
+@pytest.fixture
+def submission(db):
+    teacher = CustomUser.objects.create_user(username="ope", password="x", role="TEACHER")
+    student = CustomUser.objects.create_user(username="oppilas", password="x", role="STUDENT")
+    material = Material.objects.create(title="Runo", content="Kirjoita runo syksystä.", author=teacher)
+    assignment = Assignment.objects.create(material=material, student=student, assigned_by=teacher, due_at=timezone.now())
+    return Submission.objects.create(assignment=assignment, student=student, response="Lehdet putoaa.")
+
+
+def test_enqueue_is_idempotent_per_submission(submission):
+    job, created = jobs.enqueue(AIJob.Kind.AI_GRADE, submission)
+    again, created_again = jobs.enqueue(AIJob.Kind.AI_GRADE, submission)
+    assert created and not created_again and again.pk == job.pk
+    other, created_other = jobs.enqueue(AIJob.Kind.PLAGIARISM, submission)
+    assert created_other and other.pk != job.pk
+
+    # Valmistuneen työn jälkeen voi pyytää uuden
+    AIJob.objects.filter(pk=job.pk).update(status=AIJob.Status.DONE)
+    assert jobs.enqueue(AIJob.Kind.AI_GRADE, submission)[1]
+
+
+def test_failed_jobs_are_retried_with_backoff_then_marked_failed(submission, settings, monkeypatch):
+    settings.AI_JOBS = {"MAX_ATTEMPTS": 2, "RETRY_BASE": 30.0}
+
+    def broken(job):
+        raise RuntimeError("yhteys katkesi")
+
+    monkeypatch.setitem(jobs.HANDLERS, AIJob.Kind.AI_GRADE, broken)
+    job, _ = jobs.enqueue(AIJob.Kind.AI_GRADE, submission)
+    assert jobs.work("w1", once=True) == 1
+    job.refresh_from_db()
+    assert job.status == AIJob.Status.QUEUED and job.attempts == 1
+    assert job.available_at > timezone.now() + timedelta(seconds=10)
+    assert "yhteys katkesi" in job.last_error
+    assert jobs.claim("w1") is None  # ei vielä suoritettavissa
+
+    AIJob.objects.filter(pk=job.pk).update(available_at=timezone.now())
+    jobs.work("w1", once=True)
+    job.refresh_from_db()
+    assert job.status == AIJob.Status.FAILED and job.attempts == 2 and job.finished_at
+
+
+def test_ai_grade_job_is_retried_when_the_llm_fails(submission, settings, monkeypatch):
+    settings.AI_JOBS = {"RETRY_BASE": 30.0}
+    settings.LLM_CACHE = {"BACKEND": "none"}
+    monkeypatch.setattr(ai_rubric, "_ops_context", lambda m: "")
+
+    def failing_call(operation, fn):
+        raise ai_service.rate_limit.RateLimited("Kiintiö täynnä.", 30.0)
+
+    monkeypatch.setattr(ai_service.openai_client, "call", failing_call)
+    job, _ = jobs.enqueue(AIJob.Kind.AI_GRADE, submission)
+    jobs.work("w1", once=True)
+    job.refresh_from_db()
+    assert job.status == AIJob.Status.QUEUED and job.attempts == 1 and "RateLimited" in job.last_error
+    assert not AIGrade.objects.exists()
+
+    grade = {"criteria": [{"name": "Sisältö ja ymmärrys", "points": 4, "feedback": "Hyvä"}], "general_feedback": "OK"}
+    reply = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=json.dumps(grade)))])
+    monkeypatch.setattr(ai_service.openai_client, "call", lambda operation, fn: reply)
+    AIJob.objects.filter(pk=job.pk).update(available_at=timezone.now())
+    jobs.work("w1", once=True)
+    job.refresh_from_db()
+    assert job.status == AIJob.Status.DONE and job.attempts == 2
+    assert AIGrade.objects.get(submission=submission).total_points == 4
+
+
+def test_expired_lock_returns_job_to_another_worker(submission, monkeypatch):
+    done = []
+    monkeypatch.setitem(jobs.HANDLERS, AIJob.Kind.PLAGIARISM, lambda job: done.append(job.locked_by))
+    jobs.enqueue(AIJob.Kind.PLAGIARISM, submission)
+    first = jobs.claim("w1")
+    assert first and jobs.claim("w2") is None  # lukittu
+
+    # w1 jumittuu: lukko vanhenee ja w2 ottaa työn
+    AIJob.objects.filter(pk=first.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+    second = jobs.claim("w2")
+    assert second.pk == first.pk and second.attempts == 2
+    assert jobs.run_job(second)
+    jobs.run_job(first)  # myöhästynyt w1 ei enää kirjaa tilaa
+    second.refresh_from_db()
+    assert second.status == AIJob.Status.DONE and second.locked_by.startswith("w2")
+
+
+def test_grading_page_enqueues_and_worker_completes(client, submission, monkeypatch):
+    grade = {"criteria": [{"name": "Sisältö", "points": 3, "feedback": "Hyvä"}], "general_feedback": "Jatka samaan malliin."}
+    reply = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=json.dumps(grade)))])
+    monkeypatch.setattr(ai_service.openai_client, "call", lambda operation, fn: reply)
+
+    client.login(username="ope", password="x")
+    url = reverse("grade_submission", args=[submission.id])
+    assert client.post(url, {"run_ai_grade": "1"}).status_code == 302
+    client.post(url, {"run_ai_grade": "1"})
+    job = AIJob.objects.get()
+    assert job.status == AIJob.Status.QUEUED and not AIGrade.objects.exists()
+
+    page = client.get(url).content.decode()
+    status_url = reverse("ai_job_status", args=[job.id])
+    assert status_url in page
+    assert client.get(status_url).json()["active"] is True
+
+    assert jobs.work(once=True) == 1
+    assert client.get(status_url).json() == {
+        "status": "DONE", "status_display": "Valmis", "active": False, "attempts": 1,
+        "progress": 0, "total": 0, "error": "",
+    }
+    assert AIGrade.objects.get(submission=submission).details["general_feedback"] == "Jatka samaan malliin."
+    assert status_url not in client.get(url).content.decode()
+
+
+def test_batch_grading_grades_class_in_parallel_with_progress(client, submission, settings, monkeypatch):
+    settings.AI_JOBS = {"BATCH_WORKERS": 3}
+    settings.LLM_CACHE = {"BACKEND": "none"}
+    assignment = submission.assignment
+    material = assignment.material
+    for name, response in [("o2", "Syksyllä sataa."), ("o3", "Puut ovat punaisia.")]:
+        student = CustomUser.objects.create_user(username=name, password="x", role="STUDENT")
+        a = Assignment.objects.create(material=material, student=student, assigned_by=assignment.assigned_by, due_at=timezone.now())
+        Submission.objects.create(assignment=a, student=student, response=response)
+    graded = Submission.objects.get(student__username="o3")
+    graded.graded_at = timezone.now()
+    graded.save()
+
+    ops_calls, active, peak = [], [0], [0]
+    lock = threading.Lock()
+    monkeypatch.setattr(ai_rubric, "_ops_context", lambda m: ops_calls.append(m) or "")
+
+    def fake_call(operation, fn):
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.2)
+        with lock:
+            active[0] -= 1
+        grade = {"criteria": [{"name": "Sisältö ja ymmärrys", "points": 4, "feedback": "Hyvä"}], "general_feedback": "OK"}
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=json.dumps(grade)))])
+
+    monkeypatch.setattr(ai_service.openai_client, "call", fake_call)
+
+    client.login(username="ope", password="x")
+    page = client.get(reverse("view_submissions", args=[material.id])).content.decode()
+    assert "kaikki arvioimattomat (2)" in page
+    url = reverse("grade_all_submissions", args=[material.id])
+    assert client.post(url).status_code == 302
+    client.post(url)
+    job = AIJob.objects.get()
+    assert job.kind == AIJob.Kind.BATCH_GRADE and job.material == material
+    page = client.get(reverse("view_submissions", args=[material.id])).content.decode()
+    assert reverse("ai_job_status", args=[job.id]) in page and "kaikki arvioimattomat" not in page
+
+    assert jobs.work(once=True) == 1
+    status = client.get(reverse("ai_job_status", args=[job.id])).json()
+    assert status["status"] == "DONE" and (status["progress"], status["total"]) == (2, 2)
+    assert len(ops_calls) == 1 and peak[0] == 2
+    grades = AIGrade.objects.order_by("submission__student__username")
+    assert [g.submission.student.username for g in grades] == ["o2", "oppilas"]
+    assert all(g.total_points == 4 and g.details["general_feedback"] == "OK" for g in grades)
+    assert not ai_rubric.ungraded_submissions(material).exists()
+
+
+def test_batch_grading_requeues_failed_calls_and_waits_longer(submission, settings, monkeypatch):
+    settings.AI_JOBS = {"BATCH_MAX_WAIT": 90.0, "RETRY_BASE": 30.0}
+    settings.LLM_CACHE = {"BACKEND": "none"}
+    material = submission.assignment.material
+    student = CustomUser.objects.create_user(username="o2", password="x", role="STUDENT")
+    a = Assignment.objects.create(material=material, student=student, assigned_by=material.author, due_at=timezone.now())
+    Submission.objects.create(assignment=a, student=student, response="Syksyllä sataa.")
+    monkeypatch.setattr(ai_rubric, "_ops_context", lambda m: "")
+
+    waits = []
+    real_limit = ai_service.rate_limit.limit
+
+    def recording_limit(model, **kw):
+        waits.append(kw.get("max_wait"))
+        return real_limit(model, **kw)
+
+    monkeypatch.setattr(ai_service.rate_limit, "limit", recording_limit)
+    grade = {"criteria": [{"name": "Sisältö ja ymmärrys", "points": 4, "feedback": "Hyvä"}], "general_feedback": "OK"}
+    reply = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=json.dumps(grade)))])
+
+    def flaky_call(operation, fn):
+        prompt = fn(SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=lambda **kw: kw))))["messages"][-1]["content"]
+        if "Syksyllä sataa." in prompt:
+            raise ai_service.rate_limit.RateLimited("Kiintiö täynnä.", 30.0)
+        return reply
+
+    monkeypatch.setattr(ai_service.openai_client, "call", flaky_call)
+    job, _ = jobs.enqueue(AIJob.Kind.BATCH_GRADE, material=material)
+    jobs.work("w1", once=True)
+    job.refresh_from_db()
+    assert job.status == AIJob.Status.QUEUED and job.attempts == 1
+    assert "BatchGradingIncomplete" in job.last_error and (job.progress, job.total) == (1, 2)
+    assert [g.submission.student.username for g in AIGrade.objects.all()] == ["oppilas"]
+    assert waits and set(waits) == {90.0}
+
+    # Uusi yritys arvioi vain epäonnistuneen palautuksen
+    monkeypatch.setattr(ai_service.openai_client, "call", lambda operation, fn: reply)
+    AIJob.objects.filter(pk=job.pk).update(available_at=timezone.now())
+    jobs.work("w1", once=True)
+    job.refresh_from_db()
+    assert job.status == AIJob.Status.DONE and (job.progress, job.total) == (1, 1)
+    assert AIGrade.objects.count() == 2
+
+
+def test_batch_progress_counts_only_saved_grades(submission, settings, monkeypatch):
+    settings.LLM_CACHE = {"BACKEND": "none"}
+    material = submission.assignment.material
+    for name in ("o2", "o3"):
+        student = CustomUser.objects.create_user(username=name, password="x", role="STUDENT")
+        a = Assignment.objects.create(material=material, student=student, assigned_by=material.author, due_at=timezone.now())
+        Submission.objects.create(assignment=a, student=student, response=f"Vastaus {name}.")
+    monkeypatch.setattr(ai_rubric, "_ops_context", lambda m: "")
+    monkeypatch.setattr(ai_rubric, "BATCH_WRITE_SIZE", 2)
+    grade = {"criteria": [{"name": "Sisältö ja ymmärrys", "points": 4, "feedback": "Hyvä"}], "general_feedback": "OK"}
+    reply = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=json.dumps(grade)))])
+    monkeypatch.setattr(ai_service.openai_client, "call", lambda operation, fn: reply)
+
+    reported = []
+
+    def progress(done, total):
+        reported.append(done)
+        assert done <= AIGrade.objects.count()  # ei tallentamattomia arvioita valmiina
+
+    assert ai_rubric.grade_submissions_batch(material, workers=1, progress=progress) == 3
+    assert reported[0] == 0 and reported[-1] == 3 and 1 not in reported
+
+
+def test_unchanged_submission_is_not_regraded_unless_forced(client, submission, settings, monkeypatch):
+    settings.LLM_CACHE = {"BACKEND": "none"}
+    calls = []
+    grade = {"criteria": [{"name": "Sisältö ja ymmärrys", "points": 4, "feedback": "Hyvä"}], "general_feedback": "OK"}
+    reply = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=json.dumps(grade)))])
+    monkeypatch.setattr(ai_service.openai_client, "call", lambda operation, fn: calls.append(operation) or reply)
+    monkeypatch.setattr(ai_rubric, "_ops_context", lambda m: "")
+
+    first = ai_rubric.create_or_update_ai_grade(submission)
+    assert ai_rubric.create_or_update_ai_grade(submission).pk == first.pk and len(calls) == 1
+    assert ai_rubric.ai_grade_is_current(submission)
+
+    # Sivulta: ajan tasalla olevaa ei lisätä jonoon, pakotettu lisätään
+    client.login(username="ope", password="x")
+    url = reverse("grade_submission", args=[submission.id])
+    client.post(url, {"run_ai_grade": "1"})
+    assert not AIJob.objects.exists()
+    client.post(url, {"run_ai_grade": "1", "force": "1"})
+    assert AIJob.objects.get().force
+    jobs.work(once=True)
+    assert len(calls) == 2
+
+    # Kriteerin muutos vanhentaa arvion
+    criterion = first.rubric.criteria.first()
+    criterion.max_points = 10
+    criterion.save()
+    assert not ai_rubric.ai_grade_is_current(submission)
+    ai_rubric.create_or_update_ai_grade(submission)
+    assert len(calls) == 3
+
+
+def test_demo_and_unparsed_grades_are_not_memoized(submission, settings, monkeypatch):
+    settings.LLM_CACHE = {"BACKEND": "none"}
+    monkeypatch.setattr(ai_rubric, "_ops_context", lambda m: "")
+
+    # Demotila (ei API-avainta): arvio tallennetaan, mutta ei ajan tasalla olevana
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    settings.OPENAI_API_KEY = None
+    demo = ai_rubric.create_or_update_ai_grade(submission)
+    assert demo.content_hash == "" and not ai_rubric.ai_grade_is_current(submission)
+
+    # Epäonnistunut kutsu ei tallenna mitään; vanha demoarvio jää muistamatta
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    monkeypatch.setattr(ai_service.openai_client, "call", lambda operation, fn: (_ for _ in ()).throw(RuntimeError("500")))
+    with pytest.raises(RuntimeError):
+        ai_rubric.create_or_update_ai_grade(submission)
+    assert AIGrade.objects.get().content_hash == ""
+
+    # Parsimaton vastaus (0 pistettä) ei myöskään ole ajan tasalla: seuraava kutsu kysyy mallilta uudelleen
+    calls = []
+    reply = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="En osaa arvioida."))])
+    monkeypatch.setattr(ai_service.openai_client, "call", lambda operation, fn: calls.append(operation) or reply)
+    assert ai_rubric.create_or_update_ai_grade(submission).content_hash == ""
+    assert not ai_rubric.ai_grade_is_current(submission)
+    ai_rubric.create_or_update_ai_grade(submission)
+    assert len(calls) == 2
@@ -0,0 +1,109 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.urls import reverse
+
+from materials import ai_service
+from users.models import CustomUser
+
+pytestmark = pytest.mark.usefixtures("openai_key")
+
+
+def _parse(body):
+    out = []
+    for block in body.strip().split("\n\n"):
+        event, data = block.split("\n")
+        out.append((event.removeprefix("event: "), json.loads(data.removeprefix("data: "))["text"]))
+    return out
+
+
+async def _aevents(resp):
+    return _parse(b"".join([part async for part in resp.streaming_content]).decode("utf-8"))
+
+
+def _chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+
+def _fake_acall(pieces, prompts, gate=None):
+    """Korvaa openai_client.acall: palauttaa async-virran, joka odottaa gatea ensimmäisen palan jälkeen."""
+    async def stream():
+        for n, piece in enumerate(pieces):
+            if n == 1 and gate is not None:
+                await gate.wait()
+            yield _chunk(piece)
+
+    async def acall(operation, fn):
+        captured = {}
+
+        async def create(**kw):
+            captured.update(kw)
+            return stream()
+        result = await fn(SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create))))
+        prompts.append(captured["messages"][-1]["content"])
+        assert captured["stream"] is True
+        return result
+    return acall
+
+
+@pytest.mark.django_db
+def test_stream_forwards_tokens_and_caches_result(async_client, settings, tmp_path, monkeypatch):
+    settings.LLM_CACHE = {"BACKEND": "sqlite", "PATH": str(tmp_path / "llm.sqlite3")}
+    CustomUser.objects.create_user(username="ope", password="x", role="TEACHER")
+    pieces = ["Otsikkoehdotus: Murtoluvut\n", "Tavoitteet:\n1) ...\n\n", "Luonnosteksti:\n- Jaa pizza."]
+    prompts = []
+    monkeypatch.setattr(ai_service.openai_client, "acall", _fake_acall(pieces, prompts))
+    url = reverse("ai_stream")
+    data = {"ai_prompt": "Murtoluvut", "use_ops": "on", "ops_subject": "Matematiikka", "ops_grade": "3-6"}
+
+    async def run():
+        await async_client.alogin(username="ope", password="x")
+        resp = await async_client.post(url, data)
+        assert resp["Content-Type"] == "text/event-stream" and resp.is_async
+        events = await _aevents(resp)
+        assert [e for e, _ in events] == ["delta", "delta", "delta", "done"]
+        assert events[-1][1] == "".join(pieces)
+        assert "OPS-KONTEKSTI" in prompts[0] and "Murtoluvut" in prompts[0]
+
+        # Sama pyyntö välimuistista yhtenä tapahtumana, regenerate ohittaa sen
+        assert await _aevents(await async_client.post(url, data)) == [("done", "".join(pieces))]
+        assert len(prompts) == 1
+        await _aevents(await async_client.post(url, dict(data, regenerate="1")))
+        assert len(prompts) == 2
+
+    async_to_sync(run)()
+
+
+@pytest.mark.django_db
+def test_stream_sends_each_token_before_the_reply_is_complete(async_client, settings, tmp_path, monkeypatch):
+    settings.LLM_CACHE = {"BACKEND": "sqlite", "PATH": str(tmp_path / "llm.sqlite3")}
+    CustomUser.objects.create_user(username="ope", password="x", role="TEACHER")
+
+    async def run():
+        # Malli lähettää loput tokenit vasta, kun ensimmäinen on välitetty asiakkaalle;
+        # puskuroiva vastaus jäisi odottamaan eikä ensimmäistä tapahtumaa tulisi.
+        gate = asyncio.Event()
+        monkeypatch.setattr(ai_service.openai_client, "acall", _fake_acall(["Otsikkoehdotus: A\n", "Luonnosteksti:\n- B"], [], gate))
+        await async_client.alogin(username="ope", password="x")
+        resp = await async_client.post(reverse("ai_stream"), {"ai_prompt": "Murtoluvut"})
+        body = aiter(resp.streaming_content)
+        first = await asyncio.wait_for(anext(body), timeout=5)
+        assert _parse(first.decode("utf-8")) == [("delta", "Otsikkoehdotus: A\n")]
+        gate.set()
+        rest = b"".join([part async for part in body]).decode("utf-8")
+        assert [e for e, _ in _parse(rest)] == ["delta", "done"]
+
+    async_to_sync(run)()
+
+
+@pytest.mark.django_db
+def test_stream_requires_teacher_and_prompt(client):
+    CustomUser.objects.create_user(username="oppilas", password="x", role="STUDENT")
+    CustomUser.objects.create_user(username="ope", password="x", role="TEACHER")
+    client.login(username="oppilas", password="x")
+    assert client.post(reverse("ai_stream"), {"ai_prompt": "x"}).status_code == 403
+    client.login(username="ope", password="x")
+    assert client.post(reverse("ai_stream"), {"ai_prompt": " "}).status_code == 400
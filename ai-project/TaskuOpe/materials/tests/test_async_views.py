@@ -0,0 +1,123 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+from django.urls import reverse
+from django.utils import timezone
+
+from materials import openai_client
+from materials.models import Assignment, Material
+from users.models import CustomUser
+
+pytestmark = pytest.mark.usefixtures("openai_key")
+
+
+def _fake_acall(respond, calls):
+    """Korvaa openai_client.acall: vastaus saadaan respond(operation, kwargs)-kutsulla."""
+    async def acall(operation, fn):
+        async def create(**kw):
+            calls.append((operation, kw))
+            return await respond(operation, kw)
+        fake = SimpleNamespace(
+            chat=SimpleNamespace(completions=SimpleNamespace(create=create)),
+            audio=SimpleNamespace(speech=SimpleNamespace(create=create)),
+        )
+        return await fn(fake)
+    return acall
+
+
+def _chat(content):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+def _in_order(replies):
+    async def respond(operation, kw):
+        return replies.pop(0)
+    return respond
+
+
+def _game_responder(delay=0.0, metadata_delay=None, metadata_error=None):
+    """Vastaa pelisisältö- ja metadatakutsuihin (metadatakutsussa on temperature)."""
+    async def respond(operation, kw):
+        if "temperature" in kw:
+            await asyncio.sleep(delay if metadata_delay is None else metadata_delay)
+            if metadata_error:
+                raise metadata_error
+            return _chat(json.dumps({"title": "Laskupeli", "subject": "Matematiikka"}))
+        await asyncio.sleep(delay)
+        return _chat(json.dumps({"questions": [{"question": "1+1?", "options": ["2", "3"], "answer": "2"}]}))
+    return respond
+
+
+@pytest.mark.django_db
+def test_generate_game_view_awaits_async_client(client, settings, tmp_path, monkeypatch):
+    settings.LLM_CACHE = {"BACKEND": "sqlite", "PATH": str(tmp_path / "llm.sqlite3")}
+    CustomUser.objects.create_user(username="ope", password="x", role="TEACHER")
+    client.login(username="ope", password="x")
+    calls = []
+    monkeypatch.setattr(openai_client, "acall", _fake_acall(_game_responder(), calls))
+
+    url = reverse("generate_game_ajax")
+    body = json.dumps({"topic": "Yhteenlasku", "game_type": "quiz", "difficulty": "easy"})
+    resp = client.post(url, body, content_type="application/json")
+    assert resp.status_code == 200
+    data = resp.json()
+    assert data["game_data"]["questions"][0]["answer"] == "2"
+    assert data["metadata"] == {"title": "Laskupeli", "subject": "Matematiikka"}
+    assert len(calls) == 2
+
+    # Toistettu pyyntö tulee välimuistista
+    assert client.post(url, body, content_type="application/json").json() == data
+    assert len(calls) == 2
+
+
+@pytest.mark.django_db
+def test_game_content_and_metadata_run_concurrently(client, settings, monkeypatch):
+    settings.LLM_CACHE = {"BACKEND": "none"}
+    CustomUser.objects.create_user(username="ope", password="x", role="TEACHER")
+    client.login(username="ope", password="x")
+    url = reverse("generate_game_ajax")
+    body = json.dumps({"topic": "Yhteenlasku", "game_type": "quiz"})
+
+    monkeypatch.setattr(openai_client, "acall", _fake_acall(_game_responder(delay=0.5), []))
+    t0 = time.perf_counter()
+    data = client.post(url, body, content_type="application/json").json()
+    assert time.perf_counter() - t0 < 0.9  # kaksi 0,5 s kutsua rinnakkain
+    assert data["metadata"]["subject"] == "Matematiikka"
+
+    # Metadatan virhe tai aikarajan ylitys -> oletusmetadata, peli palautetaan silti
+    fallback = {"title": "Quiz: Yhteenlasku", "subject": "Ympäristöoppi"}
+    monkeypatch.setattr(openai_client, "acall", _fake_acall(_game_responder(metadata_error=RuntimeError("x")), []))
+    data = client.post(url, body, content_type="application/json").json()
+    assert data["success"] and data["metadata"] == fallback
+
+    settings.GAME_GENERATION_DEADLINE = 0.2
+    monkeypatch.setattr(openai_client, "acall", _fake_acall(_game_responder(metadata_delay=5), []))
+    t0 = time.perf_counter()
+    data = client.post(url, body, content_type="application/json").json()
+    assert time.perf_counter() - t0 < 1.0
+    assert data["game_data"]["questions"] and data["metadata"] == fallback
+
+    # Pelisisältö ei valmistu aikarajassa -> 504
+    monkeypatch.setattr(openai_client, "acall", _fake_acall(_game_responder(delay=5), []))
+    assert client.post(url, body, content_type="application/json").status_code == 504
+
+
+@pytest.mark.django_db
+def test_tts_view_runs_async(client, monkeypatch):
+    teacher = CustomUser.objects.create_user(username="ope", password="x", role="TEACHER")
+    student = CustomUser.objects.create_user(username="oppilas", password="x", role="STUDENT")
+    material = Material.objects.create(title="Runo", content="Kirjoita runo syksystä.", author=teacher)
+    assignment = Assignment.objects.create(material=material, student=student, assigned_by=teacher, due_at=timezone.now())
+    calls = []
+    monkeypatch.setattr(openai_client, "acall", _fake_acall(_in_order([SimpleNamespace(content=b"mp3")]), calls))
+
+    client.login(username="oppilas", password="x")
+    resp = client.post(reverse("assignment_tts", args=[assignment.id]))
+    assert resp.status_code == 200 and resp.content == b"mp3"
+    assert calls[0][0] == "speech" and calls[0][1]["input"] == "Kirjoita runo syksystä."
+
+    client.login(username="ope", password="x")
+    assert client.post(reverse("assignment_tts", args=[assignment.id])).status_code == 403
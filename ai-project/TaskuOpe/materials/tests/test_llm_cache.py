@@ -0,0 +1,128 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from materials import ai_service, llm_cache
+from materials.models import Prompt
+from users.models import CustomUser
+
+pytestmark = pytest.mark.usefixtures("openai_key")
+
+
+def test_sqlite_backend_expires_and_evicts_least_recently_used(tmp_path, monkeypatch):
+    backend = llm_cache.SQLiteBackend(str(tmp_path / "c.sqlite3"), ttl=60, max_entries=2)
+    clock = [1000.0]
+    monkeypatch.setattr(llm_cache.time, "time", lambda: clock[0])
+    backend.set("a", {"x": 1})
+    clock[0] += 1
+    backend.set("b", "kaksi")
+    clock[0] += 1
+    assert backend.get("a") == {"x": 1}  # a käytetty viimeksi -> b vanhin
+    clock[0] += 1
+    backend.set("c", "kolme")
+    assert backend.get("b") is None and backend.get("a") == {"x": 1}
+    clock[0] += 120
+    assert backend.get("a") is None
+
+
+def test_cache_key_depends_on_all_request_parts():
+    base = llm_cache.cache_key("gpt-4o", "sys", "kehote", 0.7)
+    assert base == llm_cache.cache_key("gpt-4o", "sys", "kehote", 0.7)
+    assert len({
+        base,
+        llm_cache.cache_key("gpt-4o-mini", "sys", "kehote", 0.7),
+        llm_cache.cache_key("gpt-4o", "toinen", "kehote", 0.7),
+        llm_cache.cache_key("gpt-4o", "sys", "kehote", 0.2),
+        llm_cache.cache_key("gpt-4o", "sys", "kehote", 0.7, response_format="json_object"),
+    }) == 5
+
+
+@pytest.mark.django_db
+def test_ask_llm_serves_repeats_from_cache_and_records_hits(settings, tmp_path, monkeypatch):
+    settings.LLM_CACHE = {"BACKEND": "sqlite", "PATH": str(tmp_path / "llm.sqlite3")}
+    teacher = CustomUser.objects.create_user(username="ope", password="x", role="TEACHER")
+    calls = []
+
+    def fake_call(operation, fn):
+        calls.append(operation)
+        text = f"Otsikkoehdotus: Murtoluvut {len(calls)}\nTavoitteet:\n1) ...\n\nLuonnosteksti:\n- ..."
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))])
+
+    monkeypatch.setattr(ai_service.openai_client, "call", fake_call)
+    first = ai_service.ask_llm("Murtoluvut 4. luokalle", user_id=teacher.id)
+    assert ai_service.ask_llm("Murtoluvut 4. luokalle", user_id=teacher.id) == first
+    assert len(calls) == 1
+    prompt = Prompt.objects.get()
+    assert prompt.cache_hits == 1 and prompt.last_hit_at is not None
+
+    regenerated = ai_service.ask_llm("Murtoluvut 4. luokalle", user_id=teacher.id, regenerate=True)
+    assert regenerated != first and len(calls) == 2
+    # Uusi vastaus korvaa välimuistin sisällön
+    assert ai_service.ask_llm("Murtoluvut 4. luokalle", user_id=teacher.id) == regenerated
+    assert Prompt.objects.count() == 2
+    assert Prompt.objects.order_by("-created_at").first().cache_hits == 1
+
+
+def test_concurrent_identical_calls_share_one_upstream_call(settings, tmp_path):
+    settings.LLM_CACHE = {"BACKEND": "sqlite", "PATH": str(tmp_path / "llm.sqlite3")}
+    release = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        release.wait(5)
+        return "vastaus"
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda b=b: results.append(llm_cache.cached("k", slow, bypass=b)))
+        for b in (False, False, True, False)
+    ]
+    for t in threads:
+        t.start()
+    while not calls:
+        time.sleep(0.01)
+    time.sleep(0.3)  # muut säikeet ehtivät liittyä käynnissä olevaan kutsuun
+    release.set()
+    for t in threads:
+        t.join(5)
+    assert len(calls) == 1
+    assert sorted(results) == [("vastaus", False)] + [("vastaus", True)] * 3
+
+
+def test_waits_for_lock_held_by_another_worker(settings, tmp_path, monkeypatch):
+    settings.LLM_CACHE = {"BACKEND": "sqlite", "PATH": str(tmp_path / "llm.sqlite3")}
+    monkeypatch.setattr(llm_cache, "POLL_INTERVAL", 0.01)
+    # Toinen worker (oma yhteys samaan tiedostoon) pitää lukkoa
+    other = llm_cache.SQLiteBackend(str(tmp_path / "llm.sqlite3"))
+    assert other.acquire("k", "muu", 60)
+
+    result = []
+    t = threading.Thread(target=lambda: result.append(llm_cache.cached("k", lambda: pytest.fail("ei omaa kutsua"))))
+    t.start()
+    other.set("k", "toisen vastaus")
+    other.release("k", "muu")
+    t.join(5)
+    assert result == [("toisen vastaus", True)]
+
+
+def test_acached_shares_one_call_within_event_loop(settings, tmp_path):
+    settings.LLM_CACHE = {"BACKEND": "sqlite", "PATH": str(tmp_path / "llm.sqlite3")}
+    calls = []
+
+    async def slow():
+        calls.append(1)
+        await asyncio.sleep(0.2)
+        return "vastaus"
+
+    async def run():
+        first = await asyncio.gather(*(llm_cache.acached("k", slow, bypass=b) for b in (False, True, False)))
+        return first, await llm_cache.acached("k", slow)
+
+    results, again = asyncio.run(run())
+    assert len(calls) == 1
+    assert sorted(results) == [("vastaus", False)] + [("vastaus", True)] * 2
+    assert again == ("vastaus", True)
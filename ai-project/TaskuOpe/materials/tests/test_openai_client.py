@@ -0,0 +1,105 @@
+import asyncio
+
+import httpx
+import openai
+import pytest
+
+from materials import openai_client
+
+pytestmark = pytest.mark.usefixtures("openai_key")
+
+
+def _error(cls, status, headers=None):
+    response = httpx.Response(status, headers=headers or {}, request=httpx.Request("POST", "https://api.openai.com/v1/x"))
+    return cls("virhe", response=response, body=None)
+
+
+@pytest.fixture(autouse=True)
+def fresh_client(settings):
+    settings.OPENAI_MAX_RETRIES = 3
+    openai_client.reset_client()
+    yield
+    openai_client.reset_client()
+
+
+def test_client_is_shared_per_operation():
+    chat = openai_client.get_client("chat")
+    assert openai_client.get_client("chat") is chat
+    image = openai_client.get_client("image")
+    assert image is not chat and image._client is chat._client  # sama yhteyspooli
+    assert chat.max_retries == 0
+
+
+def test_call_retries_rate_limits_and_server_errors():
+    errors = [_error(openai.RateLimitError, 429, {"retry-after": "2"}), _error(openai.InternalServerError, 503)]
+    delays = []
+
+    def fn(client):
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    assert openai_client.call("chat", fn, sleep=delays.append) == "ok"
+    assert len(delays) == 2 and delays[0] >= 2.0
+
+
+def test_call_does_not_retry_client_errors_and_gives_up(settings):
+    calls = []
+
+    def bad_request(client):
+        calls.append(1)
+        raise _error(openai.BadRequestError, 400)
+
+    with pytest.raises(openai.BadRequestError):
+        openai_client.call("chat", bad_request, sleep=lambda d: None)
+    assert len(calls) == 1
+
+    settings.OPENAI_MAX_RETRIES = 2
+    calls.clear()
+
+    def overloaded(client):
+        calls.append(1)
+        raise _error(openai.RateLimitError, 429)
+
+    with pytest.raises(openai.RateLimitError):
+        openai_client.call("chat", overloaded, sleep=lambda d: None)
+    assert len(calls) == 3
+
+
+def test_backoff_is_capped(settings):
+    settings.OPENAI_BACKOFF_MAX = 1.5
+    assert all(0 <= openai_client.backoff_delay(n) <= 1.5 for n in range(10))
+    assert openai_client.backoff_delay(0, retry_after=60) == 1.5
+
+
+def test_acall_retries_and_shares_client_within_event_loop():
+    errors = [_error(openai.RateLimitError, 429), _error(openai.InternalServerError, 503)]
+    delays, clients = [], []
+
+    async def fn(client):
+        clients.append(client)
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+
+    async def run():
+        return await openai_client.acall("chat", fn, sleep=fake_sleep)
+
+    assert asyncio.run(run()) == "ok"
+    assert len(delays) == 2
+    assert clients[0] is clients[-1] and clients[0].max_retries == 0
+
+
+def test_async_client_is_per_loop_and_closed_with_its_loop():
+    async def get():
+        return openai_client.get_async_client("chat"), openai_client.get_async_client("image")
+
+    chat, image = asyncio.run(get())
+    assert image._client is chat._client  # sama yhteyspooli silmukan sisällä
+    assert chat.is_closed() and len(openai_client._ASYNC) == 0 and not openai_client._CLOSERS
+
+    other, _ = asyncio.run(get())
+    assert other is not chat and other.is_closed()
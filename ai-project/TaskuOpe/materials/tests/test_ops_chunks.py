@@ -0,0 +1,246 @@
+import os
+import threading
+
+import pytest
+from django.urls import reverse
+
+from TaskuOpe import ops_chunks
+
+
+def _full_scan(query, k=8):
+    rows = ops_chunks._read_rows()
+    q_tokens = ops_chunks._tokenize(query)
+    scored = [(ops_chunks._score(q_tokens, r), i) for i, r in enumerate(rows)]
+    scored = [(s, i) for s, i in scored if s > 0]
+    scored.sort(key=lambda x: (-x[0], x[1]))
+    return [rows[i]["id"] for _, i in scored[:k]]
+
+
+def test_inverted_index_matches_full_scan():
+    for query in ["murtoluvut", "historia lähteet", "lukutaito ja kirjallisuus", "vesi"]:
+        got = [c["id"] for c in ops_chunks.retrieve_chunks(query, k=8)]
+        assert got == _full_scan(query)
+
+
+def test_postings_only_contain_matching_rows():
+    ops_chunks._load_data()
+    rows = ops_chunks._read_rows()
+    plist = ops_chunks._state().postings.get("historia")
+    assert plist
+    assert len(plist) == sum(1 for r in rows if "historia" in r["_tf"])
+    for doc_id, tf in plist:
+        assert rows[doc_id]["_tf"]["historia"] == tf
+
+
+def test_bm25_scorer_ranks_by_score():
+    results = ops_chunks.retrieve_chunks("murtoluvun lukujen", k=5, scorer="bm25")
+    assert results
+    scores = [c["score"] for c in results]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_unknown_scorer_is_rejected():
+    with pytest.raises(ValueError):
+        ops_chunks.retrieve_chunks("historia", scorer="nope")
+
+
+def test_negative_k_returns_no_chunks(client):
+    assert ops_chunks.retrieve_chunks("", k=-1) == []
+    assert ops_chunks.retrieve_chunks("historia", k=-1) == []
+    assert ops_chunks.retrieve_chunks_many(["", "historia"], k=-1) == [[], []]
+    resp = client.get(reverse("ops_search"), {"q": "", "k": "-1"})
+    assert resp.status_code == 200
+
+
+def test_facet_filters_and_counts():
+    results = ops_chunks.retrieve_chunks("oppilas", k=50, subjects=["historia"], grades=["3-6"])
+    assert results and all(c["subject"] == "Historia" and c["grade_context"] == "3-6" for c in results)
+
+    facets = ops_chunks.get_facets("oppilas", grades=["3-6"])
+    expected = sum(
+        1 for r in ops_chunks._read_rows()
+        if r["subject"] == "Historia" and r["grade_context"] == "3-6" and "oppilas" in r["_tf"]
+    )
+    assert facets["counts"]["subjects"]["Historia"] == expected
+    assert facets["subjects"] == ops_chunks.get_facets()["subjects"]
+
+
+@pytest.mark.skipif(not ops_chunks._HAS_SPARSE, reason="numpy puuttuu")
+@pytest.mark.parametrize("analyzer", ops_chunks.ANALYZERS)
+@pytest.mark.parametrize("scorer", ops_chunks.SCORERS)
+def test_sparse_engine_matches_posting_walk(scorer, analyzer):
+    for query in ["oppilas ja opettaja", "luku", "historia lähteet", "oppilas"]:
+        for kwargs in ({}, {"grades": ["1-2"]}, {"subjects": ["Matematiikka"], "ctypes": ["Tavoite"]}):
+            kwargs["analyzer"] = analyzer
+            walk = ops_chunks.retrieve_chunks(query, k=3, scorer=scorer, engine="python", **kwargs)
+            vec = ops_chunks.retrieve_chunks(query, k=3, scorer=scorer, engine="sparse", **kwargs)
+            assert [c["id"] for c in vec] == [c["id"] for c in walk]
+            assert [c["score"] for c in vec] == pytest.approx([c["score"] for c in walk])
+
+
+def test_finnish_analyzer_matches_inflected_forms():
+    def ids(query, analyzer):
+        return {c["id"] for c in ops_chunks.retrieve_chunks(query, k=1000, analyzer=analyzer)}
+
+    forms = ["murtoluvut", "murtoluvun", "murtolukujen", "murtoluvuilla"]
+    union = set().union(*(ids(q, "plain") for q in forms))
+    assert union and all(ids(q, "finnish") == ids(forms[0], "finnish") for q in forms)
+    assert union <= ids("murtoluvut", "finnish")
+
+    # Yhdyssanan osa löytää myös yhdyssanan ("yhteistyötaitoja" -> "tait")
+    assert "tait" in ops_chunks._analyze("yhteistyötaitoja", "finnish")
+    assert ids("yhteistyötaitoja", "plain") <= ids("taidot", "finnish")
+
+
+def test_unknown_analyzer_is_rejected():
+    with pytest.raises(ValueError):
+        ops_chunks.retrieve_chunks("historia", analyzer="nope")
+
+
+def test_retrieve_cache_hits_and_returns_copies():
+    ops_chunks.clear_retrieve_cache()
+    first = ops_chunks.retrieve_chunks("Historia  lähteet", k=3, subjects=["Historia"])
+    first[0]["text"] = "muutettu"
+    again = ops_chunks.retrieve_chunks("historia lähteet", k=3, subjects=[" historia"])
+    info = ops_chunks.retrieve_cache_info()
+    assert (info["hits"], info["misses"]) == (1, 1)
+    assert again == ops_chunks.retrieve_chunks("historia lähteet", k=3, subjects=["Historia"], cache=False)
+    assert again[0]["text"] != "muutettu"
+
+    ops_chunks._load_data(force=True)
+    assert ops_chunks.retrieve_cache_info()["size"] == 0
+
+
+BATCH_QUERIES = ["murtoluvut", "historia lähteet", "", "vesi", "murtoluvut", "xyzzy", "lukutaito ja kirjallisuus"]
+
+
+@pytest.mark.parametrize("engine", ["python", "sparse", "auto"])
+@pytest.mark.parametrize("scorer", ["tf", "bm25"])
+def test_retrieve_many_matches_single_queries(engine, scorer):
+    if engine == "sparse" and not ops_chunks._HAS_SPARSE:
+        pytest.skip("numpy puuttuu")
+    for opts in ({}, {"grades": ["3-6"], "analyzer": "finnish"}):
+        got = ops_chunks.retrieve_chunks_many(BATCH_QUERIES, k=5, scorer=scorer, engine=engine, **opts)
+        expected = [
+            ops_chunks.retrieve_chunks(q, k=5, scorer=scorer, engine=engine, cache=False, **opts)
+            for q in BATCH_QUERIES
+        ]
+        assert [[c["id"] for c in r] for r in got] == [[c["id"] for c in r] for r in expected]
+        for g, e in zip(got, expected):
+            assert [c.get("score") for c in g] == pytest.approx([c.get("score") for c in e])
+
+
+def test_batch_search_endpoint(client):
+    url = reverse("ops_search_batch")
+    resp = client.post(url, {"queries": ["historia", "murtoluvut"], "k": 2}, content_type="application/json")
+    assert resp.status_code == 200
+    results = resp.json()["results"]
+    assert [[c["id"] for c in r] for r in results] == [
+        [c["id"] for c in ops_chunks.retrieve_chunks(q, k=2)] for q in ["historia", "murtoluvut"]
+    ]
+    assert client.post(url, {"queries": "historia"}, content_type="application/json").status_code == 400
+    assert client.post(url, {"queries": [], "scorer": "x"}, content_type="application/json").status_code == 400
+    for bad in ({"subject": "Matematiikka"}, {"grade": 5}, {"ctype": ["ok", 1]}, {"scorer": ["tf"]}):
+        assert client.post(url, dict(bad, queries=["historia"]), content_type="application/json").status_code == 400
+    resp = client.post(url, {"queries": ["historia"], "k": -3, "subject": ["Historia"]}, content_type="application/json")
+    assert resp.status_code == 200 and resp.json()["results"] == [[]]
+
+
+@pytest.fixture
+def mapped_index(settings, tmp_path):
+    settings.OPS_INDEX_PATH = str(tmp_path / "ops.idx")
+    ops_chunks.build_index_file()
+    ops_chunks._load_data(force=True)
+    yield settings.OPS_INDEX_PATH
+    del settings.OPS_INDEX_PATH
+    ops_chunks._load_data(force=True)
+
+
+def test_mapped_index_matches_json_build(mapped_index):
+    queries = ["oppilas ja opettaja", "historia lähteet", "murtoluvun lukujen", "ei-löydy-termiä"]
+    from_index = {
+        (q, sc, an): ops_chunks.retrieve_chunks(q, k=5, scorer=sc, grades=["3-6"], analyzer=an)
+        for q in queries for sc in ops_chunks.SCORERS for an in ops_chunks.ANALYZERS
+    }
+    empty = ops_chunks.retrieve_chunks("", k=5, subjects=["Historia"])
+    facets = ops_chunks.get_facets("oppilas", grades=["1-2"])
+    assert ops_chunks._state().source == mapped_index
+
+    os.remove(mapped_index)
+    ops_chunks._load_data(force=True)
+    assert ops_chunks._state().source == "json"
+    for (q, sc, an), results in from_index.items():
+        assert ops_chunks.retrieve_chunks(q, k=5, scorer=sc, grades=["3-6"], analyzer=an) == results
+    assert ops_chunks.retrieve_chunks("", k=5, subjects=["Historia"]) == empty
+    assert ops_chunks.get_facets("oppilas", grades=["1-2"]) == facets
+
+
+def test_stale_index_is_ignored(mapped_index):
+    with open(mapped_index, "r+b") as f:
+        f.write(b"XXXXXXXX")  # rikottu tiedosto -> ladataan JSONista
+    ops_chunks._load_data(force=True)
+    assert ops_chunks._state().source == "json"
+    assert ops_chunks.retrieve_chunks("historia", k=1)
+
+
+def test_refresh_swaps_in_new_state_atomically(settings, tmp_path):
+    old = ops_chunks._state()
+    before = ops_chunks.retrieve_chunks("historia", k=3, cache=False)
+    assert ops_chunks._refresh() is False  # tiedostot ennallaan -> ei uudelleenlatausta
+    assert any(t.name == "ops-reload" for t in threading.enumerate())
+
+    settings.OPS_INDEX_PATH = str(tmp_path / "ops.idx")
+    ops_chunks.build_index_file()
+    try:
+        assert ops_chunks._refresh() is True
+        new = ops_chunks._state()
+        assert new is not old and new.source == settings.OPS_INDEX_PATH
+        # Vanha olio pysyy ehjänä pyynnöille, jotka ehtivät ottaa sen käyttöön
+        assert old.rows[0]["id"] == new.rows[0]["id"]
+        assert ops_chunks.retrieve_chunks("historia", k=3, cache=False) == before
+    finally:
+        del settings.OPS_INDEX_PATH
+        ops_chunks._load_data(force=True)
+
+
+def test_jsonl_reload_reparses_only_changed_subjects(settings, tmp_path):
+    import json
+
+    with open(os.path.join(settings.BASE_DIR, "ops_data", ops_chunks.JSON_FILENAME), encoding="utf-8") as f:
+        raw = json.load(f)
+    path = tmp_path / ops_chunks.JSONL_FILENAME
+    path.write_text("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in raw), encoding="utf-8")
+    before = ops_chunks.retrieve_chunks("historia lähteet", k=8, cache=False)
+
+    settings.OPS_DATA_PATH = str(path)
+    settings.OPS_INDEX_PATH = str(tmp_path / "missing.idx")
+    try:
+        ops_chunks._load_data(force=True)
+        assert ops_chunks.retrieve_chunks("historia lähteet", k=8, cache=False) == before
+
+        i = next(i for i, r in enumerate(raw) if (r.get("subject") or "").strip() == "Historia")
+        raw[i] = dict(raw[i], content="Zeppeliinit ja ilmalaivat historiassa.")
+        path.write_text("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in raw), encoding="utf-8")
+        ops_chunks._load_data(force=True)
+        assert ops_chunks._state().reparsed == ["Historia"]
+        assert [c["id"] for c in ops_chunks.retrieve_chunks("zeppeliinit", cache=False)] == [f"ops-{i}"]
+    finally:
+        del settings.OPS_DATA_PATH
+        del settings.OPS_INDEX_PATH
+        ops_chunks._load_data(force=True)
+
+
+def test_pack_chunks_keeps_whole_chunks_within_budget():
+    from materials.ai_service import _prompt_within_budget
+
+    chunks = ops_chunks.retrieve_chunks("historia lähteet", k=8, scorer="bm25")
+    budget = ops_chunks.count_tokens(ops_chunks.format_for_llm(chunks[:3])) + 2
+    packed = ops_chunks.pack_chunks(list(reversed(chunks)), budget)
+    assert packed and packed[0] == chunks[0]  # pistejärjestys, ei syötteen järjestys
+    context = ops_chunks.format_for_llm(packed)
+    assert ops_chunks.count_tokens(context) <= budget
+    assert all(c["text"] in context for c in packed)  # ei katkaistuja chunkkeja
+
+    question = "Laadi tehtävä lähdekritiikistä."
+    prompt, used = _prompt_within_budget(question, chunks, max_prompt_tokens=10)
+    assert used == [] and question in prompt
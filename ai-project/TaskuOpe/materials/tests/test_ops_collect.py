@@ -0,0 +1,91 @@
+import asyncio
+import importlib.util
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from django.conf import settings
+
+pytest.importorskip("httpx")
+
+SUBJECTS = [
+    {"id": 1, "nimi": {"fi": "Historia"}},
+    {"id": 2, "nimi": {"fi": "Liikunta"}},  # ei KEEP_SUBJECTS-listalla
+]
+DETAIL = {
+    "vuosiluokkakokonaisuudet": [{
+        "nimi": {"fi": "Vuosiluokat 3-6"},
+        "tavoitteet": [{"tavoite": {"fi": "Oppilas tutustuu historiallisiin lähteisiin."}}],
+        "sisaltoalueet": [{"kuvaus": {"fi": "Esihistoria ja varhaiset kulttuurit."}}],
+    }],
+}
+
+
+def _load_collector():
+    path = os.path.join(settings.BASE_DIR, "ops_data", "collect_ops_data_API_toimiva.py")
+    spec = importlib.util.spec_from_file_location("collect_ops_data", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def standin_server():
+    """Paikallinen ePerusteet-korvike ETag-tuella; kirjaa vastauskoodit."""
+    log = []
+    bodies = {"/api/oppiaineet": SUBJECTS, "/api/oppiaineet/1": DETAIL}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = bodies.get(self.path)
+            if body is None:
+                log.append(404); self.send_response(404); self.end_headers(); return
+            payload = json.dumps(body).encode("utf-8")
+            etag = f'"{hash(payload)}"'
+            if self.headers.get("If-None-Match") == etag:
+                log.append(304); self.send_response(304); self.end_headers(); return
+            log.append(200)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/api", log
+    server.shutdown()
+    server.server_close()
+
+
+def test_collector_uses_conditional_requests_and_offline_cache(standin_server, tmp_path):
+    collector = _load_collector()
+    base_url, log = standin_server
+    cache_dir = str(tmp_path / "cache")
+
+    rows, statuses = asyncio.run(collector.collect_async(base_url=base_url, cache_dir=cache_dir))
+    assert statuses == {"Historia": "fetched"}
+    assert {r["content_type"] for r in rows} == {"Tavoite", "Keskeinen sisältö"}
+    assert all(r["subject"] == "Historia" and r["grade_context"] == "3-6" for r in rows)
+    assert log == [200, 200]
+
+    output = str(tmp_path / "ops.jsonl")
+    assert collector.write_jsonl(rows, output) == ["Historia"]
+    with open(output, encoding="utf-8") as f:
+        assert [json.loads(line) for line in f] == rows
+
+    log.clear()
+    again, statuses = asyncio.run(collector.collect_async(base_url=base_url, cache_dir=cache_dir))
+    assert statuses == {"Historia": "not-modified"} and log == [304, 304]
+    assert again == rows and collector.write_jsonl(again, output) == []
+
+    log.clear()
+    offline, statuses = asyncio.run(collector.collect_async(base_url=base_url, cache_dir=cache_dir, offline=True))
+    assert offline == rows and statuses == {"Historia": "offline"} and log == []
@@ -0,0 +1,241 @@
+import random
+import time
+from collections import Counter
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
+
+from materials import class_similarity, minhash_index, plagiarism, plagiarism_prefilter, tfidf_index
+from materials.models import (
+    Assignment, ClassSimilarity, Material, MinHashBand, PlagiarismReport, Submission, TfidfTerm, TfidfVector,
+)
+from users.models import CustomUser
+
+ANSWERS = [
+    "Syksyllä lehdet putoavat puista ja ilma viilenee.",
+    "Syksyllä lehdet putoavat puista ja päivät lyhenevät.",
+    "Kesällä uidaan järvessä ja syödään jäätelöä.",
+    "",
+]
+
+
+@pytest.fixture
+def submissions(db):
+    teacher = CustomUser.objects.create_user(username="ope", password="x", role="TEACHER")
+    material = Material.objects.create(title="Syksy", content="Kirjoita syksystä.", author=teacher)
+    subs = []
+    for i, text in enumerate(ANSWERS):
+        student = CustomUser.objects.create_user(username=f"o{i}", password="x", role="STUDENT")
+        assignment = Assignment.objects.create(material=material, student=student, assigned_by=teacher, due_at=timezone.now())
+        subs.append(Submission.objects.create(assignment=assignment, student=student, response=text))
+    return subs
+
+
+def _same_assignment(subs):
+    # Kaikki palautukset samaan tehtävänantoon (verrokit haetaan tehtävänannon sisältä)
+    assignment = subs[0].assignment
+    Submission.objects.filter(pk__in=[s.pk for s in subs]).update(assignment=assignment)
+    subs = [Submission.objects.get(pk=s.pk) for s in subs]
+    for s in subs:
+        tfidf_index.index_submission(s)  # update() ohitti signaalit
+    return subs
+
+
+def test_index_matches_full_tfidf_refit(submissions):
+    subs = _same_assignment(submissions)
+    new = subs[0]
+    corpus = [s.response for s in subs]
+    vec = TfidfVectorizer(strip_accents="unicode", lowercase=True, ngram_range=(1, 3), min_df=1).fit(corpus)
+    X = vec.transform(corpus)
+    expected = {str(s.pk): sc for s, sc in zip(subs[1:], cosine_similarity(X[0], X[1:])[0])}
+
+    got = tfidf_index.similar_submissions(new, top_k=10)
+    assert len(got) == 3 and got[0][0] == str(subs[1].pk)
+    for pk, sc in got:
+        assert sc == pytest.approx(expected[pk])
+
+    cands = plagiarism._get_internal_candidates(new)
+    assert [s.pk for s, _ in cands] == [subs[1].pk]  # muut alle RETRIEVAL_MIN_SIM
+
+
+def test_saves_update_index_incrementally(submissions, monkeypatch):
+    subs = _same_assignment(submissions)
+    analyzed = []
+    real = tfidf_index._ANALYZER
+    monkeypatch.setattr(tfidf_index, "_ANALYZER", lambda text: analyzed.append(text) or real(text))
+
+    # Tarkistus ja muuttumattoman vastauksen tallennus eivät kirjoita indeksiin
+    with CaptureQueriesContext(connection) as ctx:
+        plagiarism._get_internal_candidates(subs[0])
+        subs[1].save()
+    assert analyzed == []
+    assert not [q for q in ctx.captured_queries if "tfidf" in q["sql"] and not q["sql"].startswith("SELECT")]
+
+    # Muuttunut vastaus vektorisoidaan tallennettaessa
+    subs[2].response = subs[0].response
+    subs[2].save()
+    assert analyzed == [subs[0].response]
+    assert tfidf_index.similar_submissions(subs[0], top_k=1)[0] == (str(subs[2].pk), pytest.approx(1.0))
+
+    subs[2].delete()
+    assert not TfidfVector.objects.filter(submission_id=subs[2].pk).exists()
+    assert TfidfVector.objects.filter(assignment=subs[0].assignment).count() == 3
+    assert min(TfidfTerm.objects.values_list("doc_freq", flat=True)) >= 0
+
+    # Dokumenttifrekvenssit vastaavat jäljelle jääneitä vastauksia
+    expected = Counter(t for s in (subs[0], subs[1], subs[3]) for t in set(real(s.response)))
+    stored = dict(TfidfTerm.objects.filter(assignment=subs[0].assignment, doc_freq__gt=0).values_list("term", "doc_freq"))
+    assert stored == dict(expected)
+
+
+def test_minhash_finds_near_duplicates_across_materials(submissions, monkeypatch):
+    teacher = submissions[0].assignment.assigned_by
+    other = Material.objects.create(title="Syksy 2", content="Rinnakkaisluokka.", author=teacher)
+    student = CustomUser.objects.create_user(username="rinnakkais", password="x", role="STUDENT")
+    assignment = Assignment.objects.create(material=other, student=student, assigned_by=teacher, due_at=timezone.now())
+    copy = Submission.objects.create(
+        assignment=assignment, student=student,
+        response="Syksyllä lehdet putoavat puista, ja ilma viilenee!",
+    )
+    assert MinHashBand.objects.filter(submission=copy).count() == minhash_index.BANDS
+
+    found = minhash_index.near_duplicates(copy)
+    assert found[0][0] == submissions[0] and found[0][1] > 0.8
+    assert submissions[2] not in [s for s, _ in found]
+
+    seen = {}
+
+    def fake_call(payload, *, user_id=0):
+        seen["payload"] = payload
+        return {"plagiarism_risk": 0.9, "suspected_sources": [{"submission_id": str(submissions[0].id)}]}
+
+    monkeypatch.setattr(plagiarism, "_call_openai", fake_call)
+    report = plagiarism.build_or_update_report(copy)
+    sources = {c["submission_id"]: c["similarity_source"] for c in seen["payload"]["internal_candidates"]}
+    assert sources[str(submissions[0].id)] == "minhash"
+    assert report.suspected_source == submissions[0] and report.score == 0.9
+
+
+def test_unsuspicious_answer_is_checked_locally_until_teacher_asks(submissions, monkeypatch):
+    calls = []
+
+    def fake_call(payload, *, user_id=0):
+        calls.append(payload)
+        return {"plagiarism_risk": 0.1, "ai_generated_likelihood": 0.2}
+
+    monkeypatch.setattr(plagiarism, "_call_openai", fake_call)
+    report = plagiarism.build_or_update_report(submissions[2])
+    assert calls == [] and report.is_provisional
+    assert report.score == 0.0 and report.notes["local"]["escalated"] is False
+
+    report = plagiarism.build_or_update_report(submissions[2], force_llm=True)
+    assert len(calls) == 1 and report.method == PlagiarismReport.Method.LLM
+    assert report.notes["plagiarism_risk"] == 0.1 and "local" in report.notes
+
+
+def test_winnowing_and_style_signals():
+    original = "Fotosynteesissä kasvi sitoo auringon valon energiaa ja tuottaa sokeria sekä happea."
+    padded = "Minun mielestäni tämä on tärkeää. " + original + " Siksi metsät ovat arvokkaita."
+    fp = plagiarism_prefilter.fingerprints(original)
+    assert plagiarism_prefilter.fingerprint_overlap(fp, plagiarism_prefilter.fingerprints(padded)) == 1.0
+    assert plagiarism_prefilter.fingerprint_overlap(fp, plagiarism_prefilter.fingerprints(ANSWERS[2])) == 0.0
+
+    casual = " ".join(["mä tykkään syksystä koska on kivaa ja lehdet on värikkäitä."] * 4)
+    formal = " ".join([
+        "Syksyn vuodenaikaan liittyvät ilmiöt, kuten lehtivihreän hajoaminen ja karotenoidien "
+        "näkyminen, ilmentävät kasvien fysiologista sopeutumista lyhenevään valoisaan aikaan;"
+    ] * 3)
+    assert plagiarism_prefilter.style_deviation(casual, [casual, casual]) == 0.0
+    assert plagiarism_prefilter.style_deviation(formal, [casual, casual]) > plagiarism_prefilter.ESCALATE_STYLE
+    assert plagiarism_prefilter.style_deviation("Liian lyhyt.", [casual]) is None
+
+
+def test_class_similarity_clusters_copies_and_stores_reports(client, submissions):
+    material = submissions[0].assignment.material
+    student = CustomUser.objects.create_user(username="kopioija", password="x", role="STUDENT")
+    assignment = Assignment.objects.create(material=material, student=student, assigned_by=material.author, due_at=timezone.now())
+    copy = Submission.objects.create(assignment=assignment, student=student, response=ANSWERS[0] + " Niin.")
+    PlagiarismReport.objects.create(submission=submissions[2], score=0.4, method=PlagiarismReport.Method.LLM)
+    PlagiarismReport.objects.create(
+        submission=submissions[1], score=0.2, method=PlagiarismReport.Method.LOCAL,
+        notes={"local": {"winnowing": 0.1}}, content_hash="esiarvio",
+    )
+
+    client.login(username="ope", password="x")
+    resp = client.post(reverse("class_similarity", args=[material.id]))
+    assert resp.status_code == 302
+
+    heatmap = ClassSimilarity.objects.get(material=material).heatmap
+    labels = [label["submission_id"] for label in heatmap["labels"]]
+    assert [[labels[i] for i in c] for c in heatmap["clusters"]] == [[str(submissions[0].pk), str(copy.pk)]]
+    assert all(i < j and v >= class_similarity.HEATMAP_MIN_SIM for i, j, v in heatmap["cells"])
+
+    report = PlagiarismReport.objects.get(submission=copy)
+    assert report.is_provisional and report.suspected_source == submissions[0] and report.score > 0.8
+    assert PlagiarismReport.objects.get(submission=submissions[0]).suspected_source is None
+    assert PlagiarismReport.objects.get(submission=submissions[2]).score == 0.4  # tekoälyarvio säilyy
+    prefilter = PlagiarismReport.objects.get(submission=submissions[1])  # esiarvio säilyy
+    assert prefilter.score == 0.2 and prefilter.content_hash == "esiarvio" and "class_similarity" not in prefilter.notes
+    assert report.content_hash == ""
+
+    # Uusi vertailu päivittää omat raporttinsa
+    copy.response = ANSWERS[2]
+    copy.save()
+    client.post(reverse("class_similarity", args=[material.id]))
+    report = PlagiarismReport.objects.get(submission=copy)
+    assert report.suspected_source == submissions[2] and report.notes["class_similarity"]["cluster_size"] == 2
+    assert PlagiarismReport.objects.get(submission=submissions[2]).score == 0.4
+    assert not PlagiarismReport.objects.filter(submission=submissions[3]).exists()  # tyhjä vastaus
+
+    page = client.get(reverse("view_submissions", args=[material.id]))
+    assert b'id="similarity-data"' in page.content
+
+
+def test_class_similarity_scales_to_a_few_hundred_submissions():
+    rng = random.Random(7)
+    words = [f"sana{i}" for i in range(2000)]
+    texts = [" ".join(rng.choice(words) for _ in range(150)) for _ in range(300)]
+    texts[10] = texts[200] = texts[5]
+    t0 = time.perf_counter()
+    S = class_similarity.similarity_matrix(texts)
+    clusters = class_similarity.near_duplicate_clusters(S)
+    assert time.perf_counter() - t0 < 1.0
+    assert clusters == [[5, 10, 200]]
+
+
+def test_report_is_reused_until_response_or_candidates_change(client, submissions, monkeypatch):
+    subs = _same_assignment(submissions)
+    calls = []
+
+    def fake_call(payload, *, user_id=0):
+        calls.append(payload)
+        return {"plagiarism_risk": 0.7}
+
+    monkeypatch.setattr(plagiarism, "_call_openai", fake_call)
+    report = plagiarism.build_or_update_report(subs[0], force_llm=True)
+    assert plagiarism.build_or_update_report(subs[0]).pk == report.pk and len(calls) == 1
+    assert plagiarism.report_is_current(subs[0], require_llm=True)
+    plagiarism.build_or_update_report(subs[0], force_llm=True, force=True)
+    assert len(calls) == 2
+
+    # Arviointisivu tarkistaa ajantasaisuuden hakematta verrokkeja uudelleen
+    client.login(username="ope", password="x")
+    url = reverse("grade_submission", args=[subs[0].id])
+    real_prepare = plagiarism._prepare_analysis
+    monkeypatch.setattr(plagiarism, "_prepare_analysis", lambda sub: pytest.fail("GET haki verrokit"))
+    assert b'id="force-plagiarism"' in client.get(url).content
+    monkeypatch.setattr(plagiarism, "_prepare_analysis", real_prepare)
+
+    # Verrokin vastaus muuttuu: raportti vanhenee ja lasketaan uudelleen
+    subs[1].response = "Syksyllä lehdet putoavat puista ja ilma viilenee nopeasti."
+    subs[1].save()
+    report = PlagiarismReport.objects.get(submission=subs[0])
+    assert not plagiarism.stored_report_is_current(report, subs[0])
+    assert not plagiarism.report_is_current(subs[0])
+    plagiarism.build_or_update_report(subs[0])
+    assert len(calls) == 3
@@ -0,0 +1,86 @@
+from types import SimpleNamespace
+
+import pytest
+from django.core.cache import cache
+from django.urls import reverse
+from django.utils import timezone
+
+from materials import openai_client, rate_limit
+from materials.models import Assignment, Material
+from users.models import CustomUser
+
+pytestmark = pytest.mark.usefixtures("openai_key")
+
+
+@pytest.fixture
+def limits(db, settings):
+    cache.clear()
+    settings.RATE_LIMITS = {"MAX_WAIT": 60.0, "MODELS": {"m": {"RPM": 2, "TPM": 1000}}, "USER": {"RPM": 1}}
+    return settings.RATE_LIMITS
+
+
+def test_bucket_queues_within_deadline_and_rejects_beyond(limits):
+    assert rate_limit.reserve("m") == 0
+    assert rate_limit.reserve("m") == 0
+    # Ämpäri tyhjä: seuraava jonottaa (2/min -> 30 s), sitä seuraava vielä pidempään
+    assert rate_limit.reserve("m") == pytest.approx(30, abs=1)
+    with pytest.raises(rate_limit.RateLimited) as exc:
+        rate_limit.reserve("m", max_wait=40)
+    assert exc.value.retry_after == pytest.approx(60, abs=1)
+    # Hylätty pyyntö ei kuluttanut kiintiötä
+    assert rate_limit.reserve("m") == pytest.approx(60, abs=1)
+
+
+def test_user_and_token_quotas(limits):
+    assert rate_limit.reserve("m", user_id=1) == 0
+    with pytest.raises(rate_limit.RateLimited):
+        rate_limit.reserve("m", user_id=1, max_wait=0)
+    assert rate_limit.reserve("m", user_id=2, max_wait=0) == 0
+
+    # Kapasiteettia suurempi pyyntö rajataan kapasiteettiin (ei jää jumiin)
+    cache.clear()
+    assert rate_limit.reserve("m", tokens=5000) == 0
+    assert rate_limit.reserve("m", tokens=500) == pytest.approx(30, abs=1)
+
+
+def test_reserve_never_updates_buckets_without_the_lock(limits, monkeypatch):
+    monkeypatch.setattr(rate_limit, "LOCK_WAIT", 0.1)
+    assert cache.add(rate_limit.LOCK_KEY, "toinen-worker")
+    with pytest.raises(rate_limit.RateLimited):
+        rate_limit.reserve("m")
+    cache.delete(rate_limit.LOCK_KEY)
+    # Hylätty yritys ei kuluttanut kiintiötä
+    assert rate_limit.reserve("m") == 0 and rate_limit.reserve("m") == 0
+
+
+def test_limit_sleeps_for_reserved_wait_and_caps_concurrency(limits):
+    limits["MODELS"]["c"] = {"RPM": 1, "CONCURRENCY": 1}
+    sleeps = []
+    with rate_limit.limit("c", sleep=sleeps.append):
+        with pytest.raises(rate_limit.RateLimited):
+            # Paikka on varattu; toinen kutsu ehtii jonottaa vain jäljellä olevan ajan
+            with rate_limit.limit("c", sleep=sleeps.append, max_wait=60.1):
+                pass
+    assert sleeps[0] == pytest.approx(60, abs=1)
+
+
+@pytest.mark.django_db
+def test_tts_view_returns_429_when_user_quota_is_used(client, limits, monkeypatch):
+    limits["MAX_WAIT"] = 0
+    teacher = CustomUser.objects.create_user(username="ope", password="x", role="TEACHER")
+    student = CustomUser.objects.create_user(username="oppilas", password="x", role="STUDENT")
+    material = Material.objects.create(title="Runo", content="Kirjoita runo syksystä.", author=teacher)
+    assignment = Assignment.objects.create(material=material, student=student, assigned_by=teacher, due_at=timezone.now())
+    calls = []
+
+    async def acall(operation, fn):
+        calls.append(operation)
+        return SimpleNamespace(content=b"mp3")
+
+    monkeypatch.setattr(openai_client, "acall", acall)
+    client.login(username="oppilas", password="x")
+    url = reverse("assignment_tts", args=[assignment.id])
+    assert client.post(url).status_code == 200
+    resp = client.post(url)
+    assert resp.status_code == 429 and int(resp["Retry-After"]) >= 1
+    assert calls == ["speech"]
@@ -0,0 +1,175 @@
+# materials/tfidf_index.py
+"""
+Inkrementaalinen, tietokantaan tallennettu TF-IDF-indeksi tehtävänannon
+palautuksille (plagiointiverrokkien haku).
+
+Aiemmin jokainen tarkistus sovitti uuden TfidfVectorizerin (1–3-grammit)
+kaikkiin tehtävänannon palautuksiin, eli 30 oppilaan luokan tarkistaminen
+yksi kerrallaan vektorisoi korpuksen 30 kertaa. Nyt palautuksen
+termifrekvenssit lasketaan kerran tallennuksen yhteydessä (post_save)
+palautuksen omalle TfidfVector-riville, ja tehtävänannon termien
+dokumenttifrekvenssit ovat TfidfTerm-riveillä. Muuttunut vastaus päivittää
+vain oman vektorinsa ja lisättyjen tai poistuneiden termien laskurit
+(F()-lausekkeilla); muuttumaton vastaus (esim. automaattitallennus) ei
+kirjoita mitään. Haku laskee IDF-painot tallennetuista frekvensseistä ja
+tekee yhden harvan matriisitulon; tulokset vastaavat koko korpukseen
+sovitettua TfidfVectorizeria (smooth_idf, l2-normitus).
+
+Vanhat palautukset indeksoidaan komennolla: python manage.py build_tfidf_index
+"""
+
+import hashlib
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+from django.db import transaction
+from django.db.models import F
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.preprocessing import normalize
+
+from .models import Submission, TfidfTerm, TfidfVector
+
+# Sama esikäsittely kuin aiemmassa, joka kerta sovitetussa TfidfVectorizerissa
+_ANALYZER = TfidfVectorizer(strip_accents="unicode", lowercase=True, ngram_range=(1, 3)).build_analyzer()
+
+
+def _response_hash(text: str) -> str:
+    return hashlib.sha1((text or "").encode("utf-8")).hexdigest()
+
+
+def _term_ids(assignment_id, terms: List[str]) -> Dict[str, int]:
+    """Palauttaa termien TfidfTerm-ID:t ja luo puuttuvat rivit."""
+    ids = dict(TfidfTerm.objects.filter(assignment_id=assignment_id, term__in=terms).values_list("term", "pk"))
+    missing = [t for t in terms if t not in ids]
+    if missing:
+        # ignore_conflicts: samanaikainen tallennus on voinut luoda saman termin
+        TfidfTerm.objects.bulk_create(
+            [TfidfTerm(assignment_id=assignment_id, term=t) for t in missing], ignore_conflicts=True,
+        )
+        ids.update(TfidfTerm.objects.filter(assignment_id=assignment_id, term__in=missing).values_list("term", "pk"))
+    return ids
+
+
+def _bump(term_ids: Iterable[int], delta: int) -> None:
+    term_ids = list(term_ids)
+    if term_ids:
+        TfidfTerm.objects.filter(pk__in=term_ids).update(doc_freq=F("doc_freq") + delta)
+
+
+def index_submission(sub: Submission) -> None:
+    """
+    Lisää tai päivittää palautuksen tehtävänantonsa TF-IDF-indeksiin.
+
+    Muuttumaton vastaus tunnistetaan tiivisteestä yhdellä haulla ilman
+    lukitusta tai kirjoitusta. Muuten vastaus vektorisoidaan ja vain
+    palautuksen oma vektoririvi lukitaan; dokumenttifrekvenssit päivitetään
+    erotuksena vanhaan vektoriin. Virhe ei kaada palautuksen tallennusta,
+    koska palautus voidaan indeksoida myöhemmin uudelleen.
+
+    Args:
+        sub (Submission): Tallennettu palautus.
+    """
+    response_hash = _response_hash(sub.response)
+    try:
+        if TfidfVector.objects.filter(
+            submission_id=sub.pk, assignment_id=sub.assignment_id, response_hash=response_hash,
+        ).exists():
+            return
+        counts = Counter(_ANALYZER(sub.response or ""))
+        with transaction.atomic():
+            old = TfidfVector.objects.select_for_update().filter(submission_id=sub.pk).first()
+            if old is not None and old.assignment_id == sub.assignment_id and old.response_hash == response_hash:
+                return  # samanaikainen tallennus ehti ensin
+            ids = _term_ids(sub.assignment_id, list(counts))
+            new_terms = set(ids.values())
+            if old is not None and old.assignment_id == sub.assignment_id:
+                old_terms = set(old.terms)
+                _bump(old_terms - new_terms, -1)
+                _bump(new_terms - old_terms, 1)
+            else:
+                if old is not None:
+                    _bump(old.terms, -1)  # palautus siirretty toiseen tehtävänantoon
+                _bump(new_terms, 1)
+            TfidfVector.objects.update_or_create(
+                submission_id=sub.pk,
+                defaults={
+                    "assignment_id": sub.assignment_id,
+                    "response_hash": response_hash,
+                    "terms": [ids[t] for t in counts],
+                    "counts": list(counts.values()),
+                },
+            )
+    except Exception as e:
+        print(f"DEBUG (tfidf_index): Indeksin päivitys epäonnistui ({sub.pk}): {e}")
+
+
+def remove_submission(sub: Submission) -> None:
+    """
+    Poistaa palautuksen tehtävänantonsa TF-IDF-indeksistä.
+
+    Args:
+        sub (Submission): Poistettava palautus.
+    """
+    try:
+        with transaction.atomic():
+            vector = TfidfVector.objects.select_for_update().filter(submission_id=sub.pk).first()
+            if vector is not None:
+                _bump(vector.terms, -1)
+                vector.delete()
+    except Exception as e:
+        print(f"DEBUG (tfidf_index): Indeksin päivitys epäonnistui ({sub.pk}): {e}")
+
+
+def _tfidf_rows(vectors: List[Tuple[List[int], List[int]]], doc_freq: Dict[int, int]) -> csr_matrix:
+    """Palauttaa dokumenttien l2-normitetut TF-IDF-rivit."""
+    column = {term_id: col for col, term_id in enumerate(doc_freq)}
+    n = len(vectors)
+    idf = np.log((1 + n) / (1 + np.fromiter(doc_freq.values(), dtype=np.float64, count=len(doc_freq)))) + 1.0
+    indptr, indices, data = [0], [], []
+    for terms, counts in vectors:
+        for term_id, count in zip(terms, counts):
+            col = column.get(term_id)
+            if col is not None:
+                indices.append(col)
+                data.append(count)
+        indptr.append(len(indices))
+    X = csr_matrix(
+        (np.asarray(data, dtype=np.float64), np.asarray(indices, dtype=np.int64), indptr),
+        shape=(n, len(doc_freq)),
+    )
+    X = X.multiply(idf).tocsr()
+    return normalize(X, norm="l2", copy=False)
+
+
+def similar_submissions(sub: Submission, top_k: int, min_sim: float = 0.0) -> List[Tuple[str, float]]:
+    """
+    Hakee palautusta eniten muistuttavat saman tehtävänannon palautukset.
+
+    Varmistaa ensin, että palautus on indeksissä ajan tasalla (ks.
+    index_submission; muuttumattomalle vastaukselle yksi haku). Lukupolku ei
+    rakenna indeksiä uudelleen: signaalien ohi lisätyt palautukset
+    indeksoidaan build_tfidf_index-komennolla.
+
+    Args:
+        sub (Submission): Verrattava palautus.
+        top_k (int): Kuinka monta samankaltaisinta palautetaan.
+        min_sim (float): Kosinisamankaltaisuuden alaraja.
+
+    Returns:
+        List[Tuple[str, float]]: (palautuksen ID, samankaltaisuus) laskevassa järjestyksessä.
+    """
+    index_submission(sub)
+    rows = list(
+        TfidfVector.objects.filter(assignment_id=sub.assignment_id).values_list("submission_id", "terms", "counts")
+    )
+    key = str(sub.pk)
+    keys = [str(pk) for pk, _, _ in rows]
+    if key not in keys or len(keys) < 2:
+        return []
+    doc_freq = dict(TfidfTerm.objects.filter(assignment_id=sub.assignment_id, doc_freq__gt=0).values_list("pk", "doc_freq"))
+    X = _tfidf_rows([(terms, counts) for _, terms, counts in rows], doc_freq)
+    sims = (X @ X[keys.index(key)].T).toarray().ravel()
+    ranked = sorted(((k, sc) for k, sc in zip(keys, sims) if k != key), key=lambda t: t[1], reverse=True)
+    return [(k, float(sc)) for k, sc in ranked[:top_k] if sc >= min_sim]
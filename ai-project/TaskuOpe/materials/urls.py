@@ -3,7 +3,7 @@ from . import views
 from users import views as user_views
 from django.conf import settings
 from django.conf.urls.static import static
-from .views import ops_facets, ops_search
+from .views import ops_facets, ops_search, ops_search_batch
 
 
 
@@ -22,6 +22,8 @@ urlpatterns = [
     path("material/<uuid:material_id>/assign/", views.assign_material_view, name="assign_material"),
     path("material/<uuid:material_id>/delete/", views.delete_material_view, name="delete_material"),
     path("material/<uuid:material_id>/submissions/", views.view_submissions, name="view_submissions"),
+    path("material/<uuid:material_id>/submissions/ai-grade/", views.grade_all_submissions_view, name="grade_all_submissions"),
+    path("material/<uuid:material_id>/submissions/similarity/", views.class_similarity_view, name="class_similarity"),
     path("materiaalit/", views.material_list_view, name="material_list"),
 
     # 🔧 Nämä kaksi muutettu int -> uuid
@@ -38,6 +40,10 @@ urlpatterns = [
 
     #Peligenerointi
     path('ajax/generate-game/', views.generate_game_ajax_view, name='generate_game_ajax'),
+
+    # Tekoälyavustimen suoratoisto (SSE)
+    path('ajax/ai-stream/', views.ai_stream_view, name='ai_stream'),
+    path('ajax/ai-job/<uuid:job_id>/', views.ai_job_status_view, name='ai_job_status'),
     path('assignment/<uuid:assignment_id>/play/', views.play_game_view, name='play_game'),
     path('assignment/<uuid:assignment_id>/complete/', views.complete_game_ajax_view, name='complete_game_ajax'),
 
@@ -64,6 +70,7 @@ urlpatterns = [
     # JSON chunkit
     path("api/ops/facets", ops_facets, name="ops_facets"),
     path("api/ops/search", ops_search, name="ops_search"),
+    path("api/ops/search/batch", ops_search_batch, name="ops_search_batch"),
 ]
 
 # LISÄÄ TÄMÄ LOHKO TIEDOSTON LOPPUUN
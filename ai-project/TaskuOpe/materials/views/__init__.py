@@ -5,7 +5,7 @@ from .main import dashboard_view
 from .teacher import (
     teacher_dashboard_view, create_material_view, material_list_view, edit_material_view,
     delete_material_view, assign_material_view, unassign_assignment, delete_assignment_view,
-    view_submissions, grade_submission_view, view_all_submissions_view,
+    view_submissions, grade_all_submissions_view, class_similarity_view, grade_submission_view, view_all_submissions_view,
     export_submissions_csv_view, teacher_student_list_view,
     add_material_image_view,
     delete_material_image_view,
@@ -19,7 +19,8 @@ from .student import (
 
 from .api import (
     generate_game_ajax_view, complete_game_ajax_view, assignment_autosave_view,
-    generate_image_view, assignment_tts_view, ops_facets, ops_search
+    generate_image_view, assignment_tts_view, ops_facets, ops_search,
+    ops_search_batch, ai_stream_view, ai_job_status_view,
 )
 
 from .shared import (
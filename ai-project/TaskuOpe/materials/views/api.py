@@ -1,4 +1,4 @@
-from django.http import JsonResponse, HttpResponse, HttpResponseForbidden
+from django.http import JsonResponse, HttpResponse, HttpResponseForbidden, StreamingHttpResponse
 from django.views.decorators.http import require_POST, require_GET
 from django.shortcuts import get_object_or_404
 from django.contrib.auth.decorators import login_required
@@ -7,7 +7,10 @@ from django.conf import settings # Tuo Django-asetukset
 import boto3 # Tuo AWS SDK
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile 
+from django.http import Http404
+from asgiref.sync import sync_to_async
 
+import asyncio
 import json
 import os
 import uuid
@@ -16,15 +19,19 @@ import requests
 import re
 from urllib.parse import urljoin
 
-from ..models import Assignment, Submission, Material, MaterialImage
-from ..ai_service import generate_speech, generate_image_bytes
-from TaskuOpe.ops_chunks import get_facets, retrieve_chunks
-from openai import OpenAI
+from ..models import AIJob, Assignment, Submission, Material, MaterialImage
+from ..ai_service import agenerate_image_bytes, agenerate_speech, build_ops_prompt, astream_llm
+from TaskuOpe.ops_chunks import ANALYZERS, SCORERS, get_facets, retrieve_chunks, retrieve_chunks_many
+from .. import llm_cache, openai_client, rate_limit
+
+# Pelin generoinnin yhteinen aikaraja (s): sisältö ja metadata generoidaan rinnakkain
+GAME_DEADLINE = 90.0
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 # Pelisisältö
-def generate_game_content(topic: str, game_type: str, difficulty: str = 'medium') -> dict:
+async def agenerate_game_content(
+    topic: str, game_type: str, difficulty: str = 'medium', regenerate: bool = False, *, user_id: int = 0,
+) -> dict:
     """
     Generoi pelisisällön tekoälyllä annetun aiheen, pelityypin ja
     vaikeustason perusteella.
@@ -34,12 +41,15 @@ def generate_game_content(topic: str, game_type: str, difficulty: str = 'medium'
         game_type (str): Pelityyppi ('quiz', 'hangman', 'memory').
         difficulty (str): Vaikeustaso ('easy', 'medium', 'hard')
                           (käytössä vain visapelissä).
+        regenerate (bool): Ohita vastausvälimuisti ja generoi uusi sisältö.
+        user_id (int): Opettajan ID (käyttäjäkohtainen kiintiö).
 
     Returns:
         dict: Generoitu pelisisältö JSON-muodossa.
 
     Raises:
         ValueError: Jos annettua pelityyppiä ei tunnisteta.
+        rate_limit.RateLimited: Jos kiintiö ei riitä aikarajassa.
     """
     prompt = ""
     
@@ -96,17 +106,21 @@ Palauta VAIN JSON: {{"pairs":[...]}}
     else:
         raise ValueError("Tuntematon pelityyppi")
 
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        response_format={"type": "json_object"},
-        messages=[{"role": "user", "content": prompt}]
-    )
-    
-    content = response.choices[0].message.content
-    return json.loads(content)
+    async def generate() -> dict:
+        async with rate_limit.alimit("gpt-4o", tokens=rate_limit.estimate_tokens(prompt), user_id=user_id):
+            response = await openai_client.acall("chat", lambda client: client.chat.completions.create(
+                model="gpt-4o",
+                response_format={"type": "json_object"},
+                messages=[{"role": "user", "content": prompt}]
+            ))
+        content = response.choices[0].message.content
+        return json.loads(content)
+
+    key = llm_cache.cache_key("gpt-4o", "", prompt, None, response_format="json_object")
+    return (await llm_cache.acached(key, generate, bypass=regenerate))[0]
 
 # Pelin metadata
-def generate_game_metadata(game_name: str, topic: str) -> dict:
+async def agenerate_game_metadata(game_name: str, topic: str, regenerate: bool = False, *, user_id: int = 0) -> dict:
     """
     Generoi pelille otsikon ja aiheen OpenAI:n avulla.
     Aihe valitaan Suomen opetussuunnitelman mukaisista oppiaineista.
@@ -114,6 +128,8 @@ def generate_game_metadata(game_name: str, topic: str) -> dict:
     Args:
         game_name (str): Pelin nimi tai tyyppi (esim. 'Quiz').
         topic (str): Pelin aihe tai kuvaus.
+        regenerate (bool): Ohita vastausvälimuisti.
+        user_id (int): Opettajan ID (käyttäjäkohtainen kiintiö).
 
     Returns:
         dict: Sanakirja, joka sisältää generoidun otsikon ('title')
@@ -163,16 +179,20 @@ Palauta täsmälleen tässä muodossa:
 {{"title":"otsikko tähän","subject":"oppiaine tähän"}}
 """
     
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            response_format={"type": "json_object"},
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.7
-        )
-        
+    async def generate() -> dict:
+        async with rate_limit.alimit("gpt-4o", tokens=rate_limit.estimate_tokens(prompt, completion=100), user_id=user_id):
+            response = await openai_client.acall("chat", lambda client: client.chat.completions.create(
+                model="gpt-4o",
+                response_format={"type": "json_object"},
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.7
+            ))
         content = response.choices[0].message.content
-        result = json.loads(content)
+        return json.loads(content)
+
+    try:
+        key = llm_cache.cache_key("gpt-4o", "", prompt, 0.7, response_format="json_object")
+        result = (await llm_cache.acached(key, generate, bypass=regenerate))[0]
         
         # Varmista että palautettu oppiaine on listalla
         returned_subject = result.get('subject', 'Ympäristöoppi')
@@ -185,17 +205,71 @@ Palauta täsmälleen tässä muodossa:
         }
     except Exception as e:
         # Fallback jos API-kutsu epäonnistuu
-        return {
-            'title': f'{game_name.capitalize()}: {topic[:40]}',
-            'subject': 'Ympäristöoppi'
-        }
+        return _default_metadata(game_name, topic)
+
+def _default_metadata(game_name: str, topic: str) -> dict:
+    """Oletusotsikko ja -oppiaine, kun metadataa ei saada tekoälyltä."""
+    return {
+        'title': f'{game_name.capitalize()}: {topic[:40]}',
+        'subject': 'Ympäristöoppi'
+    }
+
+async def generate_game(
+    topic: str, game_type: str, difficulty: str = 'medium', regenerate: bool = False, *, user_id: int = 0,
+) -> tuple:
+    """
+    Generoi pelisisällön ja metadatan rinnakkain yhteisen aikarajan sisällä.
+
+    Sisältö on pakollinen: jos se epäonnistuu tai ei valmistu ajoissa,
+    metadatakutsu perutaan ja virhe nostetaan. Metadata korvataan
+    oletuksella, jos se epäonnistuu tai ei valmistu aikarajaan mennessä.
+
+    Args:
+        topic (str): Pelin aihe tai kuvaus.
+        game_type (str): Pelityyppi ('quiz', 'hangman', 'memory').
+        difficulty (str): Vaikeustaso ('easy', 'medium', 'hard').
+        regenerate (bool): Ohita vastausvälimuisti.
+        user_id (int): Opettajan ID (käyttäjäkohtainen kiintiö).
+
+    Returns:
+        tuple: (pelisisältö, metadata).
+
+    Raises:
+        asyncio.TimeoutError: Jos pelisisältö ei valmistu aikarajassa
+                              (settings.GAME_GENERATION_DEADLINE).
+        rate_limit.RateLimited: Jos kiintiö ei riitä aikarajassa.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + getattr(settings, 'GAME_GENERATION_DEADLINE', GAME_DEADLINE)
+    content = asyncio.ensure_future(
+        agenerate_game_content(topic, game_type, difficulty, regenerate=regenerate, user_id=user_id)
+    )
+    metadata = asyncio.ensure_future(agenerate_game_metadata(game_type, topic, regenerate=regenerate, user_id=user_id))
+    try:
+        game_data = await asyncio.wait_for(content, timeout=max(0.0, deadline - loop.time()))
+    except BaseException:
+        metadata.cancel()
+        raise
+    try:
+        meta = await asyncio.wait_for(metadata, timeout=max(0.0, deadline - loop.time()))
+    except asyncio.TimeoutError:
+        print("Pelin metadata ei valmistunut aikarajassa, käytetään oletusta.")
+        meta = _default_metadata(game_type, topic)
+    return game_data, meta
+
+def _rate_limited_response(e: rate_limit.RateLimited) -> JsonResponse:
+    """429-vastaus, kun OpenAI-kiintiö ei riitä (Retry-After kertoo odotuksen)."""
+    resp = JsonResponse({'error': str(e)}, status=429)
+    resp['Retry-After'] = str(max(1, round(e.retry_after)))
+    return resp
 
 @require_POST
 @login_required
-def generate_game_ajax_view(request):
+async def generate_game_ajax_view(request):
     """
     AJAX-näkymä pelisisällön ja metadatan generointiin tekoälyllä.
-    Vain opettajat voivat käyttää tätä.
+    Vain opettajat voivat käyttää tätä. Async-näkymä: ASGI:n alla
+    LLM-vastausta odotetaan varaamatta workeria.
 
     Args:
         request: HTTP-pyyntö, sisältää aiheen, pelityypin ja vaikeustason.
@@ -204,7 +278,8 @@ def generate_game_ajax_view(request):
         JsonResponse: Sisältää generoidun pelidatan ja metadatan
                       tai virheilmoituksen.
     """
-    if not hasattr(request.user, "role") or request.user.role != "TEACHER":
+    user = await request.auser()
+    if not hasattr(user, "role") or user.role != "TEACHER":
         return JsonResponse({'error': 'Vain opettajat voivat luoda pelejä.'}, status=403)
     
     try:
@@ -212,15 +287,13 @@ def generate_game_ajax_view(request):
         topic = data.get('topic')
         game_type = data.get('game_type')
         difficulty = data.get('difficulty', 'medium')  # 🆕 Oletuksena medium
+        regenerate = bool(data.get('regenerate'))  # "Generoi uudelleen" ohittaa välimuistin
         
         if not topic or not game_type:
             return JsonResponse({'error': 'Aihe ja pelityyppi ovat pakollisia.'}, status=400)
 
-        # Generoi pelisisältö vaikeustasolla
-        game_data = generate_game_content(topic, game_type, difficulty)
-        
-        # Generoi otsikko ja aihe automaattisesti
-        metadata = generate_game_metadata(topic, game_type)
+        # Generoi pelisisältö sekä otsikko ja aihe rinnakkain
+        game_data, metadata = await generate_game(topic, game_type, difficulty, regenerate=regenerate, user_id=user.id)
         
         # Palauta sekä pelisisältö että metadata
         return JsonResponse({
@@ -229,10 +302,54 @@ def generate_game_ajax_view(request):
             'metadata': metadata
         })
 
+    except asyncio.TimeoutError:
+        return JsonResponse({'error': 'Pelin generointi kesti liian kauan. Yritä uudelleen.'}, status=504)
+    except rate_limit.RateLimited as e:
+        return _rate_limited_response(e)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
-    
+
+@require_POST
+@login_required
+async def ai_stream_view(request):
+    """
+    Suoratoistaa materiaalin luonnin tekoälyvastauksen server-sent events -muodossa.
+
+    Ottaa samat lomakekentät kuin create_material_view:n AI-toiminto
+    (ai_prompt, use_ops, ops_subject, ops_grade) sekä regenerate=1, joka
+    ohittaa vastausvälimuistin. Tapahtumat: "delta" (tekstinpala), "done"
+    (lopullinen vastaus) ja "error"; data on JSON {"text": ...}. Async-näkymä:
+    ASGI lähettää jokaisen tapahtuman heti eikä puskuroi vastausta.
+
+    Args:
+        request: HTTP-pyyntö (POST).
+
+    Returns:
+        StreamingHttpResponse: text/event-stream, tai JsonResponse virheestä.
+    """
+    user = await request.auser()
+    if getattr(user, "role", None) != "TEACHER":
+        return JsonResponse({'error': 'Vain opettajat voivat käyttää tekoälyavustinta.'}, status=403)
+    question = (request.POST.get('ai_prompt') or '').strip()
+    if not question:
+        return JsonResponse({'error': 'Kirjoita ensin aihe tai ohje.'}, status=400)
+
+    prompt = question
+    subject, grade = request.POST.get('ops_subject', ''), request.POST.get('ops_grade', '')
+    if request.POST.get('use_ops') == 'on' and subject and grade:
+        prompt, _ = await sync_to_async(build_ops_prompt)(question, subjects=[subject], grades=[grade])
+    regenerate = request.POST.get('regenerate') == '1'
+
+    async def events():
+        async for event, text in astream_llm(prompt, user_id=user.id, regenerate=regenerate):
+            yield f"event: {event}\ndata: {json.dumps({'text': text}, ensure_ascii=False)}\n\n"
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # ei puskurointia välityspalvelimessa
+    return response
+
 @require_POST
 @login_required
 def complete_game_ajax_view(request, assignment_id):
@@ -399,10 +516,13 @@ def assignment_autosave_view(request, assignment_id):
 # materials/views/api.py
 
 @require_POST
-def generate_image_view(request):
+async def generate_image_view(request):
     """
     Handles image requests via AJAX. Sets ACL to public-read in production
     to ensure permanent URLs. Includes enhanced logging.
+
+    Async view: the DALL·E call is awaited and the blocking storage upload
+    runs in a worker thread (sync_to_async).
     """
     print("\n--- generate_image_view CALLED ---")
     print(f"Request Method: {request.method}")
@@ -465,10 +585,14 @@ def generate_image_view(request):
                  size = size_map.get(size, "1024x1024") # Default to square if mapping fails
 
             print(f"Generating image with prompt: '{prompt}', size: {size}")
-            image_bytes = generate_image_bytes(prompt=prompt, size=size) # Use the validated/mapped size
+            user = await request.auser()
+            image_bytes = await agenerate_image_bytes(prompt=prompt, size=size, user_id=user.id or 0) # Use the validated/mapped size
             if not image_bytes:
                 print("ERROR: AI generation returned empty result.")
                 return JsonResponse({"error": "Generointi palautti tyhjän tuloksen."}, status=502)
+        except rate_limit.RateLimited as e:
+            print(f"ERROR: AI generation rate limited: {e}")
+            return _rate_limited_response(e)
         except Exception as e:
             print(f"ERROR: AI generation failed: {e}")
             return JsonResponse({"error": str(e)}, status=502)
@@ -484,6 +608,17 @@ def generate_image_view(request):
          print("ERROR: No file object available for saving.")
          return JsonResponse({"error": "Tiedostoa tallennukseen ei löytynyt."}, status=500)
 
+    try:
+        return await sync_to_async(_save_image, thread_sensitive=False)(file_path, uploaded_file)
+    finally:
+        print("--- generate_image_view END ---")
+
+
+def _save_image(file_path, uploaded_file):
+    """
+    Saves the image to default storage (public-read ACL in production)
+    and returns a JsonResponse with its URL.
+    """
     try:
         print(f"Attempting to save file to: {file_path}")
         # 1. Save the file using default storage
@@ -532,8 +667,6 @@ def generate_image_view(request):
     except Exception as e:
         print(f"ERROR: File saving process failed: {e}")
         return JsonResponse({"error": f"Tallennus epäonnistui: {str(e)}"}, status=500)
-    finally:
-        print("--- generate_image_view END ---")
 
 def material_detail_view(request, material_id):
     """
@@ -562,17 +695,22 @@ def material_detail_view(request, material_id):
 # Text-to-Speech for assignment content -> Poistetaan ym regexillä
 @login_required(login_url='kirjaudu')
 @require_POST
-def assignment_tts_view(request, assignment_id):
+async def assignment_tts_view(request, assignment_id):
     """
     Generoi äänitiedoston tehtävänannon sisällöstä (ilman kuvatekstejä) ja palauttaa sen.
 
     Vaatii käyttäjän kirjautumisen ja POST-pyynnön.
     Tarkistaa, että käyttäjä on tehtävän omistaja.
     Poistaa Markdown-kuvat tehtävän sisällöstä ennen äänitiedoston luontia.
+    Async-näkymä: puhesynteesiä odotetaan varaamatta workeria.
     """
-    assignment = get_object_or_404(Assignment, id=assignment_id)
+    try:
+        assignment = await Assignment.objects.select_related('material').aget(id=assignment_id)
+    except Assignment.DoesNotExist:
+        raise Http404("Tehtävää ei löytynyt.")
 
-    if assignment.student != request.user:
+    user = await request.auser()
+    if assignment.student_id != user.id:
         return HttpResponseForbidden("Sinulla ei ole oikeuksia tähän.")
 
     raw_text = assignment.material.content
@@ -588,17 +726,70 @@ def assignment_tts_view(request, assignment_id):
         # Jos jäljelle jäi vain tyhjää, palautetaan virhe.
         return JsonResponse({"Virhe": "Ei luettavaa tekstiä löytynyt siivouksen jälkeen."}, status=400)
 
-    audio_bytes = generate_speech(clean_text)
+    try:
+        audio_bytes = await agenerate_speech(clean_text, user_id=user.id)
+    except rate_limit.RateLimited as e:
+        return _rate_limited_response(e)
 
     if audio_bytes:
         return HttpResponse(audio_bytes, content_type='audio/mpeg')
     else:
         return JsonResponse({"Virhe": "Äänitiedoston luonti epäonnistui."}, status=500)
     
+@require_GET
+@login_required
+def ai_job_status_view(request, job_id):
+    """
+    Palauttaa tekoälytyön (AIJob) tilan JSON-muodossa arviointisivun pollausta varten.
+
+    Vain materiaalin omistaja tai työn pyytäjä näkee tilan. Koko luokan
+    arvioinnissa progress/total kertovat käsiteltyjen palautusten määrän.
+
+    Args:
+        request: HTTP-pyyntö (GET).
+        job_id (uuid): Työn tunniste.
+
+    Returns:
+        JsonResponse: {"status", "status_display", "active", "attempts",
+        "progress", "total", "error"}.
+    """
+    job = get_object_or_404(AIJob.objects.select_related('submission__assignment__material', 'material'), id=job_id)
+    if job.submission:
+        owner_id = job.submission.assignment.material.author_id
+    else:
+        owner_id = job.material.author_id if job.material else None
+    if request.user.id not in (owner_id, job.requested_by_id):
+        return JsonResponse({'error': 'Ei oikeuksia.'}, status=403)
+    return JsonResponse({
+        'status': job.status,
+        'status_display': job.get_status_display(),
+        'active': job.is_active,
+        'attempts': job.attempts,
+        'progress': job.progress,
+        'total': job.total,
+        'error': job.last_error if job.status == AIJob.Status.FAILED else '',
+    })
+
 #JSON Chunks lataus tekoälylle
 @require_GET
 def ops_facets(request):
-    return JsonResponse(get_facets())
+    """
+    Palauttaa OPS-facetit ja niiden osumamäärät JSON-muodossa.
+
+    Valinnaiset GET-parametrit (q, subject, grade, ctype, analyzer) rajaavat
+    määrät nykyisen haun mukaan, jolloin käyttöliittymä voi näyttää määrät
+    ilman erillisiä hakuja.
+    """
+    analyzer = request.GET.get("analyzer", "plain")
+    if analyzer not in ANALYZERS:
+        return JsonResponse({"error": f"Tuntematon analysaattori: {analyzer}"}, status=400)
+    return JsonResponse(get_facets(
+        request.GET.get("q", ""),
+        subjects=request.GET.getlist("subject"),
+        grades=request.GET.getlist("grade"),
+        ctypes=request.GET.getlist("ctype"),
+        analyzer=analyzer,
+    ))
 
 @require_GET
 def ops_search(request):
@@ -615,5 +806,57 @@ def ops_search(request):
     subjects = request.GET.getlist("subject")  # voi toistua
     grades   = request.GET.getlist("grade")
     ctypes   = request.GET.getlist("ctype")
-    results = retrieve_chunks(q, k=k, subjects=subjects, grades=grades, ctypes=ctypes)
-    return JsonResponse({"results": results})
\ No newline at end of file
+    scorer   = request.GET.get("scorer", "tf")
+    analyzer = request.GET.get("analyzer", "plain")
+    if scorer not in SCORERS:
+        return JsonResponse({"error": f"Tuntematon pisteytystapa: {scorer}"}, status=400)
+    if analyzer not in ANALYZERS:
+        return JsonResponse({"error": f"Tuntematon analysaattori: {analyzer}"}, status=400)
+    results = retrieve_chunks(
+        q, k=k, subjects=subjects, grades=grades, ctypes=ctypes, scorer=scorer, analyzer=analyzer
+    )
+    return JsonResponse({"results": results})
+
+# Yhden eräkutsun kyselyjen enimmäismäärä
+OPS_BATCH_MAX_QUERIES = 100
+
+@require_POST
+def ops_search_batch(request):
+    """
+    Hakee monta OPS-kyselyä yhdellä kutsulla (esim. koko luokan arviointi).
+
+    Odottaa JSON-rungon {"queries": [...], "k", "subject", "grade", "ctype",
+    "scorer", "analyzer"}, jossa suodattimet ovat listoja ja koskevat kaikkia
+    kyselyjä. Palauttaa {"results": [[...], ...]} kyselyjen järjestyksessä.
+    """
+    try:
+        data = json.loads(request.body or b"{}")
+    except json.JSONDecodeError:
+        return JsonResponse({"error": "Virheellinen JSON"}, status=400)
+    queries = data.get("queries") if isinstance(data, dict) else None
+    if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+        return JsonResponse({"error": "queries on oltava lista merkkijonoja"}, status=400)
+    if len(queries) > OPS_BATCH_MAX_QUERIES:
+        return JsonResponse({"error": f"Enintään {OPS_BATCH_MAX_QUERIES} kyselyä kerralla"}, status=400)
+    filters = {}
+    for field in ("subject", "grade", "ctype"):
+        values = data.get(field) or []
+        if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+            return JsonResponse({"error": f"{field} on oltava lista merkkijonoja"}, status=400)
+        filters[field] = values
+    try:
+        k = max(0, int(data.get("k", 8) or 8))
+    except (TypeError, ValueError):
+        k = 8
+    scorer   = data.get("scorer", "tf")
+    analyzer = data.get("analyzer", "plain")
+    if not isinstance(scorer, str) or scorer not in SCORERS:
+        return JsonResponse({"error": f"Tuntematon pisteytystapa: {scorer}"}, status=400)
+    if not isinstance(analyzer, str) or analyzer not in ANALYZERS:
+        return JsonResponse({"error": f"Tuntematon analysaattori: {analyzer}"}, status=400)
+    results = retrieve_chunks_many(
+        queries, k=k,
+        subjects=filters["subject"], grades=filters["grade"], ctypes=filters["ctype"],
+        scorer=scorer, analyzer=analyzer,
+    )
+    return JsonResponse({"results": results})
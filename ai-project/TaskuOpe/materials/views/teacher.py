@@ -12,12 +12,15 @@ from django.db.models.functions import Concat
 import csv
 from django.core.files.base import ContentFile
 from django.views.decorators.http import require_POST
+from asgiref.sync import sync_to_async
 from users.models import CustomUser
-from ..models import Material, Assignment, Submission, MaterialImage
+from ..models import AIJob, Material, Assignment, Submission, MaterialImage
 from ..forms import MaterialForm, AssignForm, GradingForm, AddImageForm
-from ..ai_service import ask_llm, ask_llm_with_ops, generate_image_bytes
-from ..ai_rubric import create_or_update_ai_grade
-from ..plagiarism import build_or_update_report
+from ..ai_service import aask_llm, aask_llm_with_ops, generate_image_bytes
+from ..ai_rubric import ai_grade_is_current, ungraded_submissions
+from ..class_similarity import analyze_material
+from ..plagiarism import report_is_current, stored_report_is_current
+from .. import jobs
 from .shared import format_game_content_for_display, render_material_content_to_html
 from TaskuOpe.ops_chunks import get_facets
 from urllib.parse import urljoin
@@ -75,52 +78,76 @@ def teacher_dashboard_view(request):
 
 
 @login_required(login_url='kirjaudu')
-def create_material_view(request):
+async def create_material_view(request):
 
     """
     Manuaalinen materiaalin luonti, tekoälyavustin ja pelin generointi.
     Opettaja voi luoda uuden materiaalin käsin, käyttää tekoälyä sisällön
     generointiin tai luoda tekoälyn avulla pelin.
 
+    Async-näkymä: tekoälytoiminnon LLM-vastausta odotetaan varaamatta
+    workeria; muut toiminnot ajetaan synkronisina (sync_to_async).
+
     Args:
         request: HTTP-pyyntö.
 
     Returns:
         HttpResponse: Renderöity materiaalin luontisivu.
     """
-    if request.user.role != 'TEACHER':
-        return redirect('dashboard')
+    if request.method == 'POST' and request.POST.get('action') in ('ai', 'ai_regenerate'):
+        return await _create_material_ai(request)
+    return await sync_to_async(_create_material)(request)
 
-    ops_facets = get_facets()
-    ai_reply = None
-    ai_prompt_val = ""
-    ops_vals = {
+
+def _ops_vals(request) -> dict:
+    return {
         'use_ops': request.POST.get('use_ops') == 'on',
         'ops_subject': request.POST.get('ops_subject', ''),
         'ops_grade': request.POST.get('ops_grade', ''),
     }
 
+
+async def _create_material_ai(request):
+    """Materiaalin luontisivun tekoälyavustin (action=ai / ai_regenerate)."""
+    user = await request.auser()
+    if user.role != 'TEACHER':
+        return redirect('dashboard')
+
+    ops_facets = await sync_to_async(get_facets, thread_sensitive=False)()
+    ops_vals = _ops_vals(request)
+    ai_reply = None
+    ai_prompt_val = (request.POST.get('ai_prompt') or '').strip()
+    # "Luo uusi ehdotus" ohittaa vastausvälimuistin
+    regenerate = request.POST.get('action') == 'ai_regenerate'
+    if ai_prompt_val:
+        if ops_vals['use_ops'] and ops_vals['ops_subject'] and ops_vals['ops_grade']:
+            result = await aask_llm_with_ops(
+                ai_prompt_val, subjects=[ops_vals['ops_subject']],
+                grades=[ops_vals['ops_grade']], user_id=user.id,
+                regenerate=regenerate,
+            )
+            ai_reply = result.get('answer', '[Virhe haettaessa OPS-dataa]')
+        else:
+            ai_reply = await aask_llm(ai_prompt_val, user_id=user.id, regenerate=regenerate)
+
+    return await sync_to_async(render)(request, 'materials/create.html', {
+        'form': MaterialForm(request.POST), 'ai_prompt': ai_prompt_val, 'ai_reply': ai_reply,
+        'ops_vals': ops_vals, 'ops_facets': ops_facets
+    })
+
+
+def _create_material(request):
+    """Materiaalin luontisivu ja tallennus (kaikki muut kuin tekoälytoiminto)."""
+    if request.user.role != 'TEACHER':
+        return redirect('dashboard')
+
+    ops_facets = get_facets()
+    ops_vals = _ops_vals(request)
+
     if request.method == 'POST':
         action = request.POST.get('action')
         form = MaterialForm(request.POST)
 
-        if action == 'ai':
-            ai_prompt_val = (request.POST.get('ai_prompt') or '').strip()
-            if ai_prompt_val:
-                if ops_vals['use_ops'] and ops_vals['ops_subject'] and ops_vals['ops_grade']:
-                    result = ask_llm_with_ops(
-                        question=ai_prompt_val, subjects=[ops_vals['ops_subject']],
-                        grades=[ops_vals['ops_grade']], user_id=request.user.id
-                    )
-                    ai_reply = result.get('answer', '[Virhe haettaessa OPS-dataa]')
-                else:
-                    ai_reply = ask_llm(ai_prompt_val, user_id=request.user.id)
-            
-            return render(request, 'materials/create.html', {
-                'form': form, 'ai_prompt': ai_prompt_val, 'ai_reply': ai_reply,
-                'ops_vals': ops_vals, 'ops_facets': ops_facets
-            })
-
         if action == 'save' or action is None:
             if form.is_valid():
                 material = form.save(commit=False)
@@ -397,9 +424,78 @@ def view_submissions(request, material_id):
 
     return render(request, 'assignments/student_submissions.html', {
         'material': material,
-        'assignments': assignments
+        'assignments': assignments,
+        'ungraded_count': ungraded_submissions(material).count(),
+        'batch_job': jobs.latest_jobs(material=material).get(AIJob.Kind.BATCH_GRADE),
+        'class_similarity': getattr(material, 'class_similarity', None),
     })
 
+@login_required(login_url='kirjaudu')
+@require_POST
+def grade_all_submissions_view(request, material_id):
+    """
+    Opettajakäyttäjä: Lisää jonoon koko luokan AI-arvioinnin materiaalin
+    arvioimattomille palautuksille.
+
+    Worker arvioi palautukset rinnakkain (ks. ai_rubric.grade_submissions_batch);
+    palautussivu näyttää edistymisen. Keskeneräistä ajoa ei käynnistetä uudelleen.
+
+    Args:
+        request: HttpRequest-objekti (POST).
+        material_id (uuid): Materiaalin yksilöivä ID.
+
+    Returns:
+        HttpResponseRedirect: Uudelleenohjaus palautussivulle tai 'dashboard'-sivulle,
+                              jos oikeudet puuttuvat.
+    """
+    material = get_object_or_404(Material, id=material_id)
+    if request.user.role != "TEACHER" or material.author_id != request.user.id:
+        messages.error(request, "Sinulla ei ole oikeuksia tarkastella tätä sivua.")
+        return redirect('dashboard')
+
+    if not ungraded_submissions(material).exists():
+        messages.info(request, "Kaikilla palautuksilla on jo arvio tai AI-arviointiehdotus.")
+        return redirect('view_submissions', material_id=material.id)
+
+    _job, created = jobs.enqueue(AIJob.Kind.BATCH_GRADE, material=material, requested_by=request.user)
+    if created:
+        messages.info(request, "Koko luokan AI-arviointi lisätty jonoon.")
+    else:
+        messages.info(request, "Koko luokan AI-arviointi on jo käynnissä.")
+    return redirect('view_submissions', material_id=material.id)
+
+@login_required(login_url='kirjaudu')
+@require_POST
+def class_similarity_view(request, material_id):
+    """
+    Opettajakäyttäjä: Vertaa materiaalin kaikkia palautuksia keskenään.
+
+    Vertailu tehdään paikallisesti ilman LLM-kutsuja (ks.
+    class_similarity.analyze_material), joten se ajetaan suoraan pyynnössä.
+    Tulos näytetään palautussivulla lämpökarttana, ja palautusten
+    alkuperäisyysraportit päivitetään.
+
+    Args:
+        request: HttpRequest-objekti (POST).
+        material_id (uuid): Materiaalin yksilöivä ID.
+
+    Returns:
+        HttpResponseRedirect: Uudelleenohjaus palautussivulle tai 'dashboard'-sivulle,
+                              jos oikeudet puuttuvat.
+    """
+    material = get_object_or_404(Material, id=material_id)
+    if request.user.role != "TEACHER" or material.author_id != request.user.id:
+        messages.error(request, "Sinulla ei ole oikeuksia tarkastella tätä sivua.")
+        return redirect('dashboard')
+
+    result = analyze_material(material)
+    clusters = len(result.heatmap["clusters"])
+    if clusters:
+        messages.warning(request, f"Palautukset vertailtu: {clusters} lähes identtisten vastausten ryhmää.")
+    else:
+        messages.success(request, "Palautukset vertailtu: lähes identtisiä vastauksia ei löytynyt.")
+    return redirect('view_submissions', material_id=material.id)
+
 # Arvosanan laskenta pistemäärästä
 def _calculate_grade_from_score(score, max_score):
     """
@@ -442,13 +538,17 @@ def _calculate_grade_from_score(score, max_score):
         return 10
 
 @login_required(login_url='kirjaudu')
-@transaction.atomic
 def grade_submission_view(request, submission_id):
     """
     Käsittelee tehtävän palautuksen arvioinnin ja plagioinnin tarkistuksen.
 
     Mahdollistaa opettajalle arvosanan antamisen ja tallentamisen,
     sekä alkuperäisyysraportin luomisen tai päivittämisen pyynnöstä.
+    Tekoälytoiminnot (run_ai_grade, run_plagiarism) lisätään työjonoon
+    (materials.jobs); sivu näyttää töiden tilan ja päivittyy niiden valmistuttua.
+    Näkymä ei ole yhden transaktion sisällä: ajantasaisuuden tarkistus voi
+    päivittää verrokki-indeksejä, eikä niiden lukkoja pidetä koko pyynnön ajan.
+    Jonoon lisäys ja arvosanan tallennus ovat kumpikin omia transaktioitaan.
 
     Args:
         request: HttpRequest-objekti.
@@ -470,14 +570,25 @@ def grade_submission_view(request, submission_id):
         messages.error(request, "Sinulla ei ole oikeuksia arvioida tätä palautusta.")
         return redirect('dashboard')
 
-    # --- AI rubric grading: generate from button press ---
-    if request.method == 'POST' and 'run_ai_grade' in request.POST:
-        try:
-            ag = create_or_update_ai_grade(submission)
-            messages.success(request, f"AI-arvosanaehdotus luotu ({ag.total_points:.1f} pistettä).")
-        except Exception as e:
-            messages.error(request, f"AI-arvosanaehdotuksen luonti epäonnistui: {e}")
-        return redirect('grade_submission', submission_id=submission.id)
+    # --- AI rubric grading / plagiarism check: enqueue from button press ---
+    # Ajan tasalla olevaa tulosta (sisältötiiviste ennallaan) ei lasketa uudelleen, ellei opettaja pakota
+    for field, kind, label, is_current in (
+        ('run_ai_grade', AIJob.Kind.AI_GRADE, "AI-arvosanaehdotus", ai_grade_is_current),
+        ('run_plagiarism', AIJob.Kind.PLAGIARISM, "Alkuperäisyysselvitys", report_is_current),
+        ('run_plagiarism_llm', AIJob.Kind.PLAGIARISM_LLM, "Alkuperäisyyden tekoälyarvio",
+         lambda sub: report_is_current(sub, require_llm=True)),
+    ):
+        if request.method == 'POST' and field in request.POST:
+            force = request.POST.get('force') == '1'
+            if not force and is_current(submission):
+                messages.info(request, f"{label} on jo ajan tasalla: vastaus ja vertailutiedot eivät ole muuttuneet.")
+                return redirect('grade_submission', submission_id=submission.id)
+            _job, created = jobs.enqueue(kind, submission, requested_by=request.user, force=force)
+            if created:
+                messages.info(request, f"{label} lisätty jonoon. Sivu päivittyy, kun tulos on valmis.")
+            else:
+                messages.info(request, f"{label} on jo käsittelyssä.")
+            return redirect('grade_submission', submission_id=submission.id)
 
     # --- AI rubric grading: accept suggestion into fields ---
     if request.method == 'POST' and 'accept_ai_grade' in request.POST:
@@ -513,34 +624,17 @@ def grade_submission_view(request, submission_id):
         messages.success(request, "AI-arvosanaehdotus kopioitu arviointikenttiin. Voit nyt muokata ja tallentaa.")
         return redirect('grade_submission', submission_id=submission.id)
 
-    # --- Plagiarism check from button press ---
-    if request.method == 'POST' and 'run_plagiarism' in request.POST:
-        try:
-            report = build_or_update_report(submission)
-            if report.suspected_source:
-                messages.success(
-                    request,
-                    f"Alkuperäisyysselvityksen raportti päivitetty. Samankaltaisuus: {report.score:.2f}"
-                )
-            else:
-                messages.info(
-                    request,
-                    "Raportti päivitetty. Merkittävää samankaltaisuutta ei löytynyt."
-                )
-        except Exception as e:
-            messages.error(request, f"Raportin luonti epäonnistui: {e}")
-        return redirect('grade_submission', submission_id=submission.id)
-
     # --- Final form submission (saving the manual grade) ---
     if request.method == 'POST':
         form = GradingForm(request.POST, instance=submission)
         if form.is_valid():
-            sub = form.save(commit=False)
-            sub.graded_at = timezone.now()
-            sub.save()
+            with transaction.atomic():
+                sub = form.save(commit=False)
+                sub.graded_at = timezone.now()
+                sub.save()
 
-            assignment.status = Assignment.Status.GRADED
-            assignment.save(update_fields=['status'])
+                assignment.status = Assignment.Status.GRADED
+                assignment.save(update_fields=['status'])
 
             messages.success(request, "Arvosana tallennettu onnistuneesti.")
             return redirect('view_submissions', material_id=material.id)
@@ -550,6 +644,7 @@ def grade_submission_view(request, submission_id):
     # Pass potential reports and suggestions to the template
     plagiarism_report = getattr(submission, "plagiarism_report", None)
     ai_grade = getattr(submission, "ai_grade", None)
+    latest = jobs.latest_jobs(submission)
 
     # pelin HTML-esikatselu) renderöitäväksi HTML-koodiksi.
     rendered_material_content = render_material_content_to_html(material.content)
@@ -561,7 +656,12 @@ def grade_submission_view(request, submission_id):
         'submission': submission,
         'form': form,
         'plagiarism_report': plagiarism_report,
+        'plagiarism_current': plagiarism_report is not None and stored_report_is_current(plagiarism_report, submission),
         'ai_grade': ai_grade,
+        'ai_grade_current': ai_grade is not None and ai_grade_is_current(submission),
+        'ai_grade_job': latest.get(AIJob.Kind.AI_GRADE),
+        'plagiarism_job': latest.get(AIJob.Kind.PLAGIARISM),
+        'plagiarism_llm_job': latest.get(AIJob.Kind.PLAGIARISM_LLM),
         'rendered_material_content': rendered_material_content,
     })
 
@@ -869,7 +969,7 @@ def add_material_image_view(request, material_id):
                 print(f"AI generation selected (server-side fallback). Prompt: '{prompt}', Size: '{ai_image_size}'")
                 try:
                     # Assume generate_image_bytes is globally available
-                    image_data = generate_image_bytes(prompt, size=ai_image_size) 
+                    image_data = generate_image_bytes(prompt, size=ai_image_size, user_id=request.user.id)
                     if image_data:
                         image_to_save = ContentFile(image_data, name="gen.png")
                         rel_dir = "ai_images"
@@ -3,18 +3,40 @@
 Kerää perusopetuksen (POPS 2014) 1–6 -luokkien datan ePerusteet-rajapinnasta.
 
 Käsittelee vain ennalta määritellyt, halutut oppiaineet.
+
+Oppiaineet haetaan rinnakkain (asyncio + httpx, rajattu samanaikaisuus).
+Vastaukset tallennetaan levylle (.http_cache/) ETag- ja Last-Modified-
+otsakkeineen, joten uusinta-ajo lähettää ehdolliset pyynnöt ja saa
+muuttumattomista oppiaineista 304-vastauksen. --offline ajaa pelkästä
+välimuistista. Tulos kirjoitetaan JSONL-muotoon (yksi tietue riville),
+jonka ops_chunks lukee rivi kerrallaan ja indeksoi uudelleen vain
+muuttuneet oppiaineet.
+
+Käyttö: python collect_ops_data_API_toimiva.py [--offline] [--concurrency 4]
 '''
 
-import requests
+import argparse
+import asyncio
+import hashlib
 import json
+import os
 import re
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import httpx
+    _HAS_HTTPX = True
+except ImportError:
+    _HAS_HTTPX = False
 
 BASE_URL = "https://eperusteet.opintopolku.fi/eperusteet-service/api/external/peruste/419550/perusopetus"
 SUBJECTS_URL = f"{BASE_URL}/oppiaineet"
 HEADERS = {"Caller-Id": "script.opetussuunnitelma"}
 TIMEOUT = 30
-OUTPUT_FILE = "opetussuunnitelma_1-6_API_data.json"
+CONCURRENCY = 4
+HERE = os.path.dirname(os.path.abspath(__file__))
+OUTPUT_FILE = os.path.join(HERE, "opetussuunnitelma_1-6_API_data.jsonl")
+CACHE_DIR = os.path.join(HERE, ".http_cache")
 
 # ======================================================================
 # === SÄILYTETTÄVIEN OPPIAINEIDEN LISTA ("WHITELIST")               ====
@@ -192,52 +214,212 @@ def process_subject(
 
     return total_g, total_c, total_e
 
-def main():
+class ResponseCache:
+    """
+    Levyllä oleva HTTP-vastausvälimuisti.
+
+    Jokainen URL tallennetaan omaan tiedostoonsa (SHA-1 URL:sta) yhdessä
+    ETag- ja Last-Modified-otsakkeiden kanssa ehdollisia pyyntöjä varten.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.directory, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, url: str) -> Optional[Dict[str, Any]]:
+        """Palauttaa tallennetun vastauksen ({"body", "etag", "last_modified"}) tai None."""
+        try:
+            with open(self._path(url), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, url: str, body: Any, etag: Optional[str], last_modified: Optional[str]) -> None:
+        """Tallentaa vastauksen atomisesti (väliaikaistiedosto + os.replace)."""
+        path = self._path(url)
+        tmp = f"{path}.tmp{os.getpid()}"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"url": url, "etag": etag, "last_modified": last_modified, "body": body}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+async def fetch_json(
+    client: "httpx.AsyncClient",
+    cache: ResponseCache,
+    url: str,
+    sem: asyncio.Semaphore,
+    offline: bool = False,
+) -> Tuple[Any, str]:
+    """
+    Hakee JSON-vastauksen ehdollisella pyynnöllä välimuistin kautta.
+
+    Args:
+        client (httpx.AsyncClient): Jaettu HTTP-asiakas.
+        cache (ResponseCache): Levyvälimuisti.
+        url (str): Haettava osoite.
+        sem (asyncio.Semaphore): Rajoittaa samanaikaisten pyyntöjen määrää.
+        offline (bool): Jos True, verkkoon ei oteta yhteyttä.
+
+    Returns:
+        Tuple[Any, str]: Vastauksen data ja tila ("fetched", "not-modified",
+        "offline" tai "stale", kun verkko ei vastannut ja käytettiin välimuistia).
+
+    Raises:
+        LookupError: Offline-tilassa, jos URL:ää ei ole välimuistissa.
+        httpx.HTTPError: Jos haku epäonnistuu eikä välimuistissa ole vastausta.
+    """
+    entry = cache.get(url)
+    if offline:
+        if entry is None:
+            raise LookupError(f"Ei välimuistissa: {url}")
+        return entry["body"], "offline"
+
+    headers = dict(HEADERS)
+    if entry and entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry and entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    try:
+        async with sem:
+            resp = await client.get(url, headers=headers)
+        if resp.status_code == 304 and entry is not None:
+            return entry["body"], "not-modified"
+        resp.raise_for_status()
+    except httpx.HTTPError:
+        if entry is not None:
+            return entry["body"], "stale"
+        raise
+    body = resp.json()
+    cache.put(url, body, resp.headers.get("ETag"), resp.headers.get("Last-Modified"))
+    return body, "fetched"
+
+async def collect_async(
+    base_url: str = BASE_URL,
+    cache_dir: str = CACHE_DIR,
+    concurrency: int = CONCURRENCY,
+    offline: bool = False,
+    timeout: float = TIMEOUT,
+) -> Tuple[List[Dict[str, Any]], Dict[str, str]]:
+    """
+    Hakee halutut oppiaineet rinnakkain ja kerää niiden tietueet.
+
+    Args:
+        base_url (str): Rajapinnan perusosoite (testeissä paikallinen palvelin).
+        cache_dir (str): HTTP-välimuistin hakemisto.
+        concurrency (int): Samanaikaisten pyyntöjen enimmäismäärä.
+        offline (bool): Aja pelkästä välimuistista.
+        timeout (float): Yksittäisen pyynnön aikakatkaisu sekunteina.
+
+    Returns:
+        Tuple[List[Dict[str, Any]], Dict[str, str]]: Tietueet (vain ne, joilla
+        on luokka-aste) oppiaineiden järjestyksessä sekä oppiaine -> hakutila.
+    """
+    cache = ResponseCache(cache_dir)
+    sem = asyncio.Semaphore(max(1, concurrency))
+    async with httpx.AsyncClient(timeout=timeout) as client:
+        subjects, _ = await fetch_json(client, cache, f"{base_url}/oppiaineet", sem, offline)
+
+        wanted: List[Tuple[str, Any]] = []
+        for subj in subjects:
+            if not isinstance(subj, dict): continue
+            name = get_text(subj.get("nimi")) or get_text(subj.get("nimiFi"))
+            # Jos oppiaineen nimi ei sisällä mitään avainsanaa KEEP_SUBJECTS-listalta, ohita se.
+            if not any(keep_name in name.lower() for keep_name in KEEP_SUBJECTS):
+                continue
+            subj_id = subj.get("id") or subj.get("oppiaineId")
+            if subj_id:
+                wanted.append((name, subj_id))
+
+        async def collect_one(name: str, subj_id: Any) -> Tuple[str, List[Dict[str, Any]], str]:
+            try:
+                detail, status = await fetch_json(client, cache, f"{base_url}/oppiaineet/{subj_id}", sem, offline)
+            except Exception as e:
+                print(f"  Oppiaineen {name} tietojen haku epäonnistui: {e}")
+                return name, [], "error"
+            results: List[Dict[str, Any]] = []
+            g, c, e = process_subject(detail, name, results)
+            print(f"  {name} ({status}): {g} tavoitetta, {c} sisältöä, {e} arviointia.")
+            return name, results, status
+
+        done = await asyncio.gather(*(collect_one(name, subj_id) for name, subj_id in wanted))
+
+    rows = [res for _, results, _ in done for res in results if res.get("grade_context")]
+    return rows, {name: status for name, _, status in done}
+
+def subject_digests(lines: List[str]) -> Dict[str, str]:
+    """
+    Laskee oppiainekohtaiset tiivisteet JSONL-riveistä (ks. ops_chunks).
+
+    Args:
+        lines (List[str]): JSONL-rivit.
+
+    Returns:
+        Dict[str, str]: Oppiaineen nimi -> SHA-1 sen rivien sisällöstä.
+    """
+    groups: Dict[str, Any] = {}
+    for line in lines:
+        if not line.strip(): continue
+        subject = (json.loads(line).get("subject") or "").strip()
+        groups.setdefault(subject, hashlib.sha1()).update(line.strip().encode("utf-8") + b"\n")
+    return {subject: h.hexdigest() for subject, h in groups.items()}
+
+def write_jsonl(rows: List[Dict[str, Any]], path: str) -> List[str]:
+    """
+    Kirjoittaa tietueet JSONL-tiedostoon atomisesti.
+
+    Args:
+        rows (List[Dict[str, Any]]): Tallennettavat tietueet.
+        path (str): Kohdetiedosto.
+
+    Returns:
+        List[str]: Oppiaineet, joiden sisältö muuttui edelliseen tiedostoon verrattuna.
+    """
+    lines = [json.dumps(r, ensure_ascii=False) for r in rows]
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            old = subject_digests(f.read().splitlines())
+    except OSError:
+        old = {}
+    new = subject_digests(lines)
+    changed = sorted(s for s in set(old) | set(new) if old.get(s) != new.get(s))
+
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        for line in lines:
+            f.write(line + "\n")
+    os.replace(tmp, path)
+    return changed
+
+def main(argv: Optional[List[str]] = None):
     """
     Pääohjelma, joka hakee, käsittelee ja tallentaa perusopetuksen aineistoja.
     """
+    parser = argparse.ArgumentParser(description="Kerää POPS 2014 1–6 -datan ePerusteet-rajapinnasta.")
+    parser.add_argument("--base-url", default=BASE_URL)
+    parser.add_argument("--output", default=OUTPUT_FILE)
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--offline", action="store_true", help="Käytä vain HTTP-välimuistia.")
+    args = parser.parse_args(argv)
+
+    if not _HAS_HTTPX:
+        print("httpx-kirjasto puuttuu (pip install httpx)."); return
+
     print("Haetaan oppiaineet...")
     try:
-        resp = requests.get(SUBJECTS_URL, headers=HEADERS, timeout=TIMEOUT)
-        resp.raise_for_status(); subjects = resp.json()
+        rows, statuses = asyncio.run(collect_async(
+            base_url=args.base_url, cache_dir=args.cache_dir,
+            concurrency=args.concurrency, offline=args.offline,
+        ))
     except Exception as e:
         print(f"Oppiaineiden haku epäonnistui: {e}"); return
 
-    print(f"Löytyi {len(subjects)} oppiainetta.")
-    results: List[Dict[str, Any]] = []
-    kept_subjects_count = 0
-
-    for subj in subjects:
-        if not isinstance(subj, dict): continue
-        name = get_text(subj.get("nimi")) or get_text(subj.get("nimiFi"))
-        
-        # Jos oppiaineen nimi ei sisällä mitään avainsanaa KEEP_SUBJECTS-listalta, ohita se.
-        if not any(keep_name in name.lower() for keep_name in KEEP_SUBJECTS):
-            continue
-        
-        kept_subjects_count += 1
-        subj_id = subj.get("id") or subj.get("oppiaineId")
-        if not subj_id: continue
-
-        print(f"Käsitellään oppiaine {name} (ID {subj_id})...")
-        try:
-            resp2 = requests.get(f"{BASE_URL}/oppiaineet/{subj_id}", headers=HEADERS, timeout=TIMEOUT)
-            resp2.raise_for_status(); subj_detail = resp2.json()
-        except Exception as e:
-            print(f"  Oppiaineen {name} tietojen haku epäonnistui: {e}"); continue
-        
-        g, c, e = process_subject(subj_detail, name, results)
-        print(f"  -> Kerätty {g} tavoitetta, {c} sisältöä, {e} arviointia.")
-
-    print(f"\nKäsiteltiin {kept_subjects_count} oppiainetta KEEP_SUBJECTS-listan perusteella.")
-    
-    final_results = [res for res in results if res.get("grade_context")]
-    print(f"Kerättiin yhteensä {len(results)} tietuetta.")
-    print(f"Suodatettiin pois {len(results) - len(final_results)} tietuetta ilman selkeää luokka-astetta.")
-
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-        json.dump(final_results, f, ensure_ascii=False, indent=2)
-    print(f"Valmis. {len(final_results)} tietuetta tallennettu tiedostoon {OUTPUT_FILE}.")
+    print(f"\nKäsiteltiin {len(statuses)} oppiainetta KEEP_SUBJECTS-listan perusteella.")
+    changed = write_jsonl(rows, args.output)
+    print(f"Valmis. {len(rows)} tietuetta tallennettu tiedostoon {args.output}.")
+    print(f"Muuttuneet oppiaineet: {', '.join(changed) if changed else 'ei muutoksia'}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()